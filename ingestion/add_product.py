@@ -27,7 +27,10 @@ import traceback
 import datetime
 import json
 import sys
-import subprocess
+import time
+import atexit
+import threading
+import spawn_service
 
 from settings import \
     IE_SCRIPTS_DIR, \
@@ -35,17 +38,31 @@ from settings import \
     ADDPRODUCT_SUBDIR, \
     IE_MAX_ADDPRODOPS, \
     IE_PURGE_ADDPRODOPS, \
-    IE_ADDPRODOPS_AGE
+    IE_ADDPRODOPS_AGE, \
+    IE_CHECKSUM_ALGO, \
+    IE_RELOCATE_THREADS, \
+    IE_ADDPROD_BATCH_WINDOW, \
+    IE_ADDPROD_BATCH_MAX, \
+    IE_ADDPROD_BATCH_MAX_WAIT, \
+    DAR_STATUS_INTERVAL
 
 from ingestion_logic import \
     create_dl_dir, \
     download_urls, \
-    wait_for_download
+    wait_for_download, \
+    get_dar_status
 
 from utils import \
     get_base_fname, \
     mkFname, \
-    split_wcs_raw
+    split_wcs_raw, \
+    record_checksum, \
+    relocate, \
+    relocate_summary
+
+from callback_dispatcher import \
+    CallbackDispatcher, \
+    is_callback_url
 
 import work_flow_manager
 import models
@@ -55,6 +72,9 @@ logger = logging.getLogger('dream.file_logger')
 # Max number of seconds to wait for download
 IE_AP_MAX_DL_WAIT = 800
 
+# states of a DAR reported by the DM in which it does not change
+DAR_FINAL_STATES = ("COMPLETED", "IN_ERROR", "CANCELLED")
+
 #
 # Exception for local use within this file.
 # To raise an error outside, use one of the exception classes
@@ -67,6 +87,20 @@ class AddProductError(Exception):
         self.msg=str
 
 
+def record_split_checksum(manif_str, product):
+    # keep the checksum computed by split_wcs_raw with the product,
+    # there is no MANIFEST for addProduct
+    ck = {}
+    for l in manif_str.split('\n'):
+        kv = l.split('=', 1)
+        if len(kv) == 2 and kv[0].startswith('DATA_CHECKSUM'):
+            ck[kv[0]] = kv[1].strip('"')
+    if 'DATA_CHECKSUM' in ck:
+        record_checksum(os.path.dirname(product),
+                        os.path.basename(product),
+                        ck['DATA_CHECKSUM_TYPE'],
+                        ck['DATA_CHECKSUM'])
+
 def download_rem_product(dl_dir, rel_path, url):
     urls_with_dirs = [(rel_path, url)]
     logger.info("add_product: requesting download for\n"+`url`)
@@ -77,6 +111,11 @@ def download_rem_product(dl_dir, rel_path, url):
     if 0 != dl_errors:
         raise AddProductError("Download via DM failed, dl_errors="+`dl_errors`)
 
+    return split_downloaded(dl_dir)
+
+
+def split_downloaded(dl_dir):
+    # splits the product downloaded into dl_dir into data and metadata
     files = os.listdir(dl_dir)
     len_files = len(files)
     if len_files == 0:
@@ -87,9 +126,11 @@ def download_rem_product(dl_dir, rel_path, url):
 
     f = files[0]
     logger.info("add_product: processing "+`f`)
-    ret_str, metadata, product = split_wcs_raw(dl_dir, f, logger)
+    ret_str, metadata, product = split_wcs_raw(
+        dl_dir, f, logger, IE_CHECKSUM_ALGO)
     if not ret_str:
         raise AddProductError("Failed to split file '"+f+"'.")
+    record_split_checksum(ret_str, product)
 
     return metadata, product
 
@@ -108,29 +149,18 @@ def prepare_local_product(dl_dir, metadata, product, replace=False):
         
     # MP: Allow data as unpacked directories.
     if os.path.isfile(product) or os.path.isdir(product):
-        try:
-            logger.info("moving: %s --> %s"%(product, dl_dir))
-            shutil.move(product, dl_dir)
-        except OSError: #MP: If it cannot be moved try to copy them at least.
-            logger.warning("Failed to move the data to the permanent location!")
-            logger.info("copying: %s --> %s"%(product, dl_dir))
-            if os.path.isdir(product):
-                shutil.copytree(product, dl_dir)
-            else:
-                shutil.copy(product, dl_dir)
+        logger.info("relocating: %s --> %s"%(product, dl_dir))
+        stats = relocate(product, dl_dir, True,
+                         IE_RELOCATE_THREADS, IE_CHECKSUM_ALGO)
+        logger.info("relocated %s: %s" % (product, relocate_summary(stats)))
     else:
         logger.error("Product data Not found: "+product)
         raise AddProductError("Product not found or is not a file.")
 
     # MP: Metadata are required to be a file.
     if (not extra_move) and metadata and os.path.isfile(metadata):
-        try:
-            logger.info("moving: %s --> %s"%(metadata, dl_dir))
-            shutil.move(metadata, dl_dir)
-        except OSError: #MP: If it cannot be moved try to copy them at least.
-            logger.warning("Failed to move the metadata to the permanent location!")
-            logger.info("copying: %s --> %s"%(metadata, dl_dir))
-            shutil.copy(metadata, dl_dir)
+        logger.info("relocating: %s --> %s"%(metadata, dl_dir))
+        relocate(metadata, dl_dir, True)
     else:
         #MP: Be less strict and allow missing metadata.
         logger.warning("Metadata Not found: %s"%metadata)
@@ -140,13 +170,14 @@ def prepare_local_product(dl_dir, metadata, product, replace=False):
     return metadata, product
 
 
-def parse_response_file(db_ref, fname):
+def read_response_file(fname):
     #
     # Expected content of the file:
     #  productId=<eo-id>
     #  url=<product-url>
     # At least one must be present; it is considered an error if neither
     # one is there (empty file or no file).
+    # Returns the content as a dict.
     #
     if not os.path.isfile(fname):
         raise AddProductError("Response file not a file or nonexistent.")
@@ -170,7 +201,10 @@ def parse_response_file(db_ref, fname):
     if not resp or \
             ("productId" not in resp and "url" not in resp):
         raise AddProductError("No data in response file")
+    return resp
 
+def parse_response_file(db_ref, fname):
+    resp = read_response_file(fname)
     if "productId" in resp:
         db_ref.new_product_id = resp["productId"]
     if "url" in resp:
@@ -206,13 +240,18 @@ def add_product_wfunc(parameters):
             id=parameters["addProduct_id"])[0]
         addProduct.info_status = "processing"
 
-        dl_dir, rel_path = create_dl_dir("ap_", ADDPRODUCT_SUBDIR)
         metadata = None
         product = None
-        if 'url' in parameters:
+        if 'dl_dir' in parameters:
+            # downloaded by the DAR of a batch, see add_product_batch_wfunc
+            dl_dir = parameters["dl_dir"]
+            metadata, product = split_downloaded(dl_dir)
+        elif 'url' in parameters:
+            dl_dir, rel_path = create_dl_dir("ap_", ADDPRODUCT_SUBDIR)
             metadata, product = download_rem_product(
                 dl_dir, rel_path, parameters["url"])
         elif 'product' in parameters:
+            dl_dir, rel_path = create_dl_dir("ap_", ADDPRODUCT_SUBDIR)
             replace = True if "covId" in parameters else False
             metadata, product = prepare_local_product(
                 dl_dir,
@@ -261,7 +300,7 @@ def add_product_wfunc(parameters):
             command.append("-meta="+get_base_fname(metadata))
         command.append("-data="+get_base_fname(product))
 
-        process_status = subprocess.call(command)
+        process_status = spawn_service.call(command)
 
         if 0 != process_status:
             error_str ='AddProduct script returned status:'+`process_status`
@@ -290,6 +329,202 @@ def add_product_wfunc(parameters):
 
     finally:
             addProduct.save()
+            notify_callback(parameters, addProduct)
+
+def product_status(pi):
+    # the status of an addProduct operation, as returned by getStatus
+    resp = {'status' : pi.info_status}
+    if pi.info_error:
+        resp["errorString"] = pi.info_error
+    if pi.new_product_id:
+        resp["productId"] = pi.new_product_id
+    if pi.product_url:
+        resp["url"] = pi.product_url
+    return resp
+
+def notify_callback(parameters, pi):
+    # POSTs the final status to the callback url of the request, if any
+    if not parameters.get("callback"):
+        return
+    payload = product_status(pi)
+    payload["opId"] = pi.id
+    CallbackDispatcher.Instance().post(parameters["callback"], payload)
+
+def set_failed(parameters, error_str):
+    pi = models.ProductInfo.objects.get(id=parameters["addProduct_id"])
+    pi.info_status = "failed"
+    pi.info_error  = error_str
+    pi.save()
+    notify_callback(parameters, pi)
+
+def add_product_batch_wfunc(parameters):
+    #
+    # Executed by a worker thread from the the work_flow_manager.
+    # Downloads the products of several addProduct requests with one
+    # DAR.  Parameters:
+    #       "task_type"  - ADD_PRODUCT_BATCH
+    #       "products"   - list of the ADD_PRODUCT parameters, with url
+    #
+    # Each product that the DM reports as completed is queued as an
+    # ADD_PRODUCT task with its dl_dir, so it is split and registered
+    # (and its ProductInfo updated) while the others are still being
+    # downloaded.
+    #
+    pending = {}     # key is the leaf name of the product's dl_dir
+    try:
+        urls_with_dirs = []
+        for p in parameters["products"]:
+            dl_dir, rel_path = create_dl_dir("ap_", ADDPRODUCT_SUBDIR)
+            p["dl_dir"] = dl_dir
+            pending[os.path.basename(dl_dir)] = p
+            urls_with_dirs.append( (rel_path, p["url"]) )
+        logger.info("add_product: requesting download of " +
+                    `len(urls_with_dirs)` + " products in one DAR")
+        dar_url, dar_id = download_urls(urls_with_dirs)
+        if None == dar_id:
+            raise AddProductError("No DAR generated")
+
+        wfm = work_flow_manager.WorkFlowManager.Instance()
+        n_missing = 0
+        n_final = 0
+        t_end = time.time() + IE_ADDPROD_BATCH_MAX_WAIT
+        while pending:
+            if time.time() > t_end:
+                raise AddProductError("Time-out waiting for the download")
+            time.sleep(DAR_STATUS_INTERVAL)
+            request = get_dar_status(dar_url)
+            if None == request:
+                n_missing += 1
+                if n_missing > 3:
+                    raise AddProductError(
+                        "Bad DAR status from DM; no 'dataAccessRequests' found.")
+                continue
+            n_missing = 0
+            all_final = len(request["productList"]) > 0
+            for product in request["productList"]:
+                if "productProgress" not in product:
+                    all_final = False
+                    continue
+                progress = product["productProgress"]
+                if progress["status"] not in ("COMPLETED", "IN_ERROR"):
+                    all_final = False
+                    continue
+                if "downloadDirectory" not in product:
+                    continue
+                leaf = os.path.basename(
+                    product["downloadDirectory"].rstrip("/"))
+                p = pending.pop(leaf, None)
+                if None == p:
+                    continue
+                if progress["status"] == "COMPLETED":
+                    wfm.put_task_to_queue(work_flow_manager.WorkerTask(p))
+                else:
+                    msg = progress.get("message", "(none)")
+                    logger.warning("add_product: download of " + p["url"] +
+                                   " failed: " + msg)
+                    set_failed(p, "Download via DM failed: " + msg)
+            # products the DM does not report once the DAR is finished
+            # will not be downloaded any more
+            if all_final: n_final += 1
+            else:         n_final = 0
+            if pending and (n_final > 1 or
+                            request.get("status") in DAR_FINAL_STATES):
+                raise AddProductError("Product not downloaded by the DM")
+
+    except AddProductError as ap_err:
+        logger.error("AddProductError in add_product_batch_wfunc: " +
+                     ap_err.msg)
+        for p in pending.values():
+            set_failed(p, ap_err.msg)
+
+    except Exception as e:
+        logger.error("add_product_batch_wfunc: Exception: " + `e`)
+        for p in pending.values():
+            set_failed(p, "Error %s" % `e`)
+        from settings import IE_DEBUG
+        if IE_DEBUG>0:
+            logger.debug(traceback.format_exc(4))
+
+class RequestBatcher:
+    """ Collects items added within window seconds of the first one,
+        and passes them as one list to submit(items); a list is passed
+        at once when it has max_items.
+    """
+    def __init__(self, window, max_items, submit):
+        self._window    = window
+        self._max_items = max_items
+        self._submit    = submit
+        self._lock      = threading.Lock()
+        self._items     = []
+        self._timer     = None
+
+    def add(self, item):
+        items = None
+        self._lock.acquire()
+        try:
+            self._items.append(item)
+            if len(self._items) >= self._max_items:
+                items = self._take()
+            elif None == self._timer:
+                self._timer = threading.Timer(self._window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        finally:
+            self._lock.release()
+        if items:
+            self._submit(items)
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            items = self._take()
+        finally:
+            self._lock.release()
+        if items:
+            self._submit(items)
+
+    def discard(self):
+        """ Returns the items not submitted yet, which are dropped. """
+        self._lock.acquire()
+        try:
+            return self._take()
+        finally:
+            self._lock.release()
+
+    def _take(self):
+        if None != self._timer:
+            self._timer.cancel()
+            self._timer = None
+        items = self._items
+        self._items = []
+        return items
+
+def submit_url_batch(products):
+    wfm = work_flow_manager.WorkFlowManager.Instance()
+    if len(products) == 1:
+        wfm.put_task_to_queue(work_flow_manager.WorkerTask(products[0]))
+    else:
+        wfm.put_task_to_queue(work_flow_manager.WorkerTask(
+                {"task_type" : "ADD_PRODUCT_BATCH",
+                 "products"  : products}))
+
+# addProduct requests with a url, see IE_ADDPROD_BATCH_WINDOW
+url_batcher = RequestBatcher(
+    IE_ADDPROD_BATCH_WINDOW, IE_ADDPROD_BATCH_MAX, submit_url_batch)
+
+def _discard_batched():
+    # at shutdown: the requests still waiting for their batch are lost
+    for p in url_batcher.discard():
+        logger.warning("add_product: shutting down, request " +
+                       `p["addProduct_id"]` + " (" + p["url"] +
+                       ") was not submitted")
+        try:
+            set_failed(p, "Ingestion Engine shut down")
+        except Exception as e:
+            logger.warning("Cannot set the status of request " +
+                           `p["addProduct_id"]` + ": " + `e`)
+
+atexit.register(_discard_batched)
 
 def add_product_submit(postData, request_meta):
     logger.info("processing addProduct request")
@@ -350,6 +585,13 @@ def add_product_submit(postData, request_meta):
         if "metadata" in args:
             params["metadata"] = args["metadata"].encode('ascii','ignore')
 
+        # url to POST the final status to, instead of polling getStatus
+        if "callback" in args:
+            callback = args["callback"].encode('ascii','ignore')
+            if not is_callback_url(callback):
+                raise AddProductError("Bad callback url: " + callback)
+            params["callback"] = callback
+
         # The coverage ID of an existing product, to be replaced
         if "productID" in args:
             productID = args["productID"]
@@ -363,9 +605,13 @@ def add_product_submit(postData, request_meta):
         #   ap.info_date = datetime.datetime.utcnow().replace(tzinfo=utc)
 
         # process addProduct request by work_flow_manager
-        wfm = work_flow_manager.WorkFlowManager.Instance()
-        current_task = work_flow_manager.WorkerTask(params)
-        wfm.put_task_to_queue(current_task)  # exectues add_product_wfunc
+        if "url" in params and IE_ADDPROD_BATCH_WINDOW > 0:
+            # downloaded together with other requests, in one DAR
+            url_batcher.add(params)
+        else:
+            wfm = work_flow_manager.WorkFlowManager.Instance()
+            current_task = work_flow_manager.WorkerTask(params)
+            wfm.put_task_to_queue(current_task)  # exectues add_product_wfunc
 
         resp['opId'] = ap.id
         resp['status'] = 0
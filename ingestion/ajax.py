@@ -26,6 +26,8 @@ import os
 
 from utils import build_aoi_toi
 
+from log_reader import read_log, LogFilter, is_record_start
+
 from ingestion_logic import get_dssids_from_pf
 
 from settings import \
@@ -45,10 +47,10 @@ def delete_scenario_wfm(request, ncn_id):
 @dajaxice_register(method='GET')
 def test1(request):
     user = request.user
-    scenarios = user.scenario_set.all()
+    scenarios = user.scenario_set.select_related('scenariostatus')
     results = []
     for scenario in scenarios:
-        ss = scenario.scenariostatus
+        ss = views.get_or_create_scenario_status(scenario)
         result = [scenario.id,
                   scenario.ncn_id,
                   scenario.repeat_interval,
@@ -63,10 +65,11 @@ def test1(request):
 def synchronize_scenarios(request, scenario_id=None):
     logger = logging.getLogger('dream.file_logger')
     user = request.user
-    scenarios = user.scenario_set.all()
+    # one query for all the scenarios and their status
+    scenarios = user.scenario_set.select_related('scenariostatus')
     results = []
     for scenario in scenarios:
-        ss = scenario.scenariostatus
+        ss = views.get_or_create_scenario_status(scenario)
         result = [scenario.id,
                   scenario.ncn_id,
                   scenario.repeat_interval,
@@ -81,26 +84,31 @@ def synchronize_scenarios(request, scenario_id=None):
 
 
 @dajaxice_register(method='POST')
-def read_logging(request, message_type, max_log_lines):
+def read_logging(request, message_type, max_log_lines, cursor='', ncn_id=''):
+    # message_type is the lowest level shown, e.g. 'INFO', '' for all.
+    # cursor is from the previous response; if reset is false in the
+    # response, the messages are only those appended since then.
     messages = []
     if max_log_lines == '':
         maxll = BROWSER_N_LOGLINES
     else:
         maxll = int(max_log_lines)
-    mtype = message_type.encode('ascii','ignore')
-    f = None
+    flt = LogFilter(message_type.encode('ascii','ignore'),
+                    ncn_id.encode('ascii','ignore'))
     try:
-        f = open(LOGGING_FILE,'r')
-        for line in f:
+        lines, cursor, reset = read_log(LOGGING_FILE, maxll,
+                                        cursor.encode('ascii','ignore'), flt)
+        for line in lines:
             lstr = line.strip()
-            parts = lstr.split(' ',3)
-            messages.append(parts)
-        f.close()
-        if len(messages) > maxll:
-            messages = messages[-maxll:]
-        return simplejson.dumps({'message':messages})
+            if is_record_start(lstr):
+                messages.append(lstr.split(' ',3))
+            else:
+                messages.append([lstr])
+        return simplejson.dumps({'message'   : messages,
+                                 'cursor'    : cursor,
+                                 'reset'     : reset,
+                                 'max_lines' : maxll})
     except Exception as e:
-        if f: f.close()
         try:
             logger = logging.getLogger('dream.file_logger')
             logger.error("read_logging error: " + `e`)
@@ -0,0 +1,139 @@
+############################################################
+#  Project: DREAM
+#
+#  Module:  Task 5 ODA Ingestion Engine
+#
+#    (c) 2014 Siemens Convergence Creators s.r.o., Prague
+#    Licensed under the 'DREAM ODA Ingestion Engine Open License'
+#     (see the file 'LICENSE' in the top-level directory)
+#
+#  Ingestion Engine: completion callbacks.
+#   The final status of an operation is POSTed as json to the callback
+#   url given by the client, by one background thread, so the client
+#   does not need to poll for it.  A callback that fails is tried again
+#   after IE_CALLBACK_RETRY_DELAY seconds, doubled at each attempt, up
+#   to IE_CALLBACK_RETRIES attempts.  At most IE_CALLBACK_QUEUE_SIZE
+#   callbacks wait to be sent; further ones are dropped (the client can
+#   still poll for the status).
+#
+#  used by add_product
+#
+############################################################
+
+import time
+import json
+import heapq
+import socket
+import urllib2
+import logging
+import threading
+
+from settings import \
+    IE_CALLBACK_QUEUE_SIZE, \
+    IE_CALLBACK_RETRIES, \
+    IE_CALLBACK_RETRY_DELAY
+
+from singleton_pattern import Singleton
+
+logger = logging.getLogger('dream.file_logger')
+
+# seconds to wait for the client's response
+CALLBACK_TIMEOUT = 10
+
+def is_callback_url(url):
+    return url.startswith("http://") or url.startswith("https://")
+
+@Singleton
+class CallbackDispatcher:
+    def __init__(self):
+        self._cond        = threading.Condition()
+        # heap of (time to send, seq, url, payload, attempt)
+        self._waiting     = []
+        self._seq         = 0
+        self._thread      = None
+        self._max_waiting = IE_CALLBACK_QUEUE_SIZE
+        self._retries     = IE_CALLBACK_RETRIES
+        self._retry_delay = IE_CALLBACK_RETRY_DELAY
+
+    def _push(self, t, url, payload, attempt):
+        self._seq += 1
+        heapq.heappush(self._waiting, (t, self._seq, url, payload, attempt))
+        self._cond.notify()
+
+    def post(self, url, payload):
+        """ Queues payload (a dict) to be POSTed to url.
+            Returns False if the queue is full and it was dropped.
+        """
+        self._cond.acquire()
+        try:
+            if len(self._waiting) >= self._max_waiting:
+                logger.warning("Callback queue is full, dropping callback to "
+                               + url)
+                return False
+            self._push(time.time(), url, payload, 0)
+            if None == self._thread:
+                self._thread = threading.Thread(target=self._run,
+                                                name="CallbackDispatcher")
+                self._thread.daemon = True
+                self._thread.start()
+            return True
+        finally:
+            self._cond.release()
+
+    def n_waiting(self):
+        self._cond.acquire()
+        try:
+            return len(self._waiting)
+        finally:
+            self._cond.release()
+
+    def _next(self):
+        # waits for the next callback that is due
+        self._cond.acquire()
+        try:
+            while True:
+                if self._waiting:
+                    remaining = self._waiting[0][0] - time.time()
+                    if remaining <= 0:
+                        return heapq.heappop(self._waiting)
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        while True:
+            t, seq, url, payload, attempt = self._next()
+            try:
+                ok, retry = self._send(url, payload)
+            except Exception as e:
+                logger.error("Callback to " + url + ": unexpected " + `e`)
+                ok, retry = False, False
+            if ok:
+                continue
+            if retry and attempt + 1 < self._retries:
+                self._cond.acquire()
+                try:
+                    self._push(time.time() + self._retry_delay * 2**attempt,
+                               url, payload, attempt + 1)
+                finally:
+                    self._cond.release()
+            else:
+                logger.warning("Giving up callback to " + url +
+                               " after " + `attempt + 1` + " attempts")
+
+    def _send(self, url, payload):
+        # returns (success, worth retrying)
+        req = urllib2.Request(url, json.dumps(payload),
+                              {"Content-Type": "application/json"})
+        try:
+            urllib2.urlopen(req, timeout=CALLBACK_TIMEOUT).close()
+            return True, False
+        except urllib2.HTTPError as e:
+            logger.warning("Callback to " + url + " returned " + `e.code`)
+            # the client refuses it, sending it again will not help
+            return False, e.code >= 500
+        except (urllib2.URLError, socket.error, IOError) as e:
+            logger.warning("Callback to " + url + " failed: " + `e`)
+            return False, True
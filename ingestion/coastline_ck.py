@@ -165,7 +165,7 @@ from utils import \
     IngestionError, \
     Bbox
 
-from ie_xml_parser import extract_footprintpolys
+from ie_xml_parser import extract_footprintpolys, CoverageRecord
 
 
 is_ie_c_check = False
@@ -187,10 +187,15 @@ except Exception as e:
 # Create an ogr polygon from the data in the Coverage Desr.
 # In the cov. descr, the order of coordinate points is N, E
 # The returned OGR geometry points have the order x,y (E,N).
+# coverageDescription may also be a CoverageRecord already
+# extracted by ie_xml_parser.extract_cd_record().
 #
 def extract_geom(coverageDescription, cid, wcs_type):
    
-    coords = extract_footprintpolys(coverageDescription, wcs_type)
+    if isinstance(coverageDescription, CoverageRecord):
+        coords = coverageDescription.footprint
+    else:
+        coords = extract_footprintpolys(coverageDescription, wcs_type)
     if not coords or len(coords) == 0:
         logger.warning("No polygon in coverageDescription for "+`cid`+
                        ' - not checking coastline.')
@@ -13,6 +13,8 @@
 ############################################################
 
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from cStringIO import StringIO
 import sys
 
 LOCAL_DEBUG = 0
@@ -42,6 +44,47 @@ vers = sys.version_info
 if vers[0] > 2: use_register = True
 if vers[1] > 6 and vers[0] == 2: use_register = True
 
+DAR_OPEN = \
+    '<ngeo:' + DA_RESP + \
+    ' xmlns:ngeo="' + NGEO_URI + '"' + \
+    ' xmlns:xsi="' + XSI_URI + '"' + \
+    ' xsi:schemaLocation="' + SCHEMA_LOCATION + '">' + \
+    '<ngeo:' + MONITORINGSTATUS + '>IN_PROGRESS</ngeo:' + MONITORINGSTATUS + '>' + \
+    '<ngeo:' + PRODACCESSLIST + '>'
+
+DAR_CLOSE = '</ngeo:' + PRODACCESSLIST + '></ngeo:' + DA_RESP + '>'
+
+PA_TEMPLATE = \
+    '<ngeo:' + PRODACCESS + '>' + \
+    '<ngeo:' + PRODACCESSURL + '>%s</ngeo:' + PRODACCESSURL + '>' + \
+    '<ngeo:' + PRODACCESSSTATUS + '>READY</ngeo:' + PRODACCESSSTATUS + '>' + \
+    '<ngeo:' + PRODDOWNLOADDIRECTORY + '>%s</ngeo:' + PRODDOWNLOADDIRECTORY + '>' + \
+    '</ngeo:' + PRODACCESS + '>'
+
+def _xml_text(s):
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return escape(s)
+
+def write_DAR(fp, urls):
+    """ Writes the DAR to the file object fp without building it in
+    memory. urls is a list or iterator of tuples (dl_dir, url), as for
+    build_DAR.  Returns the number of urls written."""
+    fp.write(DAR_PREAMBLE)
+    fp.write(DAR_OPEN)
+    n = 0
+    for url in urls:
+        fp.write(PA_TEMPLATE % (_xml_text(url[1]), _xml_text(url[0])))
+        n += 1
+    fp.write(DAR_CLOSE)
+    return n
+
+def build_DAR_string(urls):
+    # the same as build_DAR, but using write_DAR
+    fp = StringIO()
+    write_DAR(fp, urls)
+    return fp.getvalue()
+
 def build_DAR(urls):
     """ urls consist of a list of tuples (dl_dir, url),
     where dl_dir is the download directory for each url"""
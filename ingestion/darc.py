@@ -16,47 +16,149 @@
 #    of downloaded products to be able to check later whether that
 #    data has aleady been downloaded, to avoid downloading it again.
 #
-#  Proceeds by reading in the metada xml from the file on disc,
-#  then adds a record in the database Archive table.
+#  Proceeds by reading the EO identifier from the metada xml file on
+#  disc, then adds a record in the database Archive table.
+#  The records may be collected in an ArchiveBatch and inserted
+#  together in one transaction.
+#  Lookups use the index on (scenario_id, eoid_hash), see is_archived.
 #
 ############################################################
 
 import logging
 
-from settings import IE_DEBUG
+from django.db import transaction, connection
+
+from settings import IE_DEBUG, IE_ARCHIVE_BATCH
 
 from models import \
     Scenario, \
-    Archive
+    Archive, \
+    eoid_hash
+
+ARCHIVE_INDEX = "ingestion_archive_sc_hash"
+
+# rows updated per transaction when filling in missing eoid hashes
+BACKFILL_BATCH = 5000
 
-from ie_xml_parser import \
-    base_xml_parse, \
-    extract_eoid, \
-    determine_wcseo_type
+from ie_xml_parser import stream_extract_eoid
 
 logger = logging.getLogger('dream.file_logger')
 
-def archive_metadata(sc_id, metafile):
-    # cd_tree: coverage description tree extracted from the
-    #          metadata XML file
-    cd_tree = base_xml_parse(metafile, True)
-    wcseo_type = determine_wcseo_type(cd_tree)
+class ArchiveBatch:
+    # Collects the Archive records of one scenario, the records are
+    # written by flush(), which is also called automatically when
+    # IE_ARCHIVE_BATCH records have been collected.
+    # The caller must call flush() when done, e.g. in a 'finally'.
+    def __init__(self, sc_id):
+        self._sc_id    = sc_id
+        self._scenario = None
+        self._records  = []
+
+    def add(self, metafile):
+        coverage_id = stream_extract_eoid(metafile)
+        if None == coverage_id:
+            logger.error("Sc_id " + `self._sc_id` +
+                         ": no EO identifier found in " + `metafile` +
+                         ", not archived.")
+            return False
+
+        if IE_DEBUG > 1:
+            logger.info("Sc_id " + `self._sc_id` + ": Archiving meta for "+
+                        `metafile` + ", cid='"+coverage_id+"'.")
 
-    coverage_id = extract_eoid(cd_tree, wcseo_type)
+        if None == self._scenario:
+            self._scenario = Scenario.objects.get(id=int(self._sc_id))
 
-    if IE_DEBUG > 1:
-        logger.info("Sc_id " + `sc_id` + ": Archiving meta for " + `cd_tree.tag`+
-                    ", cid='"+coverage_id+"'.")
+        self._records.append(
+            Archive(scenario  = self._scenario,
+                    eoid      = coverage_id,
+                    eoid_hash = eoid_hash(coverage_id)))
 
-    cd_tree = None
+        if len(self._records) >= IE_ARCHIVE_BATCH:
+            self.flush()
+        return True
 
-    scenario = Scenario.objects.get(id=int(sc_id))
+    def flush(self):
+        if not self._records:
+            return 0
+        records = self._records
+        self._records = []
+        with transaction.commit_on_success():
+            Archive.objects.bulk_create(records)
+        if IE_DEBUG > 1:
+            logger.info("Sc_id " + `self._sc_id` + ": archived " +
+                        `len(records)` + " products.")
+        return len(records)
 
-    archive_record = Archive(
-        scenario = scenario,
-        eoid     = coverage_id)
 
-    archive_record.save()
+def is_archived(sc_id, coverage_id):
+    # uses the index; the eoid itself is compared only for the rows
+    # with a matching hash
+    eoids = Archive.objects.filter(
+        scenario  = int(sc_id),
+        eoid_hash = eoid_hash(coverage_id)).values_list('eoid', flat=True)
+    return coverage_id in eoids
 
-    return True
+def delete_archive(sc_id):
+    # deletes the scenario's records with one statement, rather than
+    # loading them all as QuerySet.delete() does
+    cursor = connection.cursor()
+    with transaction.commit_on_success():
+        cursor.execute("DELETE FROM " + Archive._meta.db_table +
+                       " WHERE scenario_id = %s", [int(sc_id)])
 
+def archive_index_exists(cursor):
+    cursor.execute("SELECT name FROM sqlite_master" +
+                   " WHERE type = 'index' AND name = %s", [ARCHIVE_INDEX])
+    return None != cursor.fetchone()
+
+def upgrade_archive_table():
+    """ Adds the eoid_hash column and its index to an Archive table
+        created by an older version, and fills in the hashes of the
+        existing records.  Called at start-up.
+        The index is created after the hashes are filled in, so an
+        existing index means there is nothing to do (a table created by
+        syncdb gets it from sql/archive.sql); an upgrade that was
+        interrupted is completed at the next start-up.
+    """
+    table  = Archive._meta.db_table
+    cursor = connection.cursor()
+    if archive_index_exists(cursor):
+        return 0
+    columns = [ c[0] for c in
+                connection.introspection.get_table_description(cursor, table) ]
+    if 'eoid_hash' not in columns:
+        logger.info("Adding column eoid_hash to " + table)
+        with transaction.commit_on_success():
+            cursor.execute("ALTER TABLE " + table +
+                           " ADD COLUMN eoid_hash bigint NOT NULL DEFAULT 0")
+
+    # 0 is the default of the new column
+    n = 0
+    last_id = 0
+    while True:
+        cursor.execute("SELECT id, eoid FROM " + table +
+                       " WHERE eoid_hash = 0 AND id > %s ORDER BY id LIMIT %s",
+                       [last_id, BACKFILL_BATCH])
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        with transaction.commit_on_success():
+            cursor.executemany(
+                "UPDATE " + table + " SET eoid_hash = %s WHERE id = %s",
+                [ (eoid_hash(r[1]), r[0]) for r in rows ])
+        n += len(rows)
+        last_id = rows[-1][0]
+    if n > 0:
+        logger.info("Archive: computed eoid_hash for " + `n` + " records.")
+
+    with transaction.commit_on_success():
+        cursor.execute("CREATE INDEX IF NOT EXISTS " + ARCHIVE_INDEX +
+                       " ON " + table + " (scenario_id, eoid_hash)")
+    return n
+
+def archive_metadata(sc_id, metafile):
+    batch = ArchiveBatch(sc_id)
+    ret = batch.add(metafile)
+    batch.flush()
+    return ret
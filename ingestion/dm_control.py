@@ -18,17 +18,17 @@ import json
 import os, os.path
 import time
 import sys
-import traceback
 import threading
-from collections import deque
 
 from urllib2 import HTTPError, URLError
 
+import dar_builder
+
 from utils import \
     find_process_ids, \
     pid_is_valid, \
     get_dm_config, \
-    read_from_url, \
+    fetch_json, \
     mkIdBase, \
     check_or_make_dir, \
     DMError, \
@@ -39,7 +39,10 @@ from settings import \
     MAX_PORT_WAIT_SECS, \
     IE_SERVER_PORT, \
     IE_DEBUG, \
-    DM_DAM_RESP_URL
+    DM_DAM_RESP_URL, \
+    IE_DM_RESPONSE_MAX_SIZE, \
+    IE_DAR_STORE_DIR, \
+    IE_DAR_STORE_MAX_AGE
 
 # The %s will be replaced by the port where DM is listening
 DM_URL_TEMPLATE = "http://127.0.0.1:%s/download-manager/"
@@ -58,6 +61,121 @@ PROC_STATUS_INDEX      = 3
 PROC_ADDRESS_INDEX     = 1
 
 
+DAR_SUFFIX     = ".xml"
+DAR_TMP_SUFFIX = ".tmp"
+
+class DarStore:
+    """ DARs waiting to be retrieved by the DM, one file per DAR named
+        after its sequence id.  A DAR is removed once the DM reports it
+        in its status.  The files survive a restart of the Ingestion
+        Engine; files older than max_age days which have not been
+        retrieved are removed.
+    """
+    def __init__(self, store_dir, max_age, logger):
+        self._dir     = store_dir
+        self._max_age = max_age * 24 * 3600
+        self._logger  = logger
+        self._lock    = threading.Lock()
+        self._index   = {}   # seq_id -> path
+        self._fetched = set()  # seq_ids retrieved by the DM
+        self._loaded  = False
+
+    def _load(self):
+        # called with the lock held
+        if self._loaded: return
+        check_or_make_dir(self._dir, self._logger)
+        for f in os.listdir(self._dir):
+            path = os.path.join(self._dir, f)
+            if f.endswith(DAR_TMP_SUFFIX):
+                os.unlink(path)
+            elif f.endswith(DAR_SUFFIX):
+                self._index[f[:-len(DAR_SUFFIX)]] = path
+        self._loaded = True
+        if IE_DEBUG > 0 and self._index:
+            self._logger.debug("DAR store: %d DARs found in %s" %
+                               (len(self._index), self._dir))
+
+    def _purge(self):
+        # called with the lock held
+        too_old = time.time() - self._max_age
+        for seq_id, path in self._index.items():
+            if seq_id in self._fetched:
+                continue
+            try:
+                if os.stat(path).st_mtime < too_old:
+                    os.unlink(path)
+                    del self._index[seq_id]
+            except OSError:
+                del self._index[seq_id]
+
+    def add(self, seq_id, dar):
+        """ dar is the DAR as a string, or a list/iterator of
+            (dl_dir, url) from which it is written by write_DAR.
+        """
+        self._lock.acquire()
+        try:
+            self._load()
+            self._purge()
+        finally:
+            self._lock.release()
+
+        path = os.path.join(self._dir, seq_id + DAR_SUFFIX)
+        tmp_path = path + DAR_TMP_SUFFIX
+        fp = open(tmp_path, "wb")
+        try:
+            if isinstance(dar, basestring):
+                fp.write(dar)
+            else:
+                n = dar_builder.write_DAR(fp, dar)
+                if IE_DEBUG > 1:
+                    self._logger.debug("DAR " + seq_id + ": " + `n` + " urls")
+        except:
+            fp.close()
+            os.unlink(tmp_path)
+            raise
+        fp.close()
+        os.rename(tmp_path, path)
+
+        self._lock.acquire()
+        try:
+            self._index[seq_id] = path
+        finally:
+            self._lock.release()
+
+    def open(self, seq_id):
+        """ Returns the open DAR file, or None. """
+        self._lock.acquire()
+        try:
+            self._load()
+            path = self._index.get(seq_id)
+            if None != path:
+                self._fetched.add(seq_id)
+        finally:
+            self._lock.release()
+        if None == path:
+            return None
+        try:
+            return open(path, "rb")
+        except IOError as e:
+            self._logger.error("Cannot open DAR " + `seq_id` + ": " + `e`)
+            return None
+
+    def remove(self, seq_id):
+        """ Removes the DAR, returns False if it was not in the store. """
+        self._lock.acquire()
+        try:
+            path = self._index.pop(seq_id, None)
+            self._fetched.discard(seq_id)
+        finally:
+            self._lock.release()
+        if None == path:
+            return False
+        try:
+            os.unlink(path)
+        except OSError as e:
+            self._logger.warning("Cannot remove DAR " + `seq_id` + ": " + `e`)
+        return True
+
 @Singleton
 class DownloadManagerController:
     def __init__(self):
@@ -67,7 +185,8 @@ class DownloadManagerController:
         self._ie_port = IE_SERVER_PORT  # string, ingestion engine port
         self._download_dir = None
         self._dar_resp_url = None
-        self._dar_queue = deque()
+        self._dar_store = DarStore(
+            IE_DAR_STORE_DIR, IE_DAR_STORE_MAX_AGE, self._logger)
         self._lock_queue = threading.Lock()
         self._seq_id  = 0
         self.is_dm_listening = False
@@ -161,6 +280,7 @@ class DownloadManagerController:
         return self._seq_id
 
     def submit_dar(self, dar):
+        # dar: the DAR as a string, or a list/iterator of (dl_dir, url)
         if None == self._dm_port:
             raise ConfigError("No port for DM")
         if None == self._ie_port:
@@ -168,17 +288,14 @@ class DownloadManagerController:
         if None == self._dar_resp_url:
             self._dar_resp_url = IE_DAR_RESP_URL_TEMPLATE % self._ie_port
 
-        # lock the queue since access is potentially from the
+        # lock since access is potentially from the
         # work_flow_manager worker threads
         self._lock_queue.acquire()
         try:
             dar_seq_id = mkIdBase()+`self._get_next_seq_id()`
-            dar_q_item = (dar_seq_id, dar)
-            self._dar_queue.append(dar_q_item)
-        except Exception as e:
-            raise
         finally:
             self._lock_queue.release()
+        self._dar_store.add(dar_seq_id, dar)
 
         dm_dl_url = os.path.join(self._dm_url, DM_DOWNDLOAD_COMMAND)
         dar_url = self._dar_resp_url+"/"+dar_seq_id
@@ -186,7 +303,8 @@ class DownloadManagerController:
         self._logger.info("Submitting request to DM to retieve DAR:\n" \
                            + post_data)
         try:
-            dm_resp = json.loads(read_from_url(dm_dl_url, post_data))
+            dm_resp = fetch_json(
+                dm_dl_url, post_data, max_size=IE_DM_RESPONSE_MAX_SIZE)
             self._logger.debug("dm_response: " + `dm_resp`)
         except HTTPError as e:
             self._logger.error("Download Manager Error: "+`e.code`+' '+`e`)
@@ -217,32 +335,18 @@ class DownloadManagerController:
         
         return ("OK", dar_url, dm_dar_id)
 
-    def get_next_dar(self, dar_seq_id):
-        #todo: should lock the queue!
-        if len(self._dar_queue) == 0:
-            return None
-        else:
-            if self._dar_queue[0][0] == dar_seq_id:
-                dar = self._dar_queue.popleft()[1]
-            else:
-                self._logger.warning("Out-of-sequence dar access, dar_seq_id: " + \
-                                         `dar_seq_id`)
-                dar = self.find_dar(dar_seq_id)
-                if not dar:
-                    self._logger.warning("DAR '"+`dar_seq_id`+"' not found")
-            return dar
-    
-    def find_dar(self, dar_seq_id):
-        try:
-            for d in self._dar_queue:
-                if d[0] == dar_seq_id:
-                    return d[1]
-        except Exception as e:
-            self._logger.error("find_dar: exception: " + `e`)
-            if IE_DEBUG > 0:
-                traceback.print_exc(12,sys.stdout)
-            return None
-        return None
+    def get_dar_file(self, dar_seq_id):
+        # returns the DAR as an open file, or None
+        dar_fp = self._dar_store.open(dar_seq_id)
+        if None == dar_fp:
+            self._logger.warning("DAR '"+`dar_seq_id`+"' not found")
+        return dar_fp
+
+    def dar_accepted(self, dar_url):
+        # the DM has the DAR, it is not retrieved again
+        seq_id = dar_url.rsplit("/", 1)[-1]
+        if self._dar_store.remove(seq_id) and IE_DEBUG > 1:
+            self._logger.debug("DAR " + seq_id + " accepted by the DM")
 
     def set_ie_port(self, port):
         # If behind a proxy/httpd apache server, then use the
@@ -16,14 +16,22 @@ import logging
 import xml.etree.ElementTree as ET
 import xml.parsers.expat
 
+# lxml is optional, see set_backend()
+have_lxml = False
+try:
+    import lxml.etree as LET
+    have_lxml = True
+except ImportError:
+    LET = None
 
 from utils import DummyLogger
 
 if __name__ == '__main__':
     IE_DEBUG=2
+    IE_XML_BACKEND='etree'
     logger = DummyLogger()
 else:
-    from settings import IE_DEBUG
+    from settings import IE_DEBUG, IE_XML_BACKEND
     logger = logging.getLogger('dream.file_logger')
 
 from utils import \
@@ -203,6 +211,94 @@ EO_POLYPOSLIST_XPATH = \
     GML_NS + "posList/"
     
 
+# ------------ parser backend --------------------------
+#  Two backends are supported: the standard xml.etree.ElementTree
+#  ('etree') and lxml ('lxml').  Both produce elements with the same
+#  interface (tag, attrib, text, find, findall, iteration over the
+#  children), the differences are hidden by the functions below.
+
+BACKEND_ETREE = 'etree'
+BACKEND_LXML  = 'lxml'
+
+xml_backend = BACKEND_ETREE
+
+# exceptions raised by the parser on malformed xml, whichever backend
+# is in use, so that a copy imported by another module stays valid
+XML_PARSE_ERRORS = (xml.parsers.expat.ExpatError, ET.ParseError)
+if have_lxml:
+    XML_PARSE_ERRORS += (LET.XMLSyntaxError,)
+
+# lxml: compiled xpaths, key is the ElementPath string
+_compiled_xpaths = {}
+_ns_xpath = None
+
+def set_backend(name):
+    """ Selects the xml parser backend, name is one of 'auto',
+        'lxml' or 'etree'. Returns the name of the backend in use.
+    """
+    global xml_backend, _ns_xpath
+    if name == 'auto':
+        name = BACKEND_LXML if have_lxml else BACKEND_ETREE
+    if name == BACKEND_LXML and not have_lxml:
+        logger.warning("XML backend 'lxml' requested but lxml is not "+
+                       "installed, using 'etree'.")
+        name = BACKEND_ETREE
+    if name not in (BACKEND_LXML, BACKEND_ETREE):
+        logger.error("Unknown XML backend "+`name`+", using 'etree'.")
+        name = BACKEND_ETREE
+
+    xml_backend = name
+    if name == BACKEND_LXML:
+        _ns_xpath = LET.XPath('//namespace::*')
+    return xml_backend
+
+def xml_fromstring(text):
+    if xml_backend == BACKEND_LXML:
+        return LET.fromstring(text)
+    return ET.fromstring(text)
+
+def xml_tostring(elem):
+    if xml_backend == BACKEND_LXML:
+        return LET.tostring(elem)
+    return ET.tostring(elem)
+
+def xml_find(elem, path):
+    # path is relative to elem, in ElementPath syntax
+    if xml_backend == BACKEND_LXML:
+        try:
+            xp = _compiled_xpaths[path]
+        except KeyError:
+            # a trailing '/' selects the children in ElementPath
+            if path.endswith('/'):
+                xp = LET.ETXPath("./" + path + "*")
+            else:
+                xp = LET.ETXPath("./" + path)
+            _compiled_xpaths[path] = xp
+        found = xp(elem)
+        if found:
+            return found[0]
+        return None
+    return elem.find("./"+path)
+
+def get_ns_map(root):
+    """ Returns a dictionary prefix:uri of the namespaces declared in
+        the document, if it was parsed with save_ns, None otherwise.
+        The default namespace has the prefix ''.
+    """
+    if hasattr(root, 'ns_map'):
+        return root.ns_map
+    if xml_backend == BACKEND_LXML and LET.iselement(root):
+        ns_map = {}
+        for prefix, uri in _ns_xpath(root):
+            if prefix == 'xml': continue
+            if None == prefix: prefix = ''
+            ns_map[prefix] = uri
+        return ns_map
+    return None
+
+set_backend(IE_XML_BACKEND)
+
+
 # ------------ xpath functions --------------------------
 
 def xpaths_eo_earthobservation(wcs_type):
@@ -283,7 +379,7 @@ def xpaths_cloudcover(wcs_type):
 def multifind(cd, paths):
     found = None
     for p in paths:
-        found = cd.find("./"+p)
+        found = xml_find(cd, p)
         if None != found:
             break
     return found
@@ -295,11 +391,12 @@ def determine_wcseo_type(root):
     wcseo_type = WCS_TYPE_UNKNOWN
 
     try:
-        if hasattr(root, 'ns_map'):
+        ns_map = get_ns_map(root)
+        if None != ns_map:
             wcseo_ns_final = WCSEO_NS_F[1:][:-1]
             wcseo_ns_draft = WCSEO_NS_D[1:][:-1]
-            for ns in root.ns_map:
-                uri = root.ns_map[ns]
+            for ns in ns_map:
+                uri = ns_map[ns]
                 if uri == wcseo_ns_final:
                     wcseo_type = WCS_TYPE_FINAL201
                     break
@@ -310,7 +407,7 @@ def determine_wcseo_type(root):
     except Exception:
         root_str = "<None>"
         if None != root:
-            root_str = ET.tostring(root)
+            root_str = xml_tostring(root)
         logger.error("determine_wcseo_type() failed for: \n"+root_str)
     
     return wcseo_type
@@ -319,9 +416,10 @@ def determine_wcs_type(caps):
     wcs_type = WCS_TYPE_UNKNOWN
 
     try:
-        if hasattr(caps, 'ns_map'):
-            for ns in caps.ns_map:
-                uri = caps.ns_map[ns]
+        ns_map = get_ns_map(caps)
+        if None != ns_map:
+            for ns in ns_map:
+                uri = ns_map[ns]
                 if uri == CRS_URI_FINAL201:
                     wcs_type = WCS_TYPE_FINAL201
                     break
@@ -332,7 +430,7 @@ def determine_wcs_type(caps):
     except Exception:
         caps_str = "<None>"
         if None != caps:
-            caps_str = ET.tostring(caps)
+            caps_str = xml_tostring(caps)
         logger.error("determine_wcs_type() failed for: \n"+caps_str)
     
     return wcs_type
@@ -357,7 +455,7 @@ def tree_is_exception(tree):
 
 def extract_footprintpolys(cd, wcs_type):
     ms = multifind(cd, xpaths_eo_multisurface(wcs_type))
-    if not ms:
+    if None == ms:
         logger.error("extract_footprintpoly: MultiSurface not found")
         return None
     try:
@@ -372,7 +470,7 @@ def extract_footprintpolys(cd, wcs_type):
                  GML_NS + "surfaceMember/" +
                  GML_NS + "Polygon/" +
                  GML_NS + "exterior/" +
-                 GML_NS + "LinearRing/")
+                 GML_NS + "LinearRing")
 
     if not lr:
         logger.warning("extract_footprintpoly: LinearRing not found," +
@@ -384,7 +482,7 @@ def extract_footprintpolys(cd, wcs_type):
         logger.warning("extract_footprintpoly: Multiple LinearRing found")
 
     for l in lr:
-        ps = l.find("./"+GML_NS + "posList/")
+        ps = l.find("./"+GML_NS + "posList")
         posList = ps.text
         coords = coords_from_text(posList, srsName)
         break  # support only one LR for now
@@ -421,7 +519,7 @@ def extract_refs(eoresult, node_str, fix_missing_mtype=False):
         file_name_els = e.findall(".//" + EOP_NS +"fileName")
         for f in file_name_els:
             sr = f.find('./' + OWS_NS + "ServiceReference")
-            if sr:
+            if None != sr:
                 href = sr.attrib.get(XLINK_NS+'href')
                 if fix_missing_mtype:
                     href = add_missing_mediatype(href)
@@ -437,7 +535,7 @@ def extract_prods_and_masks(cd, fix_missing_mtype=False):
     return prods_and_masks
 
 def extract_path_text(cd, path):
-    leaf_node = cd.find("./"+path)
+    leaf_node = xml_find(cd, path)
     if None == leaf_node:
         return None
     return leaf_node.text
@@ -484,7 +582,10 @@ def extract_gml_bbox(cd):
                             +  GML_NS + "Envelope" )
     if None == envelope:
         return None
+    return extract_envelope_bbox(envelope)
 
+def extract_envelope_bbox(envelope):
+    # envelope is a gml:Envelope node, the bbox is converted to WGS84
     srsNumber = None
     axisLabels = None
     try:
@@ -527,6 +628,10 @@ def extract_TimePeriod(dss):
     # returns an instance of utils.TimePeriod
     tp = dss.find("./"+ GML_NS + "TimePeriod")
     if None == tp: return None
+    return extract_TimePeriod_node(tp)
+
+def extract_TimePeriod_node(tp):
+    # tp is a gml:TimePeriod node
     begin_pos = tp.find("./"+ GML_NS + "beginPosition")
     end_pos   = tp.find("./"+ GML_NS + "endPosition")
     if None == begin_pos or None == end_pos: return None
@@ -583,7 +688,195 @@ def extract_CoverageId(cd):
     return covId
 
 
+# ------------ single-pass CoverageDescription extraction ----------
+
+class CoverageRecord(object):
+    """ The values of a CoverageDescription that are needed for
+        checking the scenario conditions, see extract_cd_record().
+        Text values are kept as found in the metadata, None if missing.
+    """
+    __slots__ = ('coverage_id',
+                 'eoid',
+                 'bbox',             # Bbox, converted to WGS84
+                 'time_period',      # TimePeriod of om:phenomenonTime
+                 'sensor_type',
+                 'incidence_angle',
+                 'cloud_cover',
+                 'has_footprint',    # True if a MultiSurface was found
+                 'footprint')        # list of coordinate pairs
+
+    def __init__(self):
+        for a in self.__slots__:
+            setattr(self, a, None)
+        self.has_footprint = False
+
+    def __repr__(self):
+        return "CoverageRecord(" + `self.coverage_id` + ")"
+
+# (parent tag, tag) of the leaf nodes with plain text values,
+# found under EarthObservation
+_EO_TEXT_FIELDS = {
+    (EOP_NS+"EarthObservationMetaData", EOP_NS+"identifier")     : 'eoid',
+    (EOP_NS+"Sensor",                   EOP_NS+"sensorType")     : 'sensor_type',
+    (EOP_NS+"Acquisition",              EOP_NS+"incidenceAngle") : 'incidence_angle',
+    (OPT_NS+"EarthObservationResult",   OPT_NS+"cloudCoverPercentage") : 'cloud_cover',
+    }
+_EO_TIME_PERIOD  = (OM_NS+"phenomenonTime", GML_NS+"TimePeriod")
+_EO_MULTISURFACE = (EOP_NS+"multiExtentOf", GML_NS+"MultiSurface")
+_EO_TAGS = (EOP_NS+"EarthObservation",
+            OPT_NS+"EarthObservation",
+            SAR_NS+"EarthObservation")
+
+def _record_footprint(rec, ms):
+    try:
+        srsName = ms.attrib['srsName']
+    except KeyError:
+        logger.error("extract_cd_record: footprint srsName not found")
+        return
+    lr = ms.findall("./" +
+                 GML_NS + "surfaceMember/" +
+                 GML_NS + "Polygon/" +
+                 GML_NS + "exterior/" +
+                 GML_NS + "LinearRing")
+    if not lr:
+        logger.warning("extract_cd_record: LinearRing not found," +
+                       " using bbox instead.")
+        if None != rec.bbox:
+            bb = rec.bbox
+            rec.footprint = [(bb.ll[0], bb.ll[1]), (bb.ur[0], bb.ur[1])]
+        return
+    if len(lr) > 1:
+        logger.warning("extract_cd_record: Multiple LinearRing found")
+    # support only one LR for now
+    ps = lr[0].find("./"+GML_NS + "posList")
+    if None != ps:
+        rec.footprint = coords_from_text(ps.text, srsName)
+
+def _walk_earthobservation(rec, eo, with_footprint):
+    # depth-first walk in document order, each node is visited once,
+    # the first occurrence of each value is kept
+    stack = [ (eo, None) ]
+    while stack:
+        el, parent_tag = stack.pop()
+        key = (parent_tag, el.tag)
+        if key in _EO_TEXT_FIELDS:
+            attr = _EO_TEXT_FIELDS[key]
+            if None == getattr(rec, attr):
+                setattr(rec, attr, el.text)
+            continue
+        if key == _EO_TIME_PERIOD:
+            if None == rec.time_period:
+                rec.time_period = extract_TimePeriod_node(el)
+            continue
+        if key == _EO_MULTISURFACE:
+            if not rec.has_footprint:
+                rec.has_footprint = True
+                if with_footprint:
+                    _record_footprint(rec, el)
+            continue
+        children = list(el)
+        children.reverse()
+        for c in children:
+            stack.append( (c, el.tag) )
+
+def extract_cd_record(cd, wcs_type, with_footprint=True):
+    """ Walks the CoverageDescription cd once and returns a
+        CoverageRecord.  The footprint coordinates are only converted
+        if with_footprint is True.
+    """
+    rec = CoverageRecord()
+    wcseo_ns = WCSEO_NS_D if WCS_TYPE_DRAFT201 == wcs_type else WCSEO_NS_F
+    eo = None
+    for child in cd:
+        tag = child.tag
+        if tag == WCS_NS+"CoverageId":
+            if None == rec.coverage_id:
+                rec.coverage_id = child.text
+        elif tag == GML_NS+"boundedBy":
+            if None == rec.bbox:
+                envelope = child.find("./" + GML_NS + "Envelope")
+                if None != envelope:
+                    rec.bbox = extract_envelope_bbox(envelope)
+        elif tag == GMLCOV_NS+"metadata" and None == eo:
+            for ext in child:
+                if ext.tag != GMLCOV_NS+"Extension": continue
+                for eom in ext:
+                    if eom.tag != wcseo_ns+"EOMetadata": continue
+                    for e in eom:
+                        if e.tag in _EO_TAGS:
+                            eo = e
+                            break
+                    if None != eo: break
+                if None != eo: break
+
+    if None == rec.coverage_id:
+        rec.coverage_id = cd.attrib.get(GML_NS+'id')
+
+    if None != eo:
+        _walk_earthobservation(rec, eo, with_footprint)
+    return rec
+
+
+def stream_extract_eoid(src_data):
+    """ Returns the EO identifier
+          metadata/Extension/EOMetadata/EarthObservation/
+          metaDataProperty/EarthObservationMetaData/identifier
+        of the document src_data (file name or file object), or None.
+        The document is parsed incrementally and parsing stops as soon
+        as the identifier has been read, no tree is kept.
+    """
+    eoid_path = [
+        (GMLCOV_NS+"metadata",),
+        (GMLCOV_NS+"Extension",),
+        (WCSEO_NS_D+"EOMetadata", WCSEO_NS_F+"EOMetadata"),
+        _EO_TAGS,
+        (EOP_NS+"metaDataProperty",),
+        (EOP_NS+"EarthObservationMetaData",),
+        (EOP_NS+"identifier",) ]
+    n_path = len(eoid_path)
+
+    if xml_backend == BACKEND_LXML:
+        iterparse = LET.iterparse
+    else:
+        iterparse = ET.iterparse
+
+    fp = None
+    if not hasattr(src_data, 'read'):
+        fp = open(src_data, "rb")
+        src_data = fp
+
+    eoid = None
+    # depth is the number of open elements below the root,
+    # matched is the number of them that are on the eoid path
+    depth = 0
+    matched = 0
+    try:
+        for event, elem in iterparse(src_data, ("start", "end")):
+            if event == "start":
+                depth += 1
+                if matched == depth-2 and matched < n_path and \
+                        elem.tag in eoid_path[matched]:
+                    matched += 1
+            else:
+                if matched == n_path and depth == n_path+1:
+                    eoid = elem.text
+                    break
+                if depth > 1 and matched == depth-1:
+                    matched -= 1
+                depth -= 1
+                elem.clear()
+    finally:
+        if None != fp:
+            fp.close()
+
+    return eoid
+
+
 def parse_with_ns(src_data):
+    if xml_backend == BACKEND_LXML:
+        # lxml keeps the namespaces, see get_ns_map()
+        return LET.parse(src_data).getroot()
+
     root = None
     events = "start", "start-ns"
     ns_map = []
@@ -602,6 +895,8 @@ def base_xml_parse(src_data, save_ns=False):
     root = None
     if save_ns:
         root = parse_with_ns(src_data)
+    elif xml_backend == BACKEND_LXML:
+        root = LET.parse(src_data).getroot()
     else:
         root = ET.parse(src_data).getroot()
     return root
@@ -614,10 +909,10 @@ def parse_file(src_data, expected_root, src_name, save_ns=False):
         if None == result:
             raise IngestionError("No data")
         if tree_is_exception(result):
-            result = None
             logger.warning("'"+src_name+"' contains exception")
             if IE_DEBUG > 0:
-                logger.info(ET.tostring(result))
+                logger.info(xml_tostring(result))
+            result = None
         elif expected_root and not is_nc_tag(result.tag, expected_root):
             msg = "'"+src_name+"' does not contain expected root "+ \
                 `expected_root` + ". In xml: "+`result.tag`
@@ -625,9 +920,9 @@ def parse_file(src_data, expected_root, src_name, save_ns=False):
             result = None
         pass
     except IOError as e:
-        loger.error("Cannot open/parse md source '"+src_name+"': " + `e`)
+        logger.error("Cannot open/parse md source '"+src_name+"': " + `e`)
         return None
-    except xml.parsers.expat.ExpatError as e:
+    except XML_PARSE_ERRORS as e:
         logger.error("Cannot parse '"+src_name+"', error="+`e`)
         return None
     except Exception as e:
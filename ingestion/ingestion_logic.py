@@ -21,8 +21,8 @@ import time
 import traceback
 import simplejson
 
-import dar_builder
 import work_flow_manager
+import md_eval_pool
 
 from utils import \
     Bbox, \
@@ -32,7 +32,11 @@ from utils import \
     DMError, \
     IngestionError, \
     StopRequest, \
-    read_from_url, \
+    fetch_json, \
+    fetch_url, \
+    ParserSink, \
+    JsonListParser, \
+    LimitedReader, \
     check_or_make_dir, \
     make_new_dir
 
@@ -41,7 +45,9 @@ from settings import \
     DAR_STATUS_INTERVAL,\
     STOP_REQUEST, \
     IE_30KM_SHPFILE, \
-    IE_DM_MAXWAIT2
+    IE_DM_MAXWAIT2, \
+    IE_DM_RESPONSE_MAX_SIZE, \
+    IE_PF_RESPONSE_MAX_SIZE
 
 from dm_control import \
     DownloadManagerController, \
@@ -49,7 +55,6 @@ from dm_control import \
     DM_PRODUCT_CANCEL_TEMPLATE
 
 from models import \
-    Archive, \
     Scenario, \
     ScenarioStatus, \
     DSRC_EOWCS_CHOICE, \
@@ -60,6 +65,8 @@ from models import \
     AOI_SHPFILE_CHOICE, \
     date_from_iso8601
 
+from darc import is_archived
+
 from coastline_ck import \
     coastline_ck, \
     coastline_cache_from_aoi
@@ -67,21 +74,16 @@ from coastline_ck import \
 # XML metadata parsing
 from ie_xml_parser import \
     parse_file, \
-    extract_paths_text, \
     extract_Id, \
-    extract_gml_bbox, \
     extract_WGS84bbox, \
     extract_TimePeriod, \
-    extract_om_time, \
     extract_ServiceTypeVersion, \
     extract_DatasetSeriesSummaries, \
     extract_CoverageId, \
     extract_prods_and_masks, \
     get_coverageDescriptions, \
     determine_wcs_type, \
-    xpaths_cloudcover, \
-    xpaths_sensor, \
-    xpaths_incidenceangle, \
+    extract_cd_record, \
     WCS_TYPE_UNKNOWN, \
     WCS_TYPE_DRAFT201, \
     WCS_TYPE_FINAL201
@@ -242,6 +244,8 @@ def getXmlTree(url, expected_tag, save_ns=False):
         if None!=resp: resp.close()
         return (None, None)
     else:
+        # the parser reads the response directly, in blocks
+        resp = LimitedReader(resp, IE_PF_RESPONSE_MAX_SIZE)
         return ( resp, parse_file(resp,
                                   expected_tag,
                                   resp.geturl(),
@@ -293,20 +297,20 @@ def get_caps_from_pf(product_facility_url, save_ns=False):
     
     return ret
 
-def check_bbox(coverageDescription, req_bbox):
-    bb = extract_gml_bbox(coverageDescription)
+def check_bbox(cd_rec, req_bbox):
+    bb = cd_rec.bbox
     if None == bb:
         return False
     return bb.overlaps(req_bbox)
 
-def check_coastline(coverageDescription, cid, params, ccache, wcs_type):
+def check_coastline(cd_rec, cid, params, ccache, wcs_type):
     if not should_check_coastline(params):
         return True
-    return coastline_ck(coverageDescription, cid, ccache, wcs_type)
+    return coastline_ck(cd_rec, cid, ccache, wcs_type)
 
-def check_timePeriod(coverageDescription, req_tp, md_src, wcs_type):
+def check_timePeriod(cd_rec, req_tp, md_src):
     if req_tp == None:     return True
-    timePeriod = extract_om_time(coverageDescription, wcs_type)
+    timePeriod = cd_rec.time_period
     if None==timePeriod:
         logger.warning("timePeriod not found in EO metatada, src='"+\
                 md_src+"'")
@@ -351,7 +355,7 @@ def check_custom_conditions(cd, req):
     return True
 
 
-def check_text_condition(cd, req, key, xpaths):
+def check_text_condition(md_item, req, key):
     if not key in req:
         return True
     req_item = req[key]
@@ -359,7 +363,6 @@ def check_text_condition(cd, req, key, xpaths):
         return True
     if IE_DEBUG > 0:
         logger.debug("Checking "+key+"=="+`req_item`)
-    md_item  = extract_paths_text(cd, xpaths)
     if not md_item:
         if IE_DEBUG > 0:
             logger.debug("No value in MD for  "+key+".")
@@ -367,7 +370,7 @@ def check_text_condition(cd, req, key, xpaths):
     return req_item == md_item
 
 
-def check_float_max(cd, req, key, xpaths, use_abs=False):
+def check_float_max(md_item, req, key, use_abs=False):
     if not key in req:
         logger.warning("Check of " + `key` + ": not found in request")
         return True
@@ -377,7 +380,6 @@ def check_float_max(cd, req, key, xpaths, use_abs=False):
     except Exception as e:
         raise IngestionError("Bad value specified for " + `key` + \
                                  ', exception: ' + `e`)
-    md_item  = extract_paths_text(cd, xpaths)
     if not md_item:
         logger.warning("Check of " + `key` + ": not found in metadata.")
         return True
@@ -397,6 +399,57 @@ def check_float_max(cd, req, key, xpaths, use_abs=False):
         return True
 
 
+def evaluate_cd(cd, coverage_id, params, aoi_toi, ccache, wcs_type, md_src, failed):
+    """ Checks one CoverageDescription against the scenario conditions,
+        returns True if the coverage should be downloaded.
+        The names of the conditions that were not met are added to
+        the set 'failed'.
+        Note: this is also run in the metadata evaluation worker
+        processes (see md_eval_pool), it must not access the db.
+    """
+    # all values except for the custom conditions are taken
+    # from the record, the tree is walked only once
+    cd_rec = extract_cd_record(
+        cd, wcs_type, None != ccache and should_check_coastline(params))
+
+    if not check_bbox(cd_rec, aoi_toi[0]):
+        if IE_DEBUG > 2: logger.debug("  bbox check failed.")
+        if IE_DEBUG > 0: failed.add('bbox')
+        return False
+        
+    if not check_timePeriod(cd_rec, aoi_toi[1], md_src):
+        if IE_DEBUG > 2: logger.debug("  TimePeriod check failed.")
+        failed.add('TimePeriod')
+        return False
+
+    if not check_text_condition(cd_rec.sensor_type, params, 'sensor_type'):
+        if IE_DEBUG > 2: logger.debug("  sensor type check failed.")
+        if IE_DEBUG > 0: failed.add('sensor_type')
+        return False
+
+    if not check_float_max(cd_rec.incidence_angle, params, 'view_angle', True):
+        if IE_DEBUG > 2: logger.debug("  incidence angle check failed.")
+        if IE_DEBUG > 0: failed.add('view_angle')
+        return False
+
+    if not check_float_max(cd_rec.cloud_cover, params, 'cloud_cover'):
+        if IE_DEBUG > 2: logger.debug("  cloud cover check failed.")
+        if IE_DEBUG > 0: failed.add('cloud_cover')
+        return False
+
+    if not check_coastline(cd_rec, coverage_id, params, ccache, wcs_type):
+        if IE_DEBUG > 2: logger.debug("  coastline check failed.")
+        if IE_DEBUG > 0: failed.add('coastline check')
+        return False
+
+    if not check_custom_conditions(cd, params):
+        if IE_DEBUG > 2: logger.debug("  custom conds check failed.")
+        if IE_DEBUG > 0: failed.add('custom conditions')
+        return False
+
+    return True
+
+
 def gen_dl_urls(params, aoi_toi, base_url, md_url, eoid, ccache, wcs_type):
     """ params is the dictionary of input parameters
         aoi_toi is a tuple containing Area-of-interest Bounding-Box and
@@ -447,6 +500,8 @@ def gen_dl_urls(params, aoi_toi, base_url, md_url, eoid, ccache, wcs_type):
     should_check_archived = True
     if 'check_arch' in params:
         should_check_archived = params['check_arch']
+    use_pool = md_eval_pool.is_enabled()
+    candidates = []
     failed = set()
     passed = 0
     for cd in cds:
@@ -469,39 +524,13 @@ def gen_dl_urls(params, aoi_toi, base_url, md_url, eoid, ccache, wcs_type):
                             "' is achived, not downloading.")
             continue
 
-        if not check_bbox(cd, aoi_toi[0]):
-            if IE_DEBUG > 2: logger.debug("  bbox check failed.")
-            if IE_DEBUG > 0: failed.add('bbox')
-            continue
-        
-        if not check_timePeriod(cd, aoi_toi[1], md_url, wcs_type):
-            if IE_DEBUG > 2: logger.debug("  TimePeriod check failed.")
-            failed.add('TimePeriod')
-            continue
-
-        if not check_text_condition(cd, params, 'sensor_type', xpaths_sensor(wcs_type)):
-            if IE_DEBUG > 2: logger.debug("  sensor type check failed.")
-            if IE_DEBUG > 0: failed.add('sensor_type')
-            continue
-
-        if not check_float_max(cd, params, 'view_angle', xpaths_incidenceangle(wcs_type), True):
-            if IE_DEBUG > 2: logger.debug("  incidence angle check failed.")
-            if IE_DEBUG > 0: failed.add('view_angle')
-            continue
-
-        if not check_float_max(cd, params, 'cloud_cover', xpaths_cloudcover(wcs_type)):
-            if IE_DEBUG > 2: logger.debug("  cloud cover check failed.")
-            if IE_DEBUG > 0: failed.add('cloud_cover')
-            continue
-
-        if not check_coastline(cd, coverage_id, params, ccache, wcs_type):
-            if IE_DEBUG > 2: logger.debug("  coastline check failed.")
-            if IE_DEBUG > 0: failed.add('coastline check')
+        if use_pool:
+            # evaluated further below, in batches
+            candidates.append( (coverage_id, cd) )
             continue
 
-        if not check_custom_conditions(cd, params):
-            if IE_DEBUG > 2: logger.debug("  custom conds check failed.")
-            if IE_DEBUG > 0: failed.add('custom conditions')
+        if not evaluate_cd(
+            cd, coverage_id, params, aoi_toi, ccache, wcs_type, md_url, failed):
             continue
 
         passed = passed+1
@@ -510,6 +539,18 @@ def gen_dl_urls(params, aoi_toi, base_url, md_url, eoid, ccache, wcs_type):
         #  disabled, not supported by ODA server for now:
         #ret.extend( extract_prods_and_masks(cd, True) )
 
+    if candidates:
+        try:
+            accepted = md_eval_pool.evaluate_cds(
+                candidates, params, aoi_toi, wcs_type, md_url, failed,
+                lambda : check_status_stopping(scid))
+        except StopRequest:
+            if None != fp: fp.close()
+            raise
+        for coverage_id in accepted:
+            passed = passed+1
+            ret.append(base_url+"&CoverageId="+coverage_id)
+        candidates = None
 
     if None != fp: fp.close()
     cd_tree = None
@@ -563,7 +604,9 @@ def process_csDescriptions(params, aoi_toi, service_version, wcs_type, md_urls):
     toteocs = float(len(md_urls))
 
     coastcache = None
-    if should_check_coastline(params):
+    if should_check_coastline(params) and not md_eval_pool.is_enabled():
+        # with the md evaluation pool each worker process
+        # builds its own cache
         shpfile = IE_30KM_SHPFILE
         prjfile = None
         coastcache = None
@@ -696,9 +739,7 @@ def check_archived(scid, coverage_id):
     # returns True if matching metadata already exists in the archive.
     # Checks only for a match against the EO-ID (coverage ID)
 
-    scenario = Scenario.objects.get(id=int(scid))
-    archived = Archive.objects.filter(scenario=scenario,eoid=coverage_id)
-    if len(archived)==0:
+    if not is_archived(scid, coverage_id):
         if IE_DEBUG > 2:
             logger.info("Not in archive: " + `coverage_id`)
         return False
@@ -707,9 +748,9 @@ def check_archived(scid, coverage_id):
 
 
 def download_urls(urls_with_dirs):
-    dar = dar_builder.build_DAR(urls_with_dirs)
+    # urls_with_dirs: list or iterator of (dl_dir, url)
     dmcontroller = DownloadManagerController.Instance()
-    status, dar_url, dm_dar_id = dmcontroller.submit_dar(dar)
+    status, dar_url, dm_dar_id = dmcontroller.submit_dar(urls_with_dirs)
     if status != "OK":
         raise DMError("DAR submit problem, status:" + status)
     return dar_url, dm_dar_id 
@@ -726,12 +767,9 @@ def request_download(sc_ncn_id, scid, urls):
     if nreqs>1000:   id_digits = 4
     fmt = "p_"+sc_ncn_id+"_%0"+`id_digits`+"d"
 
-    urls_with_dirs = []
-    i = 1
-    for url in urls:
-        urls_with_dirs.append(  (os.path.join(rel_path, fmt % i), url) )
-        i += 1
-    urls = None
+    # the DAR is written to the DAR store directly from this
+    urls_with_dirs = ( (os.path.join(rel_path, fmt % (i+1)), url)
+                       for i, url in enumerate(urls) )
 
     dar_url, dm_dar_id = download_urls(urls_with_dirs)
 
@@ -754,18 +792,22 @@ def stop_products_dl(product_list):
         uuid = p['uuid']
         url = dm_url + DM_PRODUCT_CANCEL_TEMPLATE % uuid
         try:
-            dm_response = json.loads(read_from_url(url))
+            dm_response = fetch_json(url, max_size=IE_DM_RESPONSE_MAX_SIZE)
         except urllib2.URLError as e:
             logger.warning("Error from DM while cancelling download: " + `e`)
 
-def get_dar_list():
+def get_dar_list(select=None):
+    # Returns the DARs in the DM status for which select(dar) is true,
+    # all of them if select is None.  The status of all the DARs may be
+    # large, it is parsed as it is read and only the selected DARs are
+    # kept.
     dmcontroller = DownloadManagerController.Instance()
     dm_url = dmcontroller._dm_url
     url = dm_url+DM_DAR_STATUS_COMMAND
     waiting = True
     ts = time.time()
     tdiff = 0
-    dar_status = []
+    dars = []
     err = None
     while waiting:
         tdiff = time.time() - ts
@@ -773,30 +815,25 @@ def get_dar_list():
             raise DMError(
                 "Unable to get DAR, timeout waiting for DM, "+`err`)
         try:
-            dar_status = json.loads(read_from_url(url))
+            dars = fetch_url(
+                url,
+                ParserSink(JsonListParser("dataAccessRequests", select)),
+                max_size=IE_DM_RESPONSE_MAX_SIZE)
             waiting = False
         except urllib2.HTTPError as e:
             err = e
             time.sleep(2)
-
-    if not "dataAccessRequests" in dar_status:
-        raise DMError(
-            "Bad DAR status from DM; no 'dataAccessRequests' found.")
-    return dar_status["dataAccessRequests"]
+        except ValueError:
+            raise DMError(
+                "Bad DAR status from DM; no 'dataAccessRequests' found.")
+    return dars
 
 def stop_active_dar_dl(active_dar_uuid):
     logger.info("Stopping active download, dar uuid="+`active_dar_uuid`)
-    dar = get_dar_list()
-    request = None
-    for r in dar:
-        if not "uuid" in r:
-            continue
-        uuid = r["uuid"]
-        if uuid == active_dar_uuid:
-            request = r
-            break
-    if not request:
+    dar = get_dar_list(lambda r: r.get("uuid") == active_dar_uuid)
+    if not dar:
         return
+    request = dar[0]
     if not "productList" in request:
         return 
     stop_products_dl(request["productList"])
@@ -823,14 +860,11 @@ def stop_download(scid, request):
     stop_products_dl(request["productList"])
 
 def get_dar_status(dar_url):
-    dar = get_dar_list()
+    dar = get_dar_list(lambda r: r.get("darURL") == dar_url)
     request = None
-    for r in dar:
-        if not "darURL" in r:
-            continue
-        if r["darURL"] == dar_url:
-            request = r
-            break
+    if dar:
+        request = dar[0]
+        DownloadManagerController.Instance().dar_accepted(dar_url)
     return request
 
 def wait_for_download(scid, dar_url, dar_id, ncn_id, max_wait=None):
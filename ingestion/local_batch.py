@@ -0,0 +1,278 @@
+############################################################
+#  Project: DREAM
+#
+#  Module:  Task 5 ODA Ingestion Engine
+#
+#    (c) 2014 Siemens Convergence Creators s.r.o., Prague
+#    Licensed under the 'DREAM ODA Ingestion Engine Open License'
+#     (see the file 'LICENSE' in the top-level directory)
+#
+#  Ingestion Engine: batch ingestion of local products.
+#   Many local products (already on the IE host) are ingested into a
+#   scenario by one request and one work-flow-manager task
+#   (INGEST_LOCAL_BATCH), which processes IE_LOCAL_BATCH_THREADS
+#   products in parallel.  The products are given as
+#     - a directory: every file or sub-directory is a product, with
+#       the metadata <base>.xml if there is one, or
+#     - a list file: one product per line, 'data [metadata]', paths
+#       relative to the list file, '#' starts a comment, or
+#     - a json list of {"data": path, "metadata": path}.
+#   The progress, the per-product results and the throughput are kept
+#   in a LocalBatch record, see batch_status().
+#
+#  used by views and work_flow_manager
+#
+############################################################
+
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+import traceback
+
+from settings import \
+    IE_DEBUG, \
+    IE_SCRIPTS_DIR, \
+    IE_DEFAULT_ADDPROD_SCRIPT, \
+    IE_CHECKSUM_ALGO
+
+from utils import \
+    relocate, \
+    relocate_summary
+
+from django.db import connection, transaction
+from django.core.management.color import no_style
+
+import work_flow_manager
+import models
+
+logger = logging.getLogger('dream.file_logger')
+
+METADATA_SUFFIX = ".xml"
+
+# the LocalBatch record is updated at most this often, seconds
+SAVE_INTERVAL = 5.0
+
+class LocalBatchError(Exception):
+    pass
+
+def find_products(src_dir):
+    """ Returns the products in src_dir as a list of (data, metadata);
+        metadata is None if there is none.
+    """
+    names = sorted([n for n in os.listdir(src_dir) if not n.startswith(".")])
+    name_set = set(names)
+    meta_names = set()
+    for n in names:
+        base = os.path.splitext(n)[0]
+        if n != base + METADATA_SUFFIX and base + METADATA_SUFFIX in name_set:
+            meta_names.add(base + METADATA_SUFFIX)
+    products = []
+    for n in names:
+        if n in meta_names: continue
+        meta = os.path.splitext(n)[0] + METADATA_SUFFIX
+        if meta == n or meta not in name_set:
+            meta = None
+        else:
+            meta = os.path.join(src_dir, meta)
+        products.append( (os.path.join(src_dir, n), meta) )
+    return products
+
+def read_product_list(list_fn):
+    """ Reads a list file, see the top of this file. """
+    base_dir = os.path.dirname(os.path.abspath(list_fn))
+    products = []
+    fp = open(list_fn, "r")
+    try:
+        for line in fp:
+            line = line.split("#", 1)[0].strip()
+            if not line: continue
+            parts = line.split()
+            if len(parts) > 2:
+                raise LocalBatchError("Bad line in " + list_fn + ": " + line)
+            data = os.path.join(base_dir, parts[0])
+            meta = None
+            if len(parts) > 1:
+                meta = os.path.join(base_dir, parts[1])
+            products.append( (data, meta) )
+    finally:
+        fp.close()
+    return products
+
+def place_product(src, dl_dir):
+    """ Puts a copy of the product file or directory src into dl_dir,
+        cloned where the file system allows it, see utils.relocate.  The batch already runs products in parallel,
+        so the files of one product are placed by one thread.
+        Returns (base name, number of bytes).
+    """
+    name = os.path.basename(src.rstrip(os.sep))
+    stats = relocate(src, dl_dir, False, 1, IE_CHECKSUM_ALGO)
+    if IE_DEBUG > 0:
+        logger.debug("placed %s: %s" % (src, relocate_summary(stats)))
+    return name, stats["bytes"]
+
+class BatchResults:
+    """ Collects the per-product results of a batch (from several
+        threads) and writes them to the LocalBatch record.
+        A result is a dict:
+          {"data":..., "metadata":..., "status": "success"|"failed"|
+           "stopped", "productId":..., "error":..., "secs":...}
+    """
+    def __init__(self, batch_id):
+        self._lock     = threading.Lock()
+        self._batch_id = batch_id
+        self._results  = []
+        self._n_failed = 0
+        self._n_bytes  = 0
+        self._t_start  = time.time()
+        self._t_saved  = 0
+
+    def add(self, result, n_bytes):
+        self._lock.acquire()
+        try:
+            self._results.append(result)
+            if result["status"] != "success":
+                self._n_failed += 1
+            self._n_bytes += n_bytes
+        finally:
+            self._lock.release()
+
+    def n_failed(self):
+        return self._n_failed
+
+    def save(self, status=None):
+        # writes the record if status is given (final), or if the last
+        # write was more than SAVE_INTERVAL ago
+        now = time.time()
+        if None == status and now - self._t_saved < SAVE_INTERVAL:
+            return
+        self._lock.acquire()
+        try:
+            self._t_saved = now
+            batch = models.LocalBatch.objects.get(id=self._batch_id)
+            batch.n_done   = len(self._results)
+            batch.n_failed = self._n_failed
+            batch.n_bytes  = self._n_bytes
+            batch.elapsed  = now - self._t_start
+            batch.results  = json.dumps(self._results)
+            if None != status:
+                batch.info_status = status
+            batch.save()
+        finally:
+            self._lock.release()
+
+def create_batch_table():
+    """ Creates the LocalBatch table in a db from an older version;
+        called at start-up, syncdb is only run for a new db.
+    """
+    table = models.LocalBatch._meta.db_table
+    cursor = connection.cursor()
+    if table in connection.introspection.table_names(cursor):
+        return
+    logger.info("Creating table " + table)
+    statements, pending = connection.creation.sql_create_model(
+        models.LocalBatch, no_style(), set())
+    with transaction.commit_on_success():
+        for sql in statements:
+            cursor.execute(sql)
+
+def batch_status(batch_id):
+    """ Returns the status of a batch as a dict, with the aggregate
+        throughput (products/s, MB/s) and the per-product results.
+    """
+    batch = models.LocalBatch.objects.get(id=batch_id)
+    resp = {"status"     : batch.info_status,
+            "ncn_id"     : batch.ncn_id,
+            "nProducts"  : batch.n_products,
+            "nDone"      : batch.n_done,
+            "nFailed"    : batch.n_failed,
+            "elapsed"    : batch.elapsed,
+            "products"   : json.loads(batch.results)}
+    if batch.elapsed > 0:
+        resp["productsPerSec"] = batch.n_done / batch.elapsed
+        resp["mbPerSec"] = batch.n_bytes / (1024.0*1024.0) / batch.elapsed
+    return resp
+
+def local_batch_submit(postData, request_meta):
+    """ Submits a batch local ingestion; postData is json:
+          {"ncn_id": ..., "dir": ...}  or  {"ncn_id": ..., "list": ...}
+          or {"ncn_id": ..., "products": [{"data":..., "metadata":...}]}
+        The response has batchId, for getStatus.
+    """
+    logger.info("processing addLocalBatch request")
+    resp = {}
+    locked_id = None
+    try:
+        args = json.loads(postData)
+        ncn_id = args["ncn_id"].encode('ascii','ignore')
+        if "dir" in args:
+            products = find_products(args["dir"].encode('ascii','ignore'))
+        elif "list" in args:
+            products = read_product_list(args["list"].encode('ascii','ignore'))
+        elif "products" in args:
+            products = []
+            for p in args["products"]:
+                meta = p.get("metadata")
+                if meta: meta = meta.encode('ascii','ignore')
+                products.append( (p["data"].encode('ascii','ignore'), meta) )
+        else:
+            raise LocalBatchError("One of dir, list or products is required")
+        if not products:
+            raise LocalBatchError("No products found")
+        for data, meta in products:
+            if not os.path.exists(data):
+                raise LocalBatchError("Product not found: " + data)
+
+        scenario = models.Scenario.objects.get(ncn_id=ncn_id)
+        wfm = work_flow_manager.WorkFlowManager.Instance()
+        # released by the task when it is done
+        if not wfm.lock_scenario(scenario.id):
+            raise LocalBatchError("Scenario '%s' is busy." % ncn_id)
+        locked_id = scenario.id
+        batch = models.LocalBatch(
+            ncn_id      = ncn_id,
+            info_status = "processing",
+            info_date   = datetime.datetime.utcnow(),
+            n_products  = len(products))
+        batch.save()
+
+        scripts = []
+        if scenario.oda_server_ingest != 0:
+            scripts.append(os.path.join(IE_SCRIPTS_DIR, IE_DEFAULT_ADDPROD_SCRIPT))
+
+        wfm.put_task_to_queue(work_flow_manager.WorkerTask(
+            {"scenario_id"      : scenario.id,
+             "ncn_id"           : ncn_id,
+             "task_type"        : "INGEST_LOCAL_BATCH",
+             "batch_id"         : batch.id,
+             "products"         : products,
+             "scripts"          : scripts,
+             "s2_preprocess"    : scenario.s2_preprocess,
+             }))
+        logger.info("Local batch ingestion submitted to queue: " +
+                    "ncn_id='%s', batch %d, %d products" %
+                    (ncn_id, batch.id, len(products)))
+        locked_id = None
+        resp["status"]    = 0
+        resp["batchId"]   = batch.id
+        resp["nProducts"] = len(products)
+
+    except (LocalBatchError, KeyError, ValueError, OSError, IOError,
+            models.Scenario.DoesNotExist) as e:
+        logger.warning("addLocalBatch request error: " + `e`)
+        resp["status"] = 1
+        resp["errorString"] = "%s" % e
+
+    except Exception as e:
+        logger.error("Exception in local_batch_submit: " + `e`)
+        if IE_DEBUG > 0:
+            logger.debug(traceback.format_exc(4))
+        resp["status"] = 50
+        resp["errorString"] = "Unexpected exception: " + e.__class__.__name__
+
+    if None != locked_id:
+        work_flow_manager.WorkFlowManager.Instance().set_scenario_status(
+            0, locked_id, 1, 'IDLE', 0)
+    return resp
@@ -0,0 +1,143 @@
+############################################################
+#  Project: DREAM
+#
+#  Module:  Task 5 ODA Ingestion Engine
+#
+#    (c) 2014 Siemens Convergence Creators s.r.o., Prague
+#    Licensed under the 'DREAM ODA Ingestion Engine Open License'
+#     (see the file 'LICENSE' in the top-level directory)
+#
+#  Ingestion Engine: reader for the log file, for the log display.
+#   The last lines are found by reading backwards from the end of the
+#   file, so only the tail of a large log is read.  The reader returns
+#   a cursor (inode:offset); with it the next call reads only what was
+#   appended in the meantime.  If the log was rotated or truncated the
+#   cursor is not valid any more, and the tail is read again.
+#   A log record is a line starting with a level name, followed by any
+#   lines without one (e.g. a traceback).
+#
+#  used by ajax
+#
+############################################################
+
+import os
+
+# rank of the level names used in the log format of settings.LOGGING
+LEVEL_RANK = {
+    "DEBUG"    : 10,
+    "INFO"     : 20,
+    "WARNING"  : 30,
+    "ERROR"    : 40,
+    "CRITICAL" : 50,
+    }
+
+BLOCK_SZ = 65536
+
+# if more than this was appended since the cursor, the tail is read instead
+MAX_INCREMENT = 4*1024*1024
+
+class LogFilter:
+    """ Selects records with at least level min_level, and which contain
+        the string ncn_id.  Either may be None or empty.
+    """
+    def __init__(self, min_level=None, ncn_id=None):
+        self._min_rank = LEVEL_RANK.get((min_level or "").upper(), 0)
+        self._ncn_id   = ncn_id or None
+
+    def match(self, record):
+        if self._min_rank > 0:
+            rank = LEVEL_RANK.get(record[0].split(" ", 1)[0], 0)
+            if rank < self._min_rank:
+                return False
+        if None != self._ncn_id:
+            for line in record:
+                if self._ncn_id in line: return True
+            return False
+        return True
+
+def is_record_start(line):
+    return line.split(" ", 1)[0] in LEVEL_RANK
+
+def _tail_records(fp, end, n, flt):
+    # reads backwards from end until n matching records are found
+    records = []
+    cont = []        # lines after the record start, in reverse order
+    pos = max(end - 1, 0)   # without the final newline
+    first = ""       # the first, possibly incomplete, line read so far
+    while pos > 0 and len(records) < n:
+        rd = min(BLOCK_SZ, pos)
+        pos -= rd
+        fp.seek(pos)
+        lines = (fp.read(rd) + first).split("\n")
+        first = lines.pop(0)
+        if 0 == pos: lines.insert(0, first)
+        for line in reversed(lines):
+            if not is_record_start(line):
+                cont.append(line)
+                continue
+            record = [line] + cont[::-1]
+            cont = []
+            if flt.match(record):
+                records.append(record)
+                if len(records) >= n: break
+    records.reverse()
+    return records
+
+def _read_records(fp, start, end, flt):
+    # reads the complete records between start and end, in order
+    fp.seek(start)
+    records = []
+    for line in fp.read(end - start).split("\n")[:-1]:
+        if is_record_start(line) or not records:
+            records.append([line])
+        else:
+            records[-1].append(line)
+    return [r for r in records if flt.match(r)]
+
+def _line_end(fp, size):
+    # offset after the last complete line; a line being written is
+    # left for the next call
+    pos = size
+    while pos > 0:
+        rd = min(BLOCK_SZ, pos)
+        fp.seek(pos - rd)
+        i = fp.read(rd).rfind("\n")
+        if i >= 0:
+            return pos - rd + i + 1
+        pos -= rd
+    return 0
+
+def read_log(fn, max_lines, cursor=None, flt=None):
+    """ Returns (lines, cursor, reset). lines is a list of log lines,
+        at most max_lines, from the selected records; reset is True if
+        lines is the tail of the log rather than what was appended
+        since the cursor, and the client should discard what it has.
+        cursor: the cursor from the previous call, or None/''.
+    """
+    if None == flt: flt = LogFilter()
+    fp = open(fn, "r")
+    try:
+        st = os.fstat(fp.fileno())
+        end = _line_end(fp, st.st_size)
+        start = None
+        if cursor:
+            try:
+                inode, offset = [int(c) for c in cursor.split(":")]
+                if inode == st.st_ino and offset <= end and \
+                        end - offset <= MAX_INCREMENT:
+                    start = offset
+            except ValueError:
+                pass
+        if None == start:
+            records = _tail_records(fp, end, max_lines, flt)
+        else:
+            records = _read_records(fp, start, end, flt)
+    finally:
+        fp.close()
+
+    lines = []
+    for r in records:
+        lines.extend(r)
+    if len(lines) > max_lines:
+        lines = lines[-max_lines:]
+    return lines, "%d:%d" % (st.st_ino, end), None == start
@@ -0,0 +1,145 @@
+############################################################
+#  Project: DREAM
+#
+#  Module:  Task 5 ODA Ingestion Engine
+#
+#    (c) 2014 Siemens Convergence Creators s.r.o., Prague
+#    Licensed under the 'DREAM ODA Ingestion Engine Open License'
+#     (see the file 'LICENSE' in the top-level directory)
+#
+#  Ingestion Engine: process pool for evaluating product metadata.
+#   The CoverageDescriptions are checked against the scenario
+#   conditions (bbox, time, sensor, angles, cloud cover, coastline,
+#   custom conditions) in separate processes, so that the evaluation
+#   is not serialised by the GIL of the work-flow worker threads.
+#   The pool is enabled by setting IE_MD_EVAL_PROCESSES > 0.
+#
+#  used by ingestion_logic
+#
+############################################################
+
+import logging
+import multiprocessing
+import threading
+
+from settings import \
+    IE_DEBUG, \
+    IE_MD_EVAL_PROCESSES, \
+    IE_MD_EVAL_BATCH, \
+    IE_30KM_SHPFILE
+
+from utils import StopRequest, IngestionError
+from ie_xml_parser import xml_fromstring, xml_tostring
+
+logger = logging.getLogger('dream.file_logger')
+
+_pool      = None
+_pool_lock = threading.Lock()
+
+# per-process cache of coastline geometries, key is the aoi
+_coast_caches = {}
+
+def is_enabled():
+    return IE_MD_EVAL_PROCESSES > 0
+
+def start():
+    """ Creates the process pool. Should be called at start-up before
+        any other threads are started, since the worker processes are
+        forked from the current process.
+    """
+    global _pool
+    if not is_enabled():
+        return None
+    _pool_lock.acquire()
+    try:
+        if None == _pool:
+            if IE_DEBUG > 0:
+                logger.debug("Starting md evaluation pool, processes: " +
+                             `IE_MD_EVAL_PROCESSES`)
+            _pool = multiprocessing.Pool(IE_MD_EVAL_PROCESSES)
+    finally:
+        _pool_lock.release()
+    return _pool
+
+def stop():
+    global _pool
+    _pool_lock.acquire()
+    try:
+        if None != _pool:
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+    finally:
+        _pool_lock.release()
+
+def _get_coast_cache(aoi):
+    key = `aoi`
+    if key in _coast_caches:
+        return _coast_caches[key]
+    from coastline_ck import coastline_cache_from_aoi
+    ccache = None
+    try:
+        ccache = coastline_cache_from_aoi(IE_30KM_SHPFILE, None, aoi)
+    except Exception as e:
+        logger.error("NOT checking coastline due to Error initialising "+
+                     "coastline:\n"+`e`)
+    _coast_caches[key] = ccache
+    return ccache
+
+def eval_batch(args):
+    """ Runs in the pool worker processes.
+        args is a tuple (batch, params, aoi_toi, wcs_type, md_src),
+        batch is a list of (coverage_id, cd_xml_string).
+        Returns a tuple (accepted_coverage_ids, failed_conditions).
+        An error in the evaluation is raised again in the parent (by
+        Pool.imap) as an IngestionError naming the coverage, as in the
+        serial evaluation, which does not catch it either.
+    """
+    # imported here to avoid a circular import with ingestion_logic
+    from ingestion_logic import evaluate_cd, should_check_coastline
+    batch, params, aoi_toi, wcs_type, md_src = args
+    ccache = None
+    if should_check_coastline(params):
+        ccache = _get_coast_cache(aoi_toi[0])
+    accepted = []
+    failed = set()
+    for coverage_id, cd_str in batch:
+        try:
+            cd = xml_fromstring(cd_str)
+            if evaluate_cd(cd, coverage_id, params, aoi_toi,
+                           ccache, wcs_type, md_src, failed):
+                accepted.append(coverage_id)
+        except Exception as e:
+            # the original exception may not survive the pickling
+            raise IngestionError("Error evaluating metadata for coverage '" +
+                                 coverage_id + "': " + `e`)
+    return accepted, failed
+
+def evaluate_cds(candidates, params, aoi_toi, wcs_type, md_src, failed,
+                 stop_check=None):
+    """ Evaluates the list of (coverage_id, cd) pairs in the process pool,
+        returns the list of coverage ids that passed, in the original
+        order. The names of failed conditions are added to 'failed'.
+        stop_check is called between batches, if it returns True a
+        StopRequest is raised.
+    """
+    pool = start()
+    batches = []
+    for i in range(0, len(candidates), IE_MD_EVAL_BATCH):
+        batch = [ (cid, xml_tostring(cd))
+                  for cid, cd in candidates[i:i+IE_MD_EVAL_BATCH] ]
+        batches.append( (batch, params, aoi_toi, wcs_type, md_src) )
+
+    if IE_DEBUG > 1:
+        logger.debug("Evaluating " + `len(candidates)` +
+                     " coverage descriptions in " + `len(batches)` +
+                     " batches")
+
+    accepted = []
+    results = pool.imap(eval_batch, batches)
+    for r in results:
+        if None != stop_check and stop_check():
+            raise StopRequest("Stop Request")
+        accepted.extend(r[0])
+        failed.update(r[1])
+    return accepted
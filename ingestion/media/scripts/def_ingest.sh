@@ -6,6 +6,7 @@
 #
 # usage:
 # $0 manifest-file [-catreg=script]
+# $0 -batch=manifest-list -response=response-file [-catreg=script]
 #
 #  The script should exit with a 0 status to indicate
 # success; a non-zero status indicates failure.
@@ -25,7 +26,41 @@
 #    METADATA="/path/p_scid0_001/ows.meta"
 #    DATA="/path/p_scid0_001/p1.tif"
 #
+# Batch mode: the script declares that it understands the
+# batch protocol by the marker line below.  The Ingestion
+# Engine then invokes it once for a batch of products:
+# the manifest-list contains the names of the manifest
+# files, one per line.  For each of them the script writes
+# the line
+#     <status> <manifest-file>
+# to the response-file, status 0 means success.  Products
+# missing in the response-file are treated as failed.
 #
+# IE-BATCH-PROTOCOL: 1
+#
+
+ingest_one()
+{
+    echo arg: $1
+    echo "arg1 contains:"
+    cat $1
+
+    status=0
+    if [[ -n $catregscript ]]
+    then
+        if [[ -f $catregscript ]] ; then
+            echo "Ing. script: Running catalogue registration script."
+            $catregscript $1
+            cat_reg_status=$?
+            echo 'cat. reg. script exited with ' $cat_reg_status
+            if [ $cat_reg_status != 0 ] ; then status=$cat_reg_status; fi
+        else
+            echo "Ing. script: did not find an executable cat. reg. script ."
+            status=3
+        fi
+    fi
+    return $status
+}
 
 echo "Default Ingestion script started."
 
@@ -36,27 +71,45 @@ then
 fi
 
 ex_status=0
+batchfile=''
+responsefile=''
+manifest=''
+catregscript=''
 
-echo arg: $1
-echo "arg1 contains:"
-cat $1
+for arg in "$@"
+do
+    case $arg in
+        -batch=*)    batchfile=${arg:7} ;;
+        -response=*) responsefile=${arg:10} ;;
+        -catreg=*)
+            echo $arg
+            echo "Ing. script: Catalogue registration requested."
+            catregscript=${arg:8}
+            echo "catregscript: " $catregscript
+            ;;
+        *)           manifest=$arg ;;
+    esac
+done
 
-if [[ $2 == -catreg=* ]]
+if [[ -n $batchfile ]]
 then
-    echo $2
-    echo "Ing. script: Catalogue registration requested."
-    catregscript=${2:8}
-    echo "catregscript: " $catregscript
-    if [[ -f $catregscript ]] ; then
-        echo "Ing. script: Running catalogue registration script."
-        $catregscript $1
-        cat_reg_status=$?
-        echo 'cat. reg. script exited with ' $cat_reg_status
-        if [ $cat_reg_status != 0 ] ; then ex_status=$cat_reg_status; fi
-    else
-        echo "Ing. script: did not find an executable cat. reg. script ."
-        ex_status=3
+    if [[ -z $responsefile ]]
+    then
+        echo "Missing -response= for -batch, exiting with status 1."
+        exit 1
     fi
+    : > $responsefile
+    while read mf
+    do
+        [[ -z $mf ]] && continue
+        ingest_one $mf < /dev/null
+        st=$?
+        echo $st $mf >> $responsefile
+        if [ $st != 0 ] ; then ex_status=$st; fi
+    done < $batchfile
+else
+    ingest_one $manifest
+    ex_status=$?
 fi
 
 echo "Default Ingestion script finishing with status " $ex_status
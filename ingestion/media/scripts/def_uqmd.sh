@@ -7,8 +7,16 @@
 #
 # usage:
 # $0   [ -add | -replace ]  <ProductID>  <metadatafile>
-#    
+# $0   -batch=<listfile> -response=<responsefile>
+#
 #  metadatafile is a full pathname.
+#  The -batch form is used by the operation updateMDBatch, each line
+#  of listfile is
+#     <add|replace> <ProductID> <metadatafile>
+#  For each product the script writes the line
+#     <status> <ProductID>
+#  to responsefile, status 0 means the product was updated.  Products
+#  missing in responsefile are treated as failed.
 #
 # The script should exit with status 0 if all went well
 # and non-zero otherwise.  The expected range of error
@@ -18,29 +26,73 @@
 echo "Update MetaData script started on" $(date)
 echo args: $*
 
-if [[ $# < 3 ]]
+update_md()
+{
+    # $1: -add or -replace, $2: ProductID, $3: metadatafile
+    if [[ $1 == '-add' ]]
+    then
+        echo "action=add"
+    elif [[ $1 == '-replace' ]]
+    then
+        echo "action=replace"
+    else
+        echo '***bad action: ' $1
+        return 1
+    fi
+
+    if [[ ! -f $3 ]]
+    then
+        echo "No file: " $3
+        return 3
+    fi
+    return 0
+}
+
+if [[ ${1:0:7} == '-batch=' ]]
 then
-    echo "Not enough args, exiting with status 5."
-    exit 5
+    listfile=${1:7}
+    responsefile=${2:10}
+    if [[ ${2:0:10} != '-response=' || -z $responsefile ]]
+    then
+        echo "Missing -response= for -batch, exiting with status 5."
+        exit 5
+    fi
+    if [[ ! -f $listfile ]]
+    then
+        echo "No list file: " $listfile
+        echo "exiting with status 3"
+        exit 3
+    fi
+    : > $responsefile
+    status=0
+    while read action prod_id md_file
+    do
+        [[ -z $prod_id ]] && continue
+        update_md "-$action" "$prod_id" "$md_file" < /dev/null
+        st=$?
+        echo $st $prod_id >> $responsefile
+        if [[ $st != 0 ]]
+        then
+            echo "product $prod_id failed with status $st"
+            status=$st
+        fi
+    done < $listfile
+    echo "test uqmd batch finishing with status $status."
+    exit $status
 fi
 
-if [[ $1 == '-add' ]]
-then
-    echo "action=add" 
-elif [[ $1 == '-replace' ]]
+if [[ $# < 3 ]]
 then
-    echo "action=replace" 
-else
-    echo '***bad action: ' $1
-    echo "exiting with status 1"
-    exit 1
+    echo "Not enough args, exiting with status 5."
+    exit 5
 fi
 
-if [[ ! -f $3 ]]
+update_md $1 $2 $3
+status=$?
+if [[ $status != 0 ]]
 then
-    echo "No file: " $3
-    echo echo "exiting with status 3"
-    exit 3
+    echo "exiting with status $status"
+    exit $status
 fi
 
 echo "test uqmd finishing with status 0."
@@ -0,0 +1,194 @@
+############################################################
+#  Project: DREAM
+#
+#  Module:  Task 5 ODA Ingestion Engine
+#
+#    (c) 2014 Siemens Convergence Creators s.r.o., Prague
+#    Licensed under the 'DREAM ODA Ingestion Engine Open License'
+#     (see the file 'LICENSE' in the top-level directory)
+#
+#  Ingestion Engine: streaming reader for multipart (MIME) bodies.
+#   The parts are read one after the other from a stream in blocks of
+#   BLOCK_SZ, and the body of a part is passed on in blocks, so a large
+#   part can be written to a file without holding the request in
+#   memory.  Lines may end with CRLF or LF (the email module uses LF).
+#   The boundary is taken from the Content-Type of the request, or
+#   from MIME headers at the start of the body, as sent by clients
+#   posting email.mime messages.
+#
+#  used by uqmd
+#
+############################################################
+
+BLOCK_SZ = 65536
+MAX_HEADER_LINE = 8192
+MAX_HEADERS = 100
+
+class MultipartError(Exception):
+    pass
+
+def parse_content_type(value):
+    """ Returns (maintype, subtype, params) of a Content-Type header
+        value, in lower case except for the parameter values.
+    """
+    parts = value.split(";")
+    mtype = parts[0].strip().lower()
+    if "/" in mtype:
+        main, sub = mtype.split("/", 1)
+    else:
+        main, sub = mtype, ""
+    params = {}
+    for p in parts[1:]:
+        if "=" not in p: continue
+        k, v = p.split("=", 1)
+        params[k.strip().lower()] = v.strip().strip('"')
+    return main, sub, params
+
+class MultipartReader:
+    """ Usage:
+          while True:
+              headers = reader.next_part()
+              if None == headers: break
+              reader.copy_part(fp.write)    # or data = reader.read_part()
+        headers is a dict with lower case names.  The body of a part
+        that is not read is skipped.
+    """
+    def __init__(self, stream, length=None):
+        # length: number of bytes to read from stream, None to read
+        # until the end of the stream
+        self._stream  = stream
+        self._left    = length
+        self._delim   = None
+        # a boundary at the very start of the body has no line end before it
+        self._buf     = "\n"
+        self._in_body = True
+        self._done    = False
+
+    def set_boundary(self, boundary):
+        self._delim = "\n--" + boundary
+
+    def _fill(self):
+        # appends a block to the buffer, False at the end of the stream
+        n = BLOCK_SZ
+        if None != self._left:
+            n = min(n, self._left)
+            if n <= 0: return False
+        data = self._stream.read(n)
+        if not data:
+            return False
+        if None != self._left:
+            self._left -= len(data)
+        self._buf += data
+        return True
+
+    def _read_line(self):
+        while True:
+            i = self._buf.find("\n", 1)
+            if i >= 0:
+                line = self._buf[1:i+1]
+                self._buf = self._buf[i:]
+                return line
+            if len(self._buf) > MAX_HEADER_LINE:
+                raise MultipartError("Header line too long")
+            if not self._fill():
+                line = self._buf[1:]
+                self._buf = "\n"
+                return line
+
+    def read_headers(self):
+        """ Reads header lines up to an empty line, returns a dict. """
+        headers = {}
+        name = None
+        while True:
+            line = self._read_line()
+            if not line:
+                raise MultipartError("Unexpected end of the headers")
+            line = line.rstrip("\r\n")
+            if not line:
+                return headers
+            if len(headers) > MAX_HEADERS:
+                raise MultipartError("Too many headers")
+            if line[0] in " \t" and None != name:
+                # folded header
+                headers[name] += " " + line.strip()
+                continue
+            if ":" not in line:
+                raise MultipartError("Bad header line: " + `line[:80]`)
+            name, value = line.split(":", 1)
+            name = name.strip().lower()
+            headers[name] = value.strip()
+
+    def _copy_to_delim(self, write):
+        # passes the data up to the next boundary to write (if not
+        # None), and leaves the buffer after the boundary
+        keep = len(self._delim) + 1
+        # the buffer starts with the line end before the data
+        start = 1
+        while True:
+            i = self._buf.find(self._delim)
+            if i >= 0:
+                data = self._buf[start:i]
+                if data.endswith("\r"): data = data[:-1]
+                if None != write and data: write(data)
+                self._buf = self._buf[i + len(self._delim):]
+                return
+            # the end of the buffer may be the start of the boundary
+            if len(self._buf) > keep:
+                if None != write: write(self._buf[start:-keep])
+                self._buf = self._buf[-keep:]
+                start = 0
+            if not self._fill():
+                raise MultipartError("Closing boundary not found")
+
+    def next_part(self):
+        """ Returns the headers of the next part, None after the last. """
+        if None == self._delim:
+            raise MultipartError("No boundary")
+        if self._done:
+            return None
+        if self._in_body:
+            self._copy_to_delim(None)
+        while len(self._buf) < 2 and self._fill():
+            pass
+        if self._buf.startswith("--"):
+            self._done = True
+            return None
+        # the rest of the boundary line
+        self._buf = "\n" + self._buf
+        self._read_line()
+        headers = self.read_headers()
+        self._in_body = True
+        return headers
+
+    def copy_part(self, write):
+        """ Passes the body of the current part to write() in blocks. """
+        self._copy_to_delim(write)
+        self._in_body = False
+
+    def read_part(self, max_size):
+        """ Returns the body of the current part, at most max_size bytes. """
+        data = []
+        size = [0]
+        def append(d):
+            size[0] += len(d)
+            if size[0] > max_size:
+                raise MultipartError("Part larger than %d bytes" % max_size)
+            data.append(d)
+        self.copy_part(append)
+        return "".join(data)
+
+def open_multipart(stream, content_type, length=None):
+    """ Returns a MultipartReader for the body in stream; content_type
+        is the Content-Type of the request.
+    """
+    reader = MultipartReader(stream, length)
+    main, sub, params = parse_content_type(content_type or "")
+    if main != "multipart" or not params.get("boundary"):
+        # the MIME headers are at the start of the body
+        headers = reader.read_headers()
+        main, sub, params = \
+            parse_content_type(headers.get("content-type", ""))
+    if main != "multipart" or not params.get("boundary"):
+        raise MultipartError("Not a multipart message")
+    reader.set_boundary(params["boundary"])
+    return reader
@@ -16,6 +16,8 @@
 import os
 import random
 import datetime
+import hashlib
+import struct
 
 import logging
 from django.db import models
@@ -160,11 +162,16 @@ def date_from_iso8601(src_str):
         a = datetime.datetime.strptime(src_str, TIME_FORMAT_8601)
     return a
 
+# related sets read by scenario_dict, for prefetch_related
+SCENARIO_DICT_RELATED = ('extraconditions_set', 'eoid_set')
+
 def scenario_dict(db_model):
     """ creates a dictionary from a database model record,
         using selected fields. Converts some fields into
         a more structured representation: e.g. a bbox is
         built up from individual database fields.
+        The related sets are read with all(), so that they come
+        from the cache if SCENARIO_DICT_RELATED were prefetched.
     """
     response_data = {}
     for s in ( EXT_GET_SCENARIO_KEYS ):
@@ -195,9 +202,9 @@ def scenario_dict(db_model):
     response_data['extraconditions'] = extras_list
 
     dssids = []
-    dss_set = db_model.eoid_set.filter(selected=True)
-    for dssid in dss_set:
-        dssids.append(dssid.eoid_val.encode('ascii','ignore'))
+    for dssid in db_model.eoid_set.all():
+        if dssid.selected:
+            dssids.append(dssid.eoid_val.encode('ascii','ignore'))
     response_data['dssids'] = dssids
 
     # Forebugging: ignore the archive_check so that we can
@@ -264,10 +271,23 @@ class Scenario(models.Model):
 #  used to avoid re-downloading what we already have.*
 #  Stores just the EOID.                             *
 #*****************************************************
+def eoid_hash(eoid):
+    # 64-bit hash of the eoid, stored in Archive.eoid_hash; the
+    # composite index (scenario_id, eoid_hash) is created by
+    # sql/archive.sql, or by darc.upgrade_archive_table for older dbs.
+    if isinstance(eoid, unicode):
+        eoid = eoid.encode('utf-8')
+    return struct.unpack("<q", hashlib.sha1(eoid).digest()[:8])[0]
+
 class Archive(models.Model):
     id           = models.AutoField(primary_key=True)
     scenario     = models.ForeignKey(Scenario)
     eoid         = models.CharField(max_length=2048)
+    eoid_hash    = models.BigIntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        self.eoid_hash = eoid_hash(self.eoid)
+        super(Archive, self).save(*args, **kwargs)
 
 
 #**************************************************
@@ -317,6 +337,24 @@ class ProductInfo(models.Model):
     product_url    = models.CharField(max_length=4096)
 
 
+#**************************************************
+#              Local Batch                        *
+#  Used for the batch local ingestion             *
+#**************************************************
+class LocalBatch(models.Model):
+    id           = models.AutoField(primary_key=True)
+    ncn_id       = models.CharField(max_length=NCN_ID_LEN)
+    info_status  = models.CharField(max_length=50) # processing, success, ...
+    info_date    = models.DateTimeField()
+    n_products   = models.IntegerField()
+    n_done       = models.IntegerField(default=0)
+    n_failed     = models.IntegerField(default=0)
+    n_bytes      = models.BigIntegerField(default=0)
+    elapsed      = models.FloatField(default=0.0)   # seconds
+    # json list of per-product results, see local_batch.py
+    results      = models.TextField(default="[]")
+
+
 
 #**************************************************
 #                 User Script                     *
@@ -0,0 +1,335 @@
+############################################################
+#  Project: DREAM
+#
+#  Module:  Task 5 ODA Ingestion Engine
+#
+#    (c) 2014 Siemens Convergence Creators s.r.o., Prague
+#    Licensed under the 'DREAM ODA Ingestion Engine Open License'
+#     (see the file 'LICENSE' in the top-level directory)
+#
+#  Ingestion Engine: uploads of local products.
+#   ProductDirUploadHandler is a Django upload handler which writes the
+#   product files of a multipart form straight into the product
+#   directory, and computes their checksum on the way, instead of
+#   Django buffering them in memory or a temporary file first.
+#
+#   Resumable uploads: the client announces the files and their sizes
+#   (start_upload), sends each file in any number of pieces, each one
+#   appended at the given offset (write_chunk), and finally asks for
+#   the product to be ingested (finish_upload).  After a failure the
+#   client asks for the sizes received so far (upload_status) and
+#   continues from there.  The state of an upload is kept in a json
+#   file in the upload state directory, so uploads can also be resumed
+#   after a restart of the IE.
+#
+#  used by views
+#
+############################################################
+
+import os
+import time
+import json
+import uuid
+import shutil
+import logging
+import threading
+
+from django.core.files.uploadhandler import \
+    FileUploadHandler, \
+    StopFutureHandlers
+from django.core.files.uploadedfile import UploadedFile
+
+from utils import \
+    new_checksum, \
+    record_checksum, \
+    CHECKSUM_BLK_SZ
+
+logger = logging.getLogger('dream.file_logger')
+
+STATE_SUFFIX = ".json"
+
+class UploadError(Exception):
+    pass
+
+class UploadOffsetError(UploadError):
+    """ The offset of a chunk is not the size received so far. """
+    def __init__(self, msg, received):
+        UploadError.__init__(self, msg)
+        self.received = received
+
+def safe_file_name(file_name):
+    # the product file is written into the product dir under this name
+    name = os.path.basename(file_name.replace("\\", "/"))
+    if not name or name.startswith("."):
+        raise UploadError("Bad file name: " + `file_name`)
+    return name.encode('ascii','ignore')
+
+#----------------------------------------------------------------------
+#  Upload handler for the add-local-product forms
+
+class ProductFile(UploadedFile):
+    """ A product file that was written into the product dir by the
+        ProductDirUploadHandler.  hexdigest is its checksum, or None.
+    """
+    def __init__(self, path, name, content_type, size, charset, hexdigest):
+        UploadedFile.__init__(self, open(path, "rb"), name,
+                              content_type, size, charset)
+        self.path = path
+        self.hexdigest = hexdigest
+
+    def temporary_file_path(self):
+        return self.path
+
+class ProductDirUploadHandler(FileUploadHandler):
+    """ Writes the files of the form fields in fields into the directory
+        returned by mk_dir(), which is called at the first file.  Other
+        files are left to the next upload handlers.
+        After the form was read, dir_path is the directory, or None if
+        there was no product file.
+    """
+    def __init__(self, mk_dir, fields, checksum_algo, request=None):
+        FileUploadHandler.__init__(self, request)
+        self._mk_dir   = mk_dir
+        self._fields   = fields
+        self._algo     = checksum_algo
+        self._fp       = None
+        self._ck       = None
+        self._path     = None
+        self.dir_path  = None
+
+    def new_file(self, field_name, file_name, content_type,
+                 content_length, charset=None):
+        self._fp = None
+        if field_name not in self._fields:
+            return
+        FileUploadHandler.new_file(self, field_name, file_name,
+                                   content_type, content_length, charset)
+        if None == self.dir_path:
+            self.dir_path = self._mk_dir()
+        self._name = safe_file_name(file_name)
+        self._path = os.path.join(self.dir_path, self._name)
+        logger.info('Saving file: ' + self._path)
+        self._fp = open(self._path, "wb")
+        self._ck = new_checksum(self._algo)
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if None == self._fp:
+            return raw_data
+        if self._ck: self._ck.update(raw_data)
+        self._fp.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if None == self._fp:
+            return None
+        self._fp.close()
+        self._fp = None
+        hexdigest = None
+        if self._ck:
+            hexdigest = self._ck.hexdigest()
+            record_checksum(self.dir_path, self._name, self._algo, hexdigest)
+        return ProductFile(self._path, self._name, self.content_type,
+                           file_size, self.charset, hexdigest)
+
+    def upload_complete(self):
+        # the request ended while a file was being received
+        if None != self._fp:
+            self._fp.close()
+            self._fp = None
+
+#----------------------------------------------------------------------
+#  Resumable uploads
+
+# checksums of the files being uploaded, key is (upload_id, path),
+# value is [size hashed, checksum object]
+_checksums = {}
+_lock = threading.Lock()
+# one lock per upload, so that chunks of one upload are written in turn
+_upload_locks = {}
+
+def _state_fn(state_dir, upload_id):
+    if not upload_id.isalnum():
+        raise UploadError("Bad upload id: " + `upload_id`)
+    return os.path.join(state_dir, upload_id + STATE_SUFFIX)
+
+def _save_state(state_dir, state):
+    fn = _state_fn(state_dir, state["id"])
+    fp = open(fn + ".tmp", "w")
+    json.dump(state, fp)
+    fp.close()
+    os.rename(fn + ".tmp", fn)
+
+def _upload_lock(upload_id):
+    _lock.acquire()
+    try:
+        lock = _upload_locks.get(upload_id)
+        if None == lock:
+            lock = threading.Lock()
+            _upload_locks[upload_id] = lock
+        return lock
+    finally:
+        _lock.release()
+
+def _forget(upload_id):
+    _lock.acquire()
+    try:
+        _upload_locks.pop(upload_id, None)
+        for k in _checksums.keys():
+            if k[0] == upload_id: del _checksums[k]
+    finally:
+        _lock.release()
+
+def purge_uploads(state_dir, max_age):
+    """ Removes uploads not finished within max_age days, and their
+        product dirs.
+    """
+    if not os.path.isdir(state_dir):
+        return
+    t_limit = time.time() - max_age*24*3600
+    for fn in os.listdir(state_dir):
+        if not fn.endswith(STATE_SUFFIX): continue
+        path = os.path.join(state_dir, fn)
+        try:
+            if os.path.getmtime(path) > t_limit: continue
+            state = json.load(open(path, "r"))
+            logger.info("Removing unfinished upload " + `state["id"]` +
+                        ", ncn_id=" + `state["ncn_id"]`)
+            shutil.rmtree(state["dir"], ignore_errors=True)
+            os.unlink(path)
+            _forget(state["id"])
+        except Exception as e:
+            logger.warning("Cannot purge upload " + fn + ": " + `e`)
+
+def start_upload(state_dir, ncn_id, dir_path, files):
+    """ Registers a new upload into dir_path.  files is a dict
+        {file name: size}.  Returns the upload id.
+    """
+    if not files:
+        raise UploadError("No files to upload")
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    sizes = {}
+    for name, size in files.items():
+        sizes[safe_file_name(name)] = int(size)
+    state = {"id"     : uuid.uuid4().hex,
+             "ncn_id" : ncn_id,
+             "dir"    : dir_path,
+             "files"  : sizes,
+             "t"      : time.time()}
+    for name in sizes:
+        open(os.path.join(dir_path, name), "wb").close()
+    _save_state(state_dir, state)
+    return state["id"]
+
+def load_upload(state_dir, upload_id):
+    fn = _state_fn(state_dir, upload_id)
+    if not os.path.exists(fn):
+        raise UploadError("No such upload: " + `upload_id`)
+    fp = open(fn, "r")
+    try:
+        state = json.load(fp)
+    finally:
+        fp.close()
+    state["dir"] = state["dir"].encode('ascii','ignore')
+    return state
+
+def upload_status(state):
+    """ Returns {file name: size received so far}. """
+    received = {}
+    for name in state["files"]:
+        received[name] = os.path.getsize(os.path.join(state["dir"], name))
+    return received
+
+def _get_checksum(upload_id, path, size, algo):
+    # returns the checksum object for the first size bytes of path;
+    # after a restart the part already received is hashed again
+    key = (upload_id, path)
+    _lock.acquire()
+    try:
+        entry = _checksums.get(key)
+    finally:
+        _lock.release()
+    if None != entry and entry[0] == size:
+        return entry
+    ck = new_checksum(algo)
+    if None != ck and size > 0:
+        fp = open(path, "rb")
+        try:
+            n = 0
+            while n < size:
+                buff = fp.read(min(CHECKSUM_BLK_SZ, size - n))
+                if not buff: break
+                ck.update(buff)
+                n += len(buff)
+        finally:
+            fp.close()
+    entry = [size, ck]
+    _lock.acquire()
+    try:
+        _checksums[key] = entry
+    finally:
+        _lock.release()
+    return entry
+
+def write_chunk(state, name, offset, stream, length, algo):
+    """ Appends length bytes read from stream to the file name of the
+        upload; offset must be the size received so far.
+        Returns the new size.
+    """
+    if name not in state["files"]:
+        raise UploadError("File not in the upload: " + `name`)
+    path = os.path.join(state["dir"], name)
+    lock = _upload_lock(state["id"])
+    lock.acquire()
+    try:
+        received = os.path.getsize(path)
+        if offset != received:
+            raise UploadOffsetError(
+                "Offset %d does not match the size received, %d" %
+                (offset, received), received)
+        if received + length > state["files"][name]:
+            raise UploadError("Chunk beyond the end of " + `name`)
+        entry = _get_checksum(state["id"], path, received, algo)
+        fp = open(path, "ab")
+        try:
+            n = 0
+            while n < length:
+                buff = stream.read(min(CHECKSUM_BLK_SZ, length - n))
+                if not buff: break
+                fp.write(buff)
+                if entry[1]: entry[1].update(buff)
+                n += len(buff)
+        finally:
+            fp.close()
+        entry[0] = received + n
+        if n < length:
+            raise UploadOffsetError("Incomplete chunk", received + n)
+        return received + n
+    finally:
+        lock.release()
+
+def finish_upload(state_dir, state, algo):
+    """ Checks that all files are complete, records their checksums and
+        removes the upload state.  Returns the product dir.
+    """
+    lock = _upload_lock(state["id"])
+    lock.acquire()
+    try:
+        received = upload_status(state)
+        for name, size in state["files"].items():
+            if received[name] != size:
+                raise UploadOffsetError(
+                    "Upload of %s is not complete: %d of %d bytes" %
+                    (name, received[name], size), received[name])
+        for name, size in state["files"].items():
+            path = os.path.join(state["dir"], name)
+            entry = _get_checksum(state["id"], path, size, algo)
+            if entry[1]:
+                record_checksum(state["dir"], name, algo,
+                                entry[1].hexdigest())
+        os.unlink(_state_fn(state_dir, state["id"]))
+    finally:
+        lock.release()
+    _forget(state["id"])
+    return state["dir"]
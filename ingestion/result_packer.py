@@ -0,0 +1,180 @@
+############################################################
+#  Project: DREAM
+#
+#  Module:  Task 5 ODA Ingestion Engine
+#
+#    (c) 2014 Siemens Convergence Creators s.r.o., Prague
+#    Licensed under the 'DREAM ODA Ingestion Engine Open License'
+#     (see the file 'LICENSE' in the top-level directory)
+#
+#  Ingestion Engine: built-in replacement for the tar_result script.
+#   The product directories are appended to the tar file as soon as
+#   each product has been post-processed, in a separate thread.
+#   The tar stream is compressed in blocks by a pool of threads
+#   (zlib releases the GIL), each block becomes one gzip member;
+#   a sequence of gzip members is a valid gzip file, so the result
+#   can be read by 'tar -xzf' just like the output of the script.
+#   The tar file contains the download dir itself as the top-level
+#   directory, as 'tar -czf dl_dir.tgz dl_dir' does.
+#
+#  used by work_flow_manager
+#
+############################################################
+
+import os
+import time
+import zlib
+import struct
+import tarfile
+import logging
+import threading
+import Queue
+import collections
+from multiprocessing.pool import ThreadPool
+
+from settings import IE_DEBUG
+
+logger = logging.getLogger('dream.file_logger')
+
+PART_SUFFIX = ".part"
+
+def gzip_member(data, level):
+    """ Compresses data into a complete gzip member (RFC 1952). """
+    co = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                          zlib.DEF_MEM_LEVEL, 0)
+    body = co.compress(data) + co.flush()
+    header = "\037\213\010\000" + struct.pack("<L", 0) + "\000\377"
+    trailer = struct.pack("<LL",
+                          zlib.crc32(data) & 0xffffffffL,
+                          len(data) & 0xffffffffL)
+    return header + body + trailer
+
+class ParallelGzipWriter:
+    """ File-like object (write/close only), compresses what is written
+        to it in blocks of block_size using n_threads threads, and writes
+        the resulting gzip members to fp in the original order.
+    """
+    def __init__(self, fp, n_threads, block_size, level=6):
+        self._fp         = fp
+        self._block_size = block_size
+        self._level      = level
+        self._pool       = ThreadPool(n_threads)
+        self._max_queued = 2 * n_threads
+        self._queued     = collections.deque()
+        self._buf        = []
+        self._buf_len    = 0
+
+    def _submit(self, data):
+        self._queued.append(
+            self._pool.apply_async(gzip_member, (data, self._level)))
+        # keep the memory bounded: wait for the oldest blocks
+        while len(self._queued) > self._max_queued:
+            self._fp.write(self._queued.popleft().get())
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buf_len += len(data)
+        if self._buf_len >= self._block_size:
+            data = "".join(self._buf)
+            n = len(data) - (len(data) % self._block_size)
+            for i in range(0, n, self._block_size):
+                self._submit(data[i:i+self._block_size])
+            self._buf = [data[n:]]
+            self._buf_len = len(data) - n
+
+    def close(self):
+        try:
+            if self._buf_len > 0:
+                self._submit("".join(self._buf))
+                self._buf = []
+                self._buf_len = 0
+            while self._queued:
+                self._fp.write(self._queued.popleft().get())
+        finally:
+            self._pool.close()
+            self._pool.join()
+
+    def abort(self):
+        self._pool.terminate()
+        self._pool.join()
+
+class ResultPacker(threading.Thread):
+    """ Packs the product directories of dl_dir into out_fn.
+        add_dir() queues a product dir, finish() adds everything in
+        dl_dir that was not added yet and completes the file.
+    """
+    def __init__(self, dl_dir, out_fn, n_threads, block_size, level=6):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._dl_dir  = dl_dir.rstrip(os.sep)
+        self._top     = os.path.basename(self._dl_dir)
+        self._out_fn  = out_fn
+        self._queue   = Queue.Queue()
+        self._added   = set()
+        self._top_added = False
+        self._error   = None
+        self._fp      = open(out_fn + PART_SUFFIX, "wb")
+        self._gz      = ParallelGzipWriter(self._fp, n_threads,
+                                           block_size, level)
+        self._tar     = tarfile.open(fileobj=self._gz, mode="w|")
+        self._t_start = time.time()
+        self.start()
+
+    def add_dir(self, d):
+        self._queue.put(d)
+
+    def run(self):
+        while True:
+            d = self._queue.get()
+            if None == d: break
+            if None != self._error or d in self._added: continue
+            self._added.add(d)
+            try:
+                if not self._top_added:
+                    self._top_added = True
+                    self._tar.add(self._dl_dir, self._top, recursive=False)
+                self._tar.add(os.path.join(self._dl_dir, d),
+                              os.path.join(self._top, d))
+            except Exception as e:
+                self._error = e
+                logger.error("Error adding " + d + " to " + self._out_fn +
+                             ": " + `e`)
+
+    def finish(self):
+        """ Returns True if the tar file was written successfully. """
+        for d in sorted(os.listdir(self._dl_dir)):
+            self.add_dir(d)
+        self._queue.put(None)
+        self.join()
+        if None != self._error:
+            self.abort()
+            return False
+        try:
+            if not self._top_added:
+                # empty download dir
+                self._top_added = True
+                self._tar.add(self._dl_dir, self._top, recursive=False)
+            self._tar.close()
+            self._gz.close()
+            self._fp.close()
+            os.rename(self._out_fn + PART_SUFFIX, self._out_fn)
+        except Exception as e:
+            logger.error("Error writing " + self._out_fn + ": " + `e`)
+            self.abort()
+            return False
+        if IE_DEBUG > 0:
+            logger.debug("Packed %d entries into %s in %.1f s" %
+                         (len(self._added), self._out_fn,
+                          time.time() - self._t_start))
+        return True
+
+    def abort(self):
+        """ Stops packing and removes the partial file. """
+        if self.is_alive():
+            self._error = self._error or "aborted"
+            self._queue.put(None)
+            self.join()
+        self._gz.abort()
+        self._fp.close()
+        if os.path.exists(self._out_fn + PART_SUFFIX):
+            os.unlink(self._out_fn + PART_SUFFIX)
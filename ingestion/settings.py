@@ -16,6 +16,7 @@ import os
 import sys
 import logging
 import json
+import hashlib
 
 DEBUG = True
 TEMPLATE_DEBUG = False
@@ -121,6 +122,243 @@ if "ie_server_port" in config:
 else:
     IE_SERVER_PORT = '8000'
 
+# Optional process pool for evaluating the product metadata
+# (CoverageDescriptions) against the scenario criteria.  The xml
+# parsing, coordinate transformations and the coastline check are
+# CPU-bound, in the work-flow worker threads they are serialised by
+# the GIL.  The number of processes is independent of
+# IE_N_WORKFLOW_WORKERS; 0 disables the pool and the evaluation is
+# then done by the worker threads themselves.
+if "MD_EvalProcesses" in config:
+    IE_MD_EVAL_PROCESSES = int(config["MD_EvalProcesses"])
+else:
+    IE_MD_EVAL_PROCESSES = 0
+
+# Number of CoverageDescriptions sent to a process in one batch
+IE_MD_EVAL_BATCH = 32
+
+# Max. size in bytes of responses read from the Download Manager
+# (DAR status, download requests) and from the Product Facilities
+# (Capabilities, EO Coverage Set descriptions); 0 for unlimited.
+if "DM_ResponseMaxSize" in config:
+    IE_DM_RESPONSE_MAX_SIZE = int(config["DM_ResponseMaxSize"])
+else:
+    IE_DM_RESPONSE_MAX_SIZE = 64*1024*1024
+
+if "PF_ResponseMaxSize" in config:
+    IE_PF_RESPONSE_MAX_SIZE = int(config["PF_ResponseMaxSize"])
+else:
+    IE_PF_RESPONSE_MAX_SIZE = 512*1024*1024
+
+# Checksum of the product data, computed while the data is split or
+# copied and written to the MANIFEST as DATA_CHECKSUM_TYPE/DATA_CHECKSUM.
+# Any hashlib algorithm ('sha256', 'sha1', 'md5', ...) or the faster
+# 'crc32' / 'adler32'; '' or 'none' (the default) to disable.
+# Note that with a checksum the split data passes through user space:
+# it is copied via mmap instead of by the kernel (copy_file_range or
+# sendfile).  'crc32' costs little cpu but only detects accidental
+# corruption; 'sha256' is slow (roughly 200-400 MB/s per core).
+if "ChecksumAlgorithm" in config:
+    IE_CHECKSUM_ALGO = config["ChecksumAlgorithm"].encode('ascii','ignore')
+else:
+    IE_CHECKSUM_ALGO = 'none'
+
+if IE_CHECKSUM_ALGO.lower() not in ('', 'none', 'crc32', 'adler32'):
+    try:
+        hashlib.new(IE_CHECKSUM_ALGO.lower())
+    except ValueError:
+        raise Exception("Unsupported ChecksumAlgorithm in config: " +
+                        `IE_CHECKSUM_ALGO`)
+
+# Number of threads copying the files of a local product directory into
+# the product dir, when it cannot be renamed or linked (see
+# utils.relocate).
+if "RelocateThreads" in config:
+    IE_RELOCATE_THREADS = max(1, int(config["RelocateThreads"]))
+else:
+    IE_RELOCATE_THREADS = 4
+
+# addProduct requests with a url that arrive within this many seconds
+# are downloaded by one DAR, at most IE_ADDPROD_BATCH_MAX products per
+# DAR.  A window of 0 submits one DAR per request.
+if "AddProductBatchWindow" in config:
+    IE_ADDPROD_BATCH_WINDOW = float(config["AddProductBatchWindow"])
+else:
+    IE_ADDPROD_BATCH_WINDOW = 2.0
+
+if "AddProductBatchMax" in config:
+    IE_ADDPROD_BATCH_MAX = max(1, int(config["AddProductBatchMax"]))
+else:
+    IE_ADDPROD_BATCH_MAX = 200
+
+# max. seconds to wait for the products of such a DAR, the products
+# not downloaded by then fail
+if "AddProductBatchMaxWait" in config:
+    IE_ADDPROD_BATCH_MAX_WAIT = float(config["AddProductBatchMaxWait"])
+else:
+    IE_ADDPROD_BATCH_MAX_WAIT = 6*3600
+
+# Completion callbacks of addProduct, see callback_dispatcher.py:
+# max. number of callbacks waiting to be sent, number of attempts,
+# and the delay before the first retry in seconds (doubled each time).
+if "CallbackQueueSize" in config:
+    IE_CALLBACK_QUEUE_SIZE = max(1, int(config["CallbackQueueSize"]))
+else:
+    IE_CALLBACK_QUEUE_SIZE = 1000
+
+if "CallbackRetries" in config:
+    IE_CALLBACK_RETRIES = max(1, int(config["CallbackRetries"]))
+else:
+    IE_CALLBACK_RETRIES = 5
+
+if "CallbackRetryDelay" in config:
+    IE_CALLBACK_RETRY_DELAY = float(config["CallbackRetryDelay"])
+else:
+    IE_CALLBACK_RETRY_DELAY = 30.0
+
+# Post-download processing of the product directories of one DAR:
+# number of threads splitting the downloaded products and creating the
+# manifests (i/o bound), and number of threads running the
+# post-ingestion scripts (each for one product, or one batch of products).
+# Both are per work-flow worker; 1 processes the products one by one.
+if "PostProc_SplitThreads" in config:
+    IE_PP_SPLIT_THREADS = max(1, int(config["PostProc_SplitThreads"]))
+else:
+    IE_PP_SPLIT_THREADS = 2
+
+if "PostProc_ScriptThreads" in config:
+    IE_PP_SCRIPT_THREADS = max(1, int(config["PostProc_ScriptThreads"]))
+else:
+    IE_PP_SCRIPT_THREADS = 4
+
+# Number of products of a batch local ingestion processed in parallel
+if "LocalBatchThreads" in config:
+    IE_LOCAL_BATCH_THREADS = max(1, int(config["LocalBatchThreads"]))
+else:
+    IE_LOCAL_BATCH_THREADS = 4
+
+# Max. number of products passed in one invocation of an ingestion
+# script that supports the batch protocol (see def_ingest.sh);
+# other scripts are still run once per product.  1 disables batching.
+if "ScriptBatchSize" in config:
+    IE_SCRIPT_BATCH_SIZE = max(1, int(config["ScriptBatchSize"]))
+else:
+    IE_SCRIPT_BATCH_SIZE = 32
+
+# How often the post-download processing checks for a stop request
+# while waiting for the split/script threads, seconds
+IE_PP_POLL_INTERVAL = 2.0
+
+# The external scripts are started by a small helper process (see
+# spawn_service.py) instead of forking the ingestion engine process.
+# SpawnServicePython is the interpreter for the helper; under mod_wsgi
+# sys.executable is not a python interpreter, by default the python of
+# the same version in sys.exec_prefix is used (see find_python).
+if "SpawnService" in config:
+    IE_SPAWN_SERVICE = bool(config["SpawnService"])
+else:
+    IE_SPAWN_SERVICE = True
+
+if "SpawnServicePython" in config:
+    IE_SPAWN_PYTHON = config["SpawnServicePython"]
+else:
+    IE_SPAWN_PYTHON = None
+
+# Wall-clock time-out for the external scripts in seconds, 0 (the
+# default) for no time-out; a script that times out is killed with its
+# process group and counts as failed.  ScriptTimeouts overrides it for
+# individual scripts, e.g. {"tar_result.sh": 7200, "def_ingest.sh": 600};
+# by default only the long-running tar and S2 pre-processing scripts
+# are bounded.
+# ScriptLimits are resource limits, e.g. {"as": 4294967296, "nofile": 1024}
+# (keys: as, cpu, nofile, fsize, nproc).
+if "ScriptTimeout" in config:
+    IE_SCRIPT_TIMEOUT = int(config["ScriptTimeout"])
+else:
+    IE_SCRIPT_TIMEOUT = 0
+
+if "ScriptTimeouts" in config:
+    IE_SCRIPT_TIMEOUTS = config["ScriptTimeouts"]
+else:
+    IE_SCRIPT_TIMEOUTS = {
+        IE_TAR_RESULT_SCRIPT       : 4*3600,
+        IE_S2ATM_PREPROCESS_SCRIPT : 4*3600,
+        }
+
+if "ScriptLimits" in config:
+    IE_SCRIPT_LIMITS = config["ScriptLimits"]
+else:
+    IE_SCRIPT_LIMITS = {}
+
+# When the 'tar results' flag of a scenario is set, the tar file is
+# written by the built-in packer while the products are processed,
+# compressed by IE_TAR_THREADS threads in blocks of IE_TAR_BLOCK_SZ.
+# Set TarBuiltin to false to run IE_TAR_RESULT_SCRIPT after all the
+# products are done instead.
+if "TarBuiltin" in config:
+    IE_TAR_BUILTIN = bool(config["TarBuiltin"])
+else:
+    IE_TAR_BUILTIN = True
+
+if "TarThreads" in config:
+    IE_TAR_THREADS = max(1, int(config["TarThreads"]))
+else:
+    try:
+        import multiprocessing
+        IE_TAR_THREADS = multiprocessing.cpu_count()
+    except NotImplementedError:
+        IE_TAR_THREADS = 2
+
+IE_TAR_BLOCK_SZ = 1024*1024
+
+# The work-flow manager watchdog reports workers that have been in the
+# same task stage for longer than this, seconds; 0 disables it.
+# Downloads of large DARs may legitimately take hours.
+if "WorkerStuckSecs" in config:
+    IE_WORKER_STUCK_SECS = int(config["WorkerStuckSecs"])
+else:
+    IE_WORKER_STUCK_SECS = 4*3600
+
+# The DARs (lists of urls for the DM) are written to files in this
+# directory, from where the DM retrieves them.  A DAR is removed when
+# the DM reports it in its status; DARs never retrieved by the DM are
+# kept for IE_DAR_STORE_MAX_AGE days.
+if "DarStoreDir" in config:
+    IE_DAR_STORE_DIR = config["DarStoreDir"]
+else:
+    IE_DAR_STORE_DIR = os.path.join(os.path.dirname(PROJECT_DIR), "dar_store")
+
+IE_DAR_STORE_MAX_AGE = 3
+
+# State of resumable local product uploads (see product_upload.py);
+# uploads not finished within IE_UPLOAD_MAX_AGE days are removed.
+if "UploadStateDir" in config:
+    IE_UPLOAD_STATE_DIR = config["UploadStateDir"]
+else:
+    IE_UPLOAD_STATE_DIR = os.path.join(os.path.dirname(PROJECT_DIR), "upload_state")
+
+IE_UPLOAD_MAX_AGE = 3
+
+# Long-poll requests for scenario status changes wait at most this
+# long for a change, seconds.  Should be below the time-outs of
+# proxies between the clients and the IE.
+if "StatusPollTimeout" in config:
+    IE_STATUS_POLL_TIMEOUT = float(config["StatusPollTimeout"])
+else:
+    IE_STATUS_POLL_TIMEOUT = 25.0
+
+# Max. number of Archive records (ids of downloaded products) that are
+# inserted into the db in one transaction
+IE_ARCHIVE_BATCH = 500
+
+# XML parser used by ie_xml_parser: 'etree' (the standard
+# xml.etree.ElementTree), 'lxml', or 'auto', which uses lxml if it is
+# installed.  lxml is faster on large responses but has to be chosen.
+if "XML_Backend" in config:
+    IE_XML_BACKEND = config["XML_Backend"]
+else:
+    IE_XML_BACKEND = 'etree'
+
 # BEAM_HOME for Sentinel-2 pre-processors
 if "BeamHome" in config:
     IE_BEAM_HOME = config["BeamHome"]
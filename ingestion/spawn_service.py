@@ -0,0 +1,400 @@
+############################################################
+#  Project: DREAM
+#
+#  Module:  Task 5 ODA Ingestion Engine
+#
+#    (c) 2014 Siemens Convergence Creators s.r.o., Prague
+#    Licensed under the 'DREAM ODA Ingestion Engine Open License'
+#     (see the file 'LICENSE' in the top-level directory)
+#
+#  Ingestion Engine: spawn service for the external scripts.
+#   Forking the large, multi-threaded mod_wsgi process for every
+#   ingestion/delete/tar/addProduct/updateMD script is slow and
+#   blocks the calling thread.  Instead the scripts are started by a
+#   small helper process (a fresh python interpreter running this
+#   file), which receives the requests over a unix socket, applies
+#   the time-outs and resource limits, and sends back the pid and
+#   the exit status of the script.  The helper also keeps latency
+#   statistics per script, served by the view getScriptStats.
+#   If the helper is not running, call() falls back to subprocess.
+#
+#  used by work_flow_manager, add_product, uqmd, views; started in wsgi.py
+#
+#  Protocol, one JSON object per line:
+#   request:  {"args":[...], "cwd":..., "timeout":secs, "limits":{...}}
+#             {"cmd":"stats"}
+#   replies:  {"pid":n, "spawn_ms":t}         when the script started
+#             {"status":n, "timed_out":bool, "run_ms":t}  when it exited
+#             {"error":"..."}                 if it could not be started
+#
+############################################################
+
+import os
+import sys
+import time
+import json
+import signal
+import socket
+import logging
+import threading
+import subprocess
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger('dream.file_logger')
+
+# resource limits that may be requested, key in the request 'limits'
+RLIMIT_NAMES = {
+    "as"     : "RLIMIT_AS",
+    "cpu"    : "RLIMIT_CPU",
+    "nofile" : "RLIMIT_NOFILE",
+    "fsize"  : "RLIMIT_FSIZE",
+    "nproc"  : "RLIMIT_NPROC",
+    }
+
+# seconds between SIGTERM and SIGKILL for scripts that timed out
+KILL_GRACE = 5.0
+# how often the helper checks running scripts and its parent, seconds
+POLL_INTERVAL = 0.1
+
+#----------------------------------------------------------------------
+#  Helper process (server side)
+
+def _set_limits(limits):
+    # runs in the child between fork and exec; the child gets its own
+    # process group, so that a time-out kills the whole script tree
+    os.setsid()
+    if None == resource: return
+    for name, value in limits.items():
+        rname = RLIMIT_NAMES.get(name)
+        if None == rname or not hasattr(resource, rname): continue
+        value = int(value)
+        resource.setrlimit(getattr(resource, rname), (value, value))
+
+def _kill_group(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except OSError:
+        pass
+
+def _wait(proc, timeout, t_start):
+    # waits for the script; after timeout seconds its process group
+    # is sent SIGTERM, and SIGKILL if it is still there KILL_GRACE
+    # seconds later.  Returns True if the script timed out.
+    timed_out = False
+    killed_at = None
+    while None == proc.poll():
+        now = time.time()
+        if timeout > 0 and not timed_out and now - t_start > timeout:
+            timed_out = True
+            killed_at = now
+            _kill_group(proc, signal.SIGTERM)
+        elif timed_out and now - killed_at > KILL_GRACE:
+            _kill_group(proc, signal.SIGKILL)
+        time.sleep(POLL_INTERVAL)
+    return timed_out
+
+class _ScriptStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def add(self, script, spawn_ms, run_ms, status, timed_out):
+        self._lock.acquire()
+        try:
+            s = self._stats.get(script)
+            if None == s:
+                s = {"count":0, "failed":0, "timed_out":0,
+                     "spawn_ms_total":0.0, "spawn_ms_max":0.0,
+                     "run_ms_total":0.0,   "run_ms_max":0.0}
+                self._stats[script] = s
+            s["count"] += 1
+            if 0 != status:  s["failed"]    += 1
+            if timed_out:    s["timed_out"] += 1
+            s["spawn_ms_total"] += spawn_ms
+            s["run_ms_total"]   += run_ms
+            s["spawn_ms_max"] = max(s["spawn_ms_max"], spawn_ms)
+            s["run_ms_max"]   = max(s["run_ms_max"],   run_ms)
+        finally:
+            self._lock.release()
+
+    def get(self):
+        self._lock.acquire()
+        try:
+            return json.loads(json.dumps(self._stats))
+        finally:
+            self._lock.release()
+
+def _send(fp, obj):
+    fp.write(json.dumps(obj) + "\n")
+    fp.flush()
+
+def _run_request(req, fp, stats):
+    args    = [str(a) for a in req["args"]]
+    timeout = float(req.get("timeout") or 0)
+    limits  = req.get("limits") or {}
+    script  = os.path.basename(args[0])
+
+    t0 = time.time()
+    try:
+        proc = subprocess.Popen(args,
+                                cwd=req.get("cwd"),
+                                close_fds=True,
+                                preexec_fn=lambda: _set_limits(limits))
+    except OSError as e:
+        stats.add(script, 0.0, 0.0, 127, False)
+        _send(fp, {"error": `e`})
+        return
+    t1 = time.time()
+    spawn_ms = (t1 - t0) * 1000.0
+    _send(fp, {"pid": proc.pid, "spawn_ms": spawn_ms})
+
+    timed_out = _wait(proc, timeout, t1)
+    run_ms = (time.time() - t1) * 1000.0
+    status = proc.returncode
+    stats.add(script, spawn_ms, run_ms, status, timed_out)
+    _send(fp, {"status": status, "timed_out": timed_out, "run_ms": run_ms})
+
+def _handle_connection(conn, stats):
+    fp = conn.makefile("rw", 0)
+    try:
+        line = fp.readline()
+        if not line: return
+        req = json.loads(line)
+        if req.get("cmd") == "stats":
+            _send(fp, stats.get())
+        else:
+            _run_request(req, fp, stats)
+    except (IOError, socket.error, ValueError, KeyError):
+        pass
+    finally:
+        fp.close()
+        conn.close()
+
+def serve(sock_path, parent_pid):
+    """ Main loop of the helper process. Exits when the parent exits. """
+    if os.path.exists(sock_path):
+        os.unlink(sock_path)
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.bind(sock_path)
+    os.chmod(sock_path, 0600)
+    srv.listen(64)
+    srv.settimeout(1.0)
+    stats = _ScriptStats()
+    try:
+        while os.getppid() == parent_pid:
+            try:
+                conn, addr = srv.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            t = threading.Thread(target=_handle_connection,
+                                 args=(conn, stats))
+            t.setDaemon(True)
+            t.start()
+    finally:
+        srv.close()
+        if os.path.exists(sock_path):
+            os.unlink(sock_path)
+
+#----------------------------------------------------------------------
+#  Client side, used in the Ingestion Engine process
+
+_helper      = None
+_sock_path   = None
+_warned      = False
+_start_lock  = threading.Lock()
+
+# defaults for call(), set by configure()
+_def_timeout     = 0
+_def_limits      = {}
+_script_timeouts = {}
+
+def default_sock_path():
+    return os.path.join(tempfile.gettempdir(),
+                        "dream_ie_spawn_%d.sock" % os.getpid())
+
+def configure(timeout=0, limits=None, script_timeouts=None):
+    """ Sets the defaults for call(): the time-out in seconds (0: none),
+        the resource limits, and time-outs for individual scripts as
+        a dict {script file name: seconds}, which override the default.
+    """
+    global _def_timeout, _def_limits, _script_timeouts
+    _def_timeout     = timeout
+    _def_limits      = limits or {}
+    _script_timeouts = script_timeouts or {}
+
+def script_timeout(script):
+    return _script_timeouts.get(os.path.basename(script), _def_timeout)
+
+def find_python(python=None):
+    """ Returns the interpreter for the helper: python if given, else
+        sys.executable if it is a python interpreter (under mod_wsgi it
+        is the httpd binary), else the python of the same version in
+        sys.exec_prefix.  None if there is no usable interpreter.
+    """
+    if python:
+        candidates = [python]
+    else:
+        version = "python%d.%d" % sys.version_info[:2]
+        candidates = [os.path.join(sys.exec_prefix, "bin", version),
+                      os.path.join(sys.exec_prefix, "bin", "python")]
+        if sys.executable and \
+                os.path.basename(sys.executable).startswith("python"):
+            candidates.insert(0, sys.executable)
+    for c in candidates:
+        if os.path.isfile(c) and os.access(c, os.X_OK):
+            return c
+    return None
+
+def start(sock_path=None, python=None):
+    """ Starts the helper process. Should be called at start-up, while
+        the process is still small.
+        python: the interpreter for the helper, see find_python().
+        Returns False if the helper is not running, call() then runs
+        the scripts by subprocess.
+    """
+    global _helper, _sock_path
+    if None == sock_path: sock_path = default_sock_path()
+    interpreter = find_python(python)
+    if None == interpreter:
+        logger.error("Cannot start the spawn service: no python " +
+                     "interpreter found (" + `python or sys.executable` +
+                     "), set SpawnServicePython.")
+        return False
+    _start_lock.acquire()
+    try:
+        if None != _helper and None == _helper.poll():
+            return True
+        try:
+            _helper = subprocess.Popen(
+                [interpreter,
+                 os.path.splitext(os.path.abspath(__file__))[0]+".py",
+                 sock_path, `os.getpid()`],
+                close_fds=True)
+        except OSError as e:
+            logger.error("Cannot start the spawn service: " + `e`)
+            _helper = None
+            return False
+        # wait for the socket to appear
+        for i in range(50):
+            if os.path.exists(sock_path) or None != _helper.poll(): break
+            time.sleep(0.1)
+        if None != _helper.poll() or not os.path.exists(sock_path):
+            logger.error("Spawn service did not start (" + interpreter +
+                         ", exit status " + `_helper.poll()` + ").")
+            if None == _helper.poll():
+                _helper.terminate()
+                _helper.wait()
+            _helper    = None
+            _sock_path = None
+            return False
+        _sock_path = sock_path
+        return True
+    finally:
+        _start_lock.release()
+
+def stop():
+    global _helper, _sock_path
+    _start_lock.acquire()
+    try:
+        if None != _helper and None == _helper.poll():
+            _helper.terminate()
+            _helper.wait()
+        _helper    = None
+        _sock_path = None
+    finally:
+        _start_lock.release()
+
+def _connect():
+    if None == _sock_path: return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(_sock_path)
+    except socket.error:
+        s.close()
+        return None
+    return s
+
+def _fallback(args, cwd, timeout, limits, reason):
+    global _warned
+    if not _warned:
+        _warned = True
+        logger.warning("Spawn service not available (" + reason +
+                       "), running scripts by subprocess.")
+    try:
+        proc = subprocess.Popen(args,
+                                cwd=cwd,
+                                close_fds=True,
+                                preexec_fn=lambda: _set_limits(limits))
+    except OSError as e:
+        logger.error("Cannot run script " + `args[0]` + ": " + `e`)
+        return 127
+    if _wait(proc, timeout, time.time()):
+        _log_timeout(args, timeout)
+    return proc.returncode
+
+def _log_timeout(args, timeout):
+    logger.error("Script " + `args[0]` + " timed out after " +
+                 `timeout` + "s and was killed.")
+
+def call(args, timeout=None, limits=None, cwd=None):
+    """ Runs the script and waits for it, like subprocess.call.
+        Returns the exit status; -signal if the script was killed,
+        e.g. after running longer than timeout seconds (0: no limit).
+        limits: dict of resource limits (see RLIMIT_NAMES).
+        None means the defaults given to configure().
+    """
+    if None == timeout: timeout = script_timeout(args[0])
+    if None == limits:  limits  = _def_limits
+    if None == cwd:
+        cwd = os.getcwd()
+    s = _connect()
+    if None == s:
+        return _fallback(args, cwd, timeout, limits, "no connection")
+    fp = s.makefile("rw", 0)
+    try:
+        _send(fp, {"args": list(args), "cwd": cwd,
+                   "timeout": timeout, "limits": limits or {}})
+        started = json.loads(fp.readline())
+        if "error" in started:
+            logger.error("Cannot run script " + `args[0]` + ": " +
+                         started["error"])
+            return 127
+        done = json.loads(fp.readline())
+    except (IOError, socket.error, ValueError) as e:
+        # the helper went away, the script may or may not have run
+        logger.error("Spawn service failed while running " + `args[0]` +
+                     ": " + `e`)
+        return -1
+    finally:
+        fp.close()
+        s.close()
+    if done["timed_out"]:
+        _log_timeout(args, timeout)
+    return done["status"]
+
+def get_stats():
+    """ Returns the per-script statistics of the helper: count, failed,
+        timed_out, and the total/max spawn and run latencies in ms.
+    """
+    s = _connect()
+    if None == s: return {}
+    fp = s.makefile("rw", 0)
+    try:
+        _send(fp, {"cmd": "stats"})
+        return json.loads(fp.readline())
+    except (IOError, socket.error, ValueError):
+        return {}
+    finally:
+        fp.close()
+        s.close()
+
+if __name__ == '__main__':
+    # the helper process: spawn_service.py <socket path> <parent pid>
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    serve(sys.argv[1], int(sys.argv[2]))
@@ -0,0 +1,3 @@
+-- Executed by syncdb after the Archive table is created.
+-- Index for the lookups of archived products, see darc.is_archived.
+CREATE INDEX IF NOT EXISTS ingestion_archive_sc_hash ON ingestion_archive (scenario_id, eoid_hash);
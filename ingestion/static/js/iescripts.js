@@ -216,6 +216,58 @@ function sync_scenarios() {
    Dajaxice.ingestion.synchronize_scenarios(update_scenario);
 }
 
+function merge_status_changes(changes) {
+    // changes from ingest/ManageScenario/scenarioStatus
+    for (var i=0; i<changes.length; i++) {
+        var c = changes[i];
+        var scenario = get_scenario(c.ncn_id);
+        if (c.deleted) {
+            for (var j=0; j<jscenarios.length; j++) {
+                if (jscenarios[j].id == c.id) {
+                    jscenarios[j].st_st = "DELETED";
+                }
+            }
+            continue;
+        }
+        if (null === scenario) {
+            scenario = new Object();
+            scenario.id     = c.id;
+            scenario.ncn_id = c.ncn_id;
+            jscenarios.push(scenario);
+        }
+        scenario.auto_ingest = c.auto_ingest;
+        scenario.st_isav     = c.st_isav;
+        scenario.st_st       = c.st_st;
+        scenario.st_done     = c.st_done;
+    }
+    update_oveview_page();
+}
+
+function watch_scenarios(since) {
+    // long-poll: the server answers when a scenario status changes,
+    // or after its time-out with no changes
+    $.ajax({
+        url      : "/ingest/ManageScenario/scenarioStatus",
+        data     : {"since": since},
+        dataType : "json",
+        cache    : false,
+        success  : function(data) {
+            if (data.status != 0) {
+                window.setTimeout(function(){ watch_scenarios(0); }, 5000);
+                return;
+            }
+            if (data.full) {
+                jscenarios = [];
+            }
+            merge_status_changes(data.scenarios);
+            watch_scenarios(data.version);
+        },
+        error    : function() {
+            window.setTimeout(function(){ watch_scenarios(since); }, 5000);
+        }
+    });
+}
+
 /* ----------------- Edit Scnenario --------------------- */
 
     function append_more_extras()
@@ -0,0 +1,141 @@
+############################################################
+#  Project: DREAM
+#
+#  Module:  Task 5 ODA Ingestion Engine
+#
+#    (c) 2014 Siemens Convergence Creators s.r.o., Prague
+#    Licensed under the 'DREAM ODA Ingestion Engine Open License'
+#     (see the file 'LICENSE' in the top-level directory)
+#
+#  Ingestion Engine: scenario status feed for long-polling clients.
+#   Every change of a ScenarioStatus (made by the Work-Flow-Manager or
+#   by the views) is recorded here with a version number that only
+#   increases.  A client asks for the changes since the last version it
+#   has seen, and the request waits until there is a change or the
+#   time-out expires, so clients get only the scenarios that changed,
+#   and idle clients cost no database queries.
+#   The versions start at the time of the process start in ms, so that
+#   a version from before a restart of the IE is recognised and the
+#   client gets a full list.  A client may ask only for the scenarios
+#   of one user (the web UI shows the scenarios of the logged-in user).
+#
+#  used by views; fed by the post_save/post_delete signals
+#
+############################################################
+
+import time
+import threading
+import logging
+
+from django.db.models.signals import post_save, post_delete
+
+import models
+from singleton_pattern import Singleton
+
+logger = logging.getLogger('dream.file_logger')
+
+@Singleton
+class StatusFeed:
+    def __init__(self):
+        self._cond     = threading.Condition()
+        self._base     = int(time.time() * 1000)
+        self._version  = self._base
+        # key is the scenario id, value is (version, status dict, user id)
+        self._changes  = {}
+        # key is the scenario id, value is (ncn_id, auto_ingest, user id)
+        self._sc_info  = {}
+
+    def _get_sc_info(self, sc_id):
+        info = self._sc_info.get(sc_id)
+        if None == info:
+            try:
+                ncn_id, repeat_interval, user_id = \
+                    models.Scenario.objects.filter(id=sc_id).values_list(
+                    'ncn_id', 'repeat_interval', 'user_id')[0]
+                info = (ncn_id, int(repeat_interval > 0), user_id)
+            except IndexError:
+                info = (None, 0, None)
+            self._sc_info[sc_id] = info
+        return info
+
+    def _publish(self, sc_id, status, user_id):
+        self._cond.acquire()
+        try:
+            self._version += 1
+            self._changes[sc_id] = (self._version, status, user_id)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def scenario_changed(self, scenario):
+        # ncn_id or repeat_interval may have changed
+        self._sc_info[scenario.id] = \
+            (scenario.ncn_id, int(scenario.repeat_interval > 0),
+             scenario.user_id)
+
+    def status_changed(self, ss):
+        ncn_id, auto_ingest, user_id = self._get_sc_info(ss.scenario_id)
+        self._publish(ss.scenario_id,
+                      {'id'          : '%s' % ss.scenario_id,
+                       'ncn_id'      : ncn_id,
+                       'auto_ingest' : auto_ingest,
+                       'st_isav'     : ss.is_available,
+                       'st_st'       : ss.status,
+                       'st_done'     : ss.done},
+                      user_id)
+
+    def status_deleted(self, sc_id):
+        user_id = self._sc_info.pop(sc_id, (None, 0, None))[2]
+        self._publish(sc_id, {'id'      : '%s' % sc_id,
+                              'deleted' : True},
+                      user_id)
+
+    def get_changes(self, since, timeout, user_id=None):
+        """ Waits up to timeout seconds for changes after version since,
+            of the scenarios of user_id only if it is not None.
+            Returns (version, changes), changes is a list of the status
+            dicts, or None if the client must read the full list instead
+            (since is not a version of this process).
+        """
+        t_end = time.time() + timeout
+        self._cond.acquire()
+        try:
+            if since < self._base or since > self._version:
+                return self._version, None
+            while True:
+                changes = [ c[1] for c in self._changes.values()
+                            if c[0] > since and
+                            (None == user_id or c[2] == user_id) ]
+                remaining = t_end - time.time()
+                if changes or remaining <= 0:
+                    return self._version, changes
+                self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+
+    def get_version(self):
+        self._cond.acquire()
+        try:
+            return self._version
+        finally:
+            self._cond.release()
+
+# created here, the first save may happen in any of the worker threads
+# and the Singleton is not thread-safe
+status_feed = StatusFeed.Instance()
+
+def _status_saved(sender, instance, **kwargs):
+    status_feed.status_changed(instance)
+
+def _status_deleted(sender, instance, **kwargs):
+    status_feed.status_deleted(instance.scenario_id)
+
+def _scenario_saved(sender, instance, **kwargs):
+    status_feed.scenario_changed(instance)
+
+post_save.connect(_status_saved, sender=models.ScenarioStatus,
+                  dispatch_uid="ie_status_feed_saved")
+post_delete.connect(_status_deleted, sender=models.ScenarioStatus,
+                    dispatch_uid="ie_status_feed_deleted")
+post_save.connect(_scenario_saved, sender=models.Scenario,
+                  dispatch_uid="ie_status_feed_scenario")
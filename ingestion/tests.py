@@ -0,0 +1,738 @@
+############################################################
+#  Project: DREAM
+#
+#  Module:  Task 5 ODA Ingestion Engine
+#
+#    (c) 2014 Siemens Convergence Creators s.r.o., Prague
+#    Licensed under the 'DREAM ODA Ingestion Engine Open License'
+#     (see the file 'LICENSE' in the top-level directory)
+#
+#  Ingestion Engine: Django tests.
+#   Checks that the scenario listing endpoints use a constant number
+#   of database queries, independent of the number of scenarios.
+#   Run with:  ./manage.py test ingestion
+#
+############################################################
+
+import os
+import time
+import shutil
+import hashlib
+import json
+import StringIO
+import datetime
+import tempfile
+import logging
+import tarfile
+import zipfile
+
+from django.test import TestCase, TransactionTestCase
+from django.db import connection
+from django.contrib.auth.models import User
+
+import models
+import views
+import log_reader
+import product_upload
+import local_batch
+import add_product
+import callback_dispatcher
+import work_flow_manager
+import dm_control
+import mime_stream
+import uqmd
+import spawn_service
+import darc
+import utils
+
+def add_scenario(user, ncn_id):
+    now = datetime.datetime.now()
+    s = models.Scenario(
+        ncn_id               = ncn_id,
+        scenario_name        = "qtest",
+        scenario_description = "query count test",
+        dsrc                 = "http://localhost/wcs",
+        dsrc_login           = "",
+        dsrc_password        = "",
+        coastline_check      = False,
+        bb_lc_long           = 0.0,
+        bb_lc_lat            = 0.0,
+        bb_uc_long           = 1.0,
+        bb_uc_lat            = 1.0,
+        from_date            = now,
+        to_date              = now,
+        cloud_cover          = 100.0,
+        view_angle           = 90.0,
+        sensor_type          = "",
+        oda_server_ingest    = False,
+        tar_result           = False,
+        cat_registration     = False,
+        download_subset      = False,
+        default_priority     = 100,
+        repeat_interval      = 0,
+        starting_date        = now,
+        user                 = user)
+    s.save()
+    models.ScenarioStatus(
+        scenario      = s,
+        is_available  = 1,
+        status        = "IDLE",
+        done          = 0.0,
+        active_dar    = "",
+        ingestion_pid = 0).save()
+    models.Eoid(scenario=s, eoid_val="eoid-a", selected=True).save()
+    models.Eoid(scenario=s, eoid_val="eoid-b", selected=False).save()
+    models.ExtraConditions(scenario=s, xpath="x", text="t").save()
+    return s
+
+class ScenarioQueryCountTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('qtest', 'qtest@localhost', 'x')
+        self.n_created = 0
+
+    def add_scenarios(self, n):
+        for i in range(n):
+            self.n_created += 1
+            add_scenario(self.user, "qtest-%d" % self.n_created)
+
+    def test_scenarios_list(self):
+        for n in (1, 10, 50):
+            self.add_scenarios(n - self.n_created)
+            # one query for all the scenarios joined with their status
+            name, data = self.assertNumQueries(
+                1, views.getAjaxScenariosList, None)
+            self.assertEqual(n, len(data))
+
+    def test_scenario_dict(self):
+        self.add_scenarios(10)
+        # scenario + extraconditions_set + eoid_set
+        name, data = self.assertNumQueries(
+            3, views.getScenario, None, ("qtest-5",))
+        self.assertEqual(["eoid-a"], data["dssids"])
+        self.assertEqual(1, len(data["extraconditions"]))
+
+    def test_status_feed(self):
+        from status_feed import status_feed as feed
+        self.add_scenarios(10)
+        v0 = feed.get_version()
+        ss = models.ScenarioStatus.objects.get(scenario__ncn_id="qtest-3")
+        ss.status = "INGESTING"
+        ss.save()
+        version, changes = feed.get_changes(v0, 0)
+        self.assertEqual(v0 + 1, version)
+        self.assertEqual(["qtest-3"], [c['ncn_id'] for c in changes])
+        # nothing changed since: no queries, empty list after the time-out
+        version, changes = self.assertNumQueries(
+            0, feed.get_changes, version, 0.1)
+        self.assertEqual([], changes)
+        # a version from before a restart asks for the full list
+        self.assertEqual(None, feed.get_changes(0, 0)[1])
+        # the web UI gets only the scenarios of its user
+        other = User.objects.create_user('qother', 'qother@localhost', 'x')
+        add_scenario(other, "qother-1")
+        self.assertEqual([], feed.get_changes(version, 0, self.user.id)[1])
+        self.assertEqual(["qother-1"], [c['ncn_id'] for c in
+                         feed.get_changes(version, 0, other.id)[1]])
+        self.assertEqual(["qother-1"], [c['ncn_id'] for c in
+                         views.scenario_status_list(other)])
+        self.assertEqual(11, len(views.scenario_status_list()))
+
+class LogReaderTest(TestCase):
+
+    def setUp(self):
+        fd, self.fn = tempfile.mkstemp(suffix=".log")
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.fn)
+
+    def append(self, text):
+        f = open(self.fn, "a")
+        f.write(text)
+        f.close()
+
+    def test_tail_and_cursor(self):
+        for i in range(20000):
+            self.append("%s 2014-01-01 12:00:00,000 views msg %d 'sc-%d'\n" %
+                        (("INFO", "ERROR")[i % 2], i, i % 3))
+        self.append("Traceback (most recent call last):\n  x\n")
+        all_lines = open(self.fn).read().split("\n")[:-1]
+        lines, cursor, reset = log_reader.read_log(self.fn, 50)
+        self.assertTrue(reset)
+        self.assertEqual(all_lines[-50:], lines)
+
+        # incomplete lines are left for the next call
+        self.append("INFO 2014-01-01 12:00:01,000 views new")
+        lines, cursor, reset = log_reader.read_log(self.fn, 50, cursor)
+        self.assertFalse(reset)
+        self.assertEqual([], lines)
+        self.append(" line\n")
+        lines, cursor, reset = log_reader.read_log(self.fn, 50, cursor)
+        self.assertEqual(["INFO 2014-01-01 12:00:01,000 views new line"],
+                         lines)
+
+        # the traceback belongs to the record before it
+        flt = log_reader.LogFilter("ERROR", "'sc-1'")
+        lines, c, reset = log_reader.read_log(self.fn, 3, None, flt)
+        self.assertEqual(["ERROR 2014-01-01 12:00:00,000 views msg 19999 'sc-1'",
+                          "Traceback (most recent call last):",
+                          "  x"], lines)
+        flt = log_reader.LogFilter("WARNING", "'sc-2'")
+        lines, c, reset = log_reader.read_log(self.fn, 2, None, flt)
+        self.assertEqual(["ERROR 2014-01-01 12:00:00,000 views msg 19991 'sc-2'",
+                          "ERROR 2014-01-01 12:00:00,000 views msg 19997 'sc-2'"],
+                         lines)
+
+        # truncated (or rotated) log: the tail is read again
+        open(self.fn, "w").close()
+        self.append("WARNING 2014-01-01 12:00:02,000 views restarted\n")
+        lines, cursor, reset = log_reader.read_log(self.fn, 50, cursor)
+        self.assertTrue(reset)
+        self.assertEqual(1, len(lines))
+
+class ResumableUploadTest(TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.dir_path  = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+        shutil.rmtree(self.dir_path)
+
+    def test_resume(self):
+        data = "".join([chr(i % 251) for i in range(300000)])
+        upload_id = product_upload.start_upload(
+            self.state_dir, "qtest", self.dir_path, {"r.tif": len(data)})
+        state = product_upload.load_upload(self.state_dir, upload_id)
+        product_upload.write_chunk(
+            state, "r.tif", 0, StringIO.StringIO(data[:100000]), 100000, "md5")
+        # a chunk at the wrong offset is refused with the size received
+        try:
+            product_upload.write_chunk(
+                state, "r.tif", 0, StringIO.StringIO("x"), 1, "md5")
+            self.fail("no UploadOffsetError")
+        except product_upload.UploadOffsetError as e:
+            self.assertEqual(100000, e.received)
+        self.assertRaises(product_upload.UploadOffsetError,
+                          product_upload.finish_upload,
+                          self.state_dir, state, "md5")
+        # as after a restart: the checksum is rebuilt from the file
+        product_upload._checksums.clear()
+        product_upload.write_chunk(
+            state, "r.tif", 100000, StringIO.StringIO(data[100000:]),
+            len(data) - 100000, "md5")
+        product_upload.finish_upload(self.state_dir, state, "md5")
+        self.assertEqual(("md5", hashlib.md5(data).hexdigest()),
+                         utils.lookup_checksum(self.dir_path, "r.tif"))
+        self.assertEqual([], os.listdir(self.state_dir))
+
+class LocalBatchTest(TestCase):
+
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+
+    def touch(self, name):
+        open(os.path.join(self.src_dir, name), "w").close()
+
+    def test_find_products(self):
+        for n in ("a.tif", "a.xml", "b.tgz", "c.xml", ".ie_checksums"):
+            self.touch(n)
+        os.mkdir(os.path.join(self.src_dir, "d"))
+        self.touch("d.xml")
+        p = lambda n: os.path.join(self.src_dir, n)
+        self.assertEqual([(p("a.tif"), p("a.xml")),
+                          (p("b.tgz"), None),
+                          (p("c.xml"), None),
+                          (p("d"),     p("d.xml"))],
+                         local_batch.find_products(self.src_dir))
+
+    def test_stop_request(self):
+        # the user stops the batch after the first product
+        user = User.objects.create_user('btest', 'btest@localhost', 'x')
+        sc = add_scenario(user, "btest")
+        batch = models.LocalBatch(ncn_id="btest", info_status="processing",
+                                  info_date=datetime.datetime.utcnow(),
+                                  n_products=20)
+        batch.save()
+        wfm = work_flow_manager.WorkFlowManager.Instance()
+        worker = wfm._workers[0]
+        self.assertTrue(wfm.lock_scenario(sc.id))
+
+        def batch_one(sc_id, ncn_id, parameters, product, results, stop_event):
+            # runs in the pool, without db access
+            time.sleep(0.05)
+            status = "stopped" if stop_event.is_set() else "success"
+            results.add({"data": product[0], "status": status}, 0)
+
+        def set_status(worker_id, scenario_id, is_available, status, done):
+            set_scenario_status(worker_id, scenario_id, is_available, status, done)
+            if status == "LOCAL BATCH" and done > 1:
+                wfm.set_stop_request(scenario_id)
+
+        set_scenario_status = wfm.set_scenario_status
+        worker.local_batch_one = batch_one
+        wfm.set_scenario_status = set_status
+        try:
+            worker.local_batch_func(
+                {"scenario_id" : sc.id,
+                 "ncn_id"      : "btest",
+                 "batch_id"    : batch.id,
+                 "products"    : [("p%d" % i, None) for i in range(20)],
+                 "scripts"     : [],
+                 "s2_preprocess" : "NO"})
+        finally:
+            del wfm.set_scenario_status
+            del worker.local_batch_one
+
+        batch = models.LocalBatch.objects.get(id=batch.id)
+        self.assertEqual("stopped", batch.info_status)
+        self.assertEqual(20, batch.n_done)
+        self.assertTrue(batch.n_failed > 10)
+        ss = models.ScenarioStatus.objects.get(scenario=sc)
+        self.assertEqual(("IDLE", 1, 0),
+                         (ss.status, ss.is_available, ss.ingestion_pid))
+
+    def test_product_list(self):
+        list_fn = os.path.join(self.src_dir, "products.txt")
+        f = open(list_fn, "w")
+        f.write("# data  metadata\n"
+                "a.tif a.xml\n"
+                "\n"
+                "/data/b.tgz   # no metadata\n")
+        f.close()
+        self.assertEqual([(os.path.join(self.src_dir, "a.tif"),
+                           os.path.join(self.src_dir, "a.xml")),
+                          ("/data/b.tgz", None)],
+                         local_batch.read_product_list(list_fn))
+
+class RelocateTest(TestCase):
+
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        self.dst_dir = tempfile.mkdtemp()
+        self.product = os.path.join(self.src_dir, "S2A_TEST.SAFE")
+        self.files = {}
+        for sub in ("", "GRANULE", os.path.join("GRANULE", "IMG_DATA")):
+            if sub: os.mkdir(os.path.join(self.product, sub))
+            else:   os.mkdir(self.product)
+            for i in range(3):
+                name = os.path.join(sub, "f%d.jp2" % i)
+                data = os.urandom(1000 * (i + 1))
+                open(os.path.join(self.product, name), "wb").write(data)
+                self.files[name] = data
+        os.symlink("f0.jp2", os.path.join(self.product, "link.jp2"))
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+        shutil.rmtree(self.dst_dir)
+
+    def check_tree(self):
+        dst = os.path.join(self.dst_dir, "S2A_TEST.SAFE")
+        for name, data in self.files.items():
+            self.assertEqual(data, open(os.path.join(dst, name), "rb").read())
+        self.assertEqual("f0.jp2", os.readlink(os.path.join(dst, "link.jp2")))
+
+    def test_copy_tree(self):
+        stats = utils.relocate(self.product, self.dst_dir, False, 3, "md5")
+        self.check_tree()
+        self.assertTrue(os.path.isdir(self.product))
+        self.assertEqual(9, stats["files"])
+        self.assertEqual(9 * 2000, stats["bytes"])
+        self.assertFalse("rename" in stats["methods"])
+        self.assertFalse("hardlink" in stats["methods"])
+        # a change of the copy in place leaves the source alone
+        dst = os.path.join(self.dst_dir, "S2A_TEST.SAFE", "f1.jp2")
+        open(dst, "r+b").write("changed")
+        self.assertEqual(self.files["f1.jp2"],
+                         open(os.path.join(self.product, "f1.jp2"), "rb").read())
+        self.assertRaises(utils.IngestionError, utils.relocate,
+                          self.product, self.dst_dir, False)
+
+    def test_move_tree(self):
+        stats = utils.relocate(self.product, self.dst_dir, True, 3)
+        self.check_tree()
+        self.assertFalse(os.path.exists(self.product))
+        self.assertEqual({"rename": 9}, stats["methods"])
+
+    def test_copy_fallback(self):
+        # as on a file system without links or in-kernel copy
+        src = os.path.join(self.product, "f2.jp2")
+        dst = os.path.join(self.dst_dir, "f2.jp2")
+        skip = set(["hardlink", "reflink", "copy_file_range"])
+        method, size = utils._relocate_file(src, dst, False, "md5", skip)
+        self.assertEqual(("copy", 3000), (method, size))
+        self.assertEqual(("md5", hashlib.md5(self.files["f2.jp2"]).hexdigest()),
+                         utils.lookup_checksum(self.dst_dir, "f2.jp2"))
+
+class RequestBatcherTest(TestCase):
+
+    def test_window(self):
+        batches = []
+        batcher = add_product.RequestBatcher(0.2, 3, batches.append)
+        for i in range(4):
+            batcher.add(i)
+        # full batch at once, the rest when the window ends
+        self.assertEqual([[0, 1, 2]], batches)
+        time.sleep(0.5)
+        self.assertEqual([[0, 1, 2], [3]], batches)
+        batcher.add(4)
+        batcher.flush()
+        self.assertEqual([4], batches[-1])
+        time.sleep(0.3)
+        self.assertEqual(3, len(batches))
+
+    def test_discard(self):
+        batches = []
+        batcher = add_product.RequestBatcher(0.2, 3, batches.append)
+        batcher.add(0)
+        batcher.add(1)
+        self.assertEqual([0, 1], batcher.discard())
+        time.sleep(0.3)
+        self.assertEqual([], batches)
+
+class CallbackDispatcherTest(TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.failures = 0
+        self.dispatcher = callback_dispatcher.CallbackDispatcher._decorated()
+        self.dispatcher._send = self.send
+        self.dispatcher._retry_delay = 0.05
+
+    def send(self, url, payload):
+        self.sent.append( (url, payload) )
+        if self.failures > 0:
+            self.failures -= 1
+            return False, url.endswith("/retry")
+        return True, False
+
+    def wait_sent(self, n):
+        t_end = time.time() + 5
+        while len(self.sent) < n and time.time() < t_end:
+            time.sleep(0.01)
+
+    def test_retry(self):
+        self.failures = 2
+        self.assertTrue(self.dispatcher.post("http://client/retry", {"opId": 1}))
+        self.wait_sent(3)
+        self.assertEqual([("http://client/retry", {"opId": 1})] * 3, self.sent)
+        # a refused callback is not sent again
+        self.failures = 1
+        self.dispatcher.post("http://client/refuse", {"opId": 2})
+        self.wait_sent(4)
+        time.sleep(0.2)
+        self.assertEqual(4, len(self.sent))
+        self.assertEqual(0, self.dispatcher.n_waiting())
+
+    def test_bounded(self):
+        self.dispatcher._max_waiting = 1
+        self.dispatcher._retry_delay = 60
+        self.failures = 1
+        self.assertTrue(self.dispatcher.post("http://client/retry", {"opId": 1}))
+        self.wait_sent(1)
+        time.sleep(0.1)
+        # the first one waits for its retry, the queue is full
+        self.assertFalse(self.dispatcher.post("http://client/retry", {"opId": 2}))
+        self.assertEqual(1, self.dispatcher.n_waiting())
+
+class MimeStreamTest(TestCase):
+
+    def read_all(self, body, content_type):
+        reader = mime_stream.open_multipart(StringIO.StringIO(body), content_type)
+        parts = []
+        while True:
+            headers = reader.next_part()
+            if None == headers: break
+            parts.append( (headers["content-type"], reader.read_part(1 << 20)) )
+        return parts
+
+    def test_email_message(self):
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.application import MIMEApplication
+        from email.encoders import encode_noop
+        xml = "<md>\r\n" + "x" * 200000 + "\n--not the boundary\n</md>"
+        outer = MIMEMultipart()
+        outer.attach(MIMEApplication('{"productID": "p1"}', "json", encode_noop))
+        outer.attach(MIMEApplication(xml, "xml", encode_noop))
+        # the MIME headers are in the body, as sent by test_uqmd.py
+        self.assertEqual([("application/json", '{"productID": "p1"}'),
+                          ("application/xml", xml)],
+                         self.read_all(outer.as_string(),
+                                       "application/x-www-form-urlencoded"))
+
+    def test_block_edges(self):
+        body = ("preamble\r\n--BB\r\nContent-Type: application/json\r\n\r\n"
+                "{}\r\n--BB\r\nContent-Type: application/xml\r\n\r\n"
+                "\r\n--BB--\r\n")
+        block_sz = mime_stream.BLOCK_SZ
+        try:
+            for mime_stream.BLOCK_SZ in (1, 2, 5, 64):
+                self.assertEqual([("application/json", "{}"),
+                                  ("application/xml", "")],
+                                 self.read_all(body, 'multipart/mixed; boundary="BB"'))
+        finally:
+            mime_stream.BLOCK_SZ = block_sz
+        self.assertRaises(mime_stream.MultipartError, self.read_all,
+                          body[:-10], 'multipart/mixed; boundary="BB"')
+
+class UqmdTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.create_dl_dir = uqmd.create_dl_dir
+        self.call = uqmd.spawn_service.call
+        self.script_status = 0
+        # batch: status by productID, products not in it are left out
+        # of the response
+        self.product_status = {}
+        uqmd.create_dl_dir = lambda prefix, subdir: \
+            (tempfile.mkdtemp(prefix=prefix, dir=self.tmpdir), subdir)
+        uqmd.spawn_service.call = self.call_script
+
+    def tearDown(self):
+        uqmd.create_dl_dir = self.create_dl_dir
+        uqmd.spawn_service.call = self.call
+        shutil.rmtree(self.tmpdir)
+
+    def call_script(self, args, timeout=None):
+        if not args[1].startswith("-batch="):
+            return self.script_status
+        resp = open(args[2][len("-response="):], "w")
+        for line in open(args[1][len("-batch="):]):
+            prod_id = line.split()[1]
+            if prod_id in self.product_status:
+                resp.write("%d %s\n" % (self.product_status[prod_id], prod_id))
+        resp.close()
+        return self.script_status
+
+    def body(self, *commands):
+        parts = []
+        for c in commands:
+            parts.append("Content-Type: application/json\r\n\r\n" + c)
+            parts.append("Content-Type: application/xml\r\n\r\n<md/>")
+        return StringIO.StringIO(
+            "".join(["--BB\r\n" + p + "\r\n" for p in parts]) + "--BB--\r\n")
+
+    def md_files(self):
+        found = []
+        for dirpath, dirs, files in os.walk(self.tmpdir):
+            found += files
+        return found
+
+    def test_removed_on_error(self):
+        meta = {"CONTENT_TYPE" : 'multipart/mixed; boundary="BB"'}
+        resp = uqmd.updateMetaData(
+            self.body('{"productID": "p1", "action": "delete"}'), meta)
+        self.assertEqual(1, resp["status"])
+        self.assertEqual([], os.listdir(self.tmpdir))
+
+        self.script_status = 3
+        resp = uqmd.updateMetaData(
+            self.body('{"productID": "p1", "action": "add"}'), meta)
+        self.assertEqual(3, resp["status"])
+        self.assertEqual([], os.listdir(self.tmpdir))
+
+    def test_batch_status(self):
+        meta = {"CONTENT_TYPE" : 'multipart/mixed; boundary="BB"'}
+        # the script fails for p3 and says nothing about p4: only the
+        # metadata of p1 is kept, whatever its exit status
+        self.script_status = 3
+        self.product_status = {"p1" : 0, "p3" : 3}
+        resp = uqmd.updateMetaDataBatch(
+            self.body('{"productID": "p1", "action": "add"}',
+                      '{"productID": "p2", "action": "delete"}',
+                      '{"productID": "p3", "action": "replace"}',
+                      '{"productID": "p4", "action": "add"}',
+                      '{"productID": "p1", "action": "replace"}'), meta)
+        self.assertEqual(0, resp["status"])
+        self.assertEqual([0, 1, 3, -1, 13],
+                         [p["status"] for p in resp["products"]])
+        self.assertEqual(1, len(self.md_files()))
+        self.assertTrue(self.md_files()[0].startswith("p1_"))
+
+        shutil.rmtree(self.tmpdir)
+        os.mkdir(self.tmpdir)
+        self.product_status = {"p1" : 3}
+        resp = uqmd.updateMetaDataBatch(
+            self.body('{"productID": "p1", "action": "add"}'), meta)
+        self.assertEqual([3], [p["status"] for p in resp["products"]])
+        self.assertEqual([], os.listdir(self.tmpdir))
+
+class DarStoreTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = dm_control.DarStore(
+            self.tmpdir, 1, logging.getLogger('dream.file_logger'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_remove_and_purge(self):
+        self.store.add("a", "<dar/>")
+        self.store.add("b", "<dar/>")
+        self.store.open("a").close()
+        old = time.time() - 2*24*3600
+        for f in os.listdir(self.tmpdir):
+            os.utime(os.path.join(self.tmpdir, f), (old, old))
+        # only the DAR never retrieved by the DM is too old
+        self.store.add("c", "<dar/>")
+        self.assertEqual(["a.xml", "c.xml"], sorted(os.listdir(self.tmpdir)))
+        self.assertTrue(self.store.remove("a"))
+        self.assertFalse(self.store.remove("a"))
+        self.assertEqual(None, self.store.open("a"))
+        self.assertEqual(["c.xml"], os.listdir(self.tmpdir))
+
+class UnpackTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmpdir, "target")
+        os.mkdir(self.target)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_tar(self, members):
+        # members: list of (name, None for a file or a symlink target)
+        path = os.path.join(self.tmpdir, "t.tar")
+        tf = tarfile.open(path, "w")
+        for name, linkname in members:
+            info = tarfile.TarInfo(name)
+            if None == linkname:
+                info.size = 4
+                tf.addfile(info, StringIO.StringIO("data"))
+            else:
+                info.type = tarfile.SYMTYPE
+                info.linkname = linkname
+                tf.addfile(info)
+        tf.close()
+        return path
+
+    def make_zip(self, name):
+        path = os.path.join(self.tmpdir, "t.zip")
+        zf = zipfile.ZipFile(path, "w")
+        zf.writestr(zipfile.ZipInfo(name), "data")
+        zf.close()
+        return path
+
+    def test_unsafe_names(self):
+        for name in ("../x", "a/../../x", "/x"):
+            self.assertRaises(utils.IngestionError, utils.unpack_tar,
+                              self.target, self.make_tar([(name, None)]))
+            self.assertRaises(utils.IngestionError, utils.unpack_zip,
+                              self.target, self.make_zip(name))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "x")))
+        self.assertFalse(os.path.exists("/x"))
+
+    def test_symlinks(self):
+        for link in ("../../x", "b/../../../x", "/etc/passwd"):
+            self.assertRaises(utils.IngestionError, utils.unpack_tar,
+                              self.target, self.make_tar([("a/l", link)]))
+        # a link to a sibling directory stays within the archive
+        utils.unpack_tar(self.target, self.make_tar(
+                [("a/c/f", None), ("a/b/g", None), ("a/b/l", "../c")]))
+        self.assertEqual("data", open(
+                os.path.join(self.target, "a", "b", "l", "f")).read())
+
+class SpawnServiceTest(TestCase):
+
+    def test_no_helper(self):
+        self.assertEqual(None, spawn_service.find_python("/nonexistent/python"))
+        sock_path = os.path.join(tempfile.gettempdir(),
+                                 "ie_spawn_test_%d.sock" % os.getpid())
+        # an interpreter that exits at once: no helper, no socket
+        self.assertFalse(spawn_service.start(sock_path, "/bin/false"))
+        self.assertFalse(os.path.exists(sock_path))
+        # the scripts still run, by subprocess
+        self.assertEqual(3, spawn_service.call(["/bin/sh", "-c", "exit 3"], 0))
+
+class ArchiveTest(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user('atest', 'atest@localhost', 'x')
+        self.sc1 = add_scenario(user, "atest-1")
+        self.sc2 = add_scenario(user, "atest-2")
+
+    def test_is_archived(self):
+        # a record whose hash is that of another eoid, as in a collision
+        models.Archive.objects.bulk_create([
+                models.Archive(scenario=self.sc1, eoid="eoid-b",
+                               eoid_hash=models.eoid_hash("eoid-a"))])
+        self.assertFalse(darc.is_archived(self.sc1.id, "eoid-a"))
+        self.assertFalse(darc.is_archived(self.sc1.id, "eoid-b"))
+        models.Archive(scenario=self.sc1, eoid="eoid-a").save()
+        self.assertTrue(darc.is_archived(self.sc1.id, "eoid-a"))
+        self.assertFalse(darc.is_archived(self.sc2.id, "eoid-a"))
+
+    def test_delete_archive(self):
+        for sc in (self.sc1, self.sc2):
+            for i in range(3):
+                models.Archive(scenario=sc, eoid="eoid-%d" % i).save()
+        darc.delete_archive(self.sc1.id)
+        self.assertEqual(0, models.Archive.objects.filter(
+                scenario=self.sc1).count())
+        self.assertEqual(3, models.Archive.objects.filter(
+                scenario=self.sc2).count())
+
+class ArchiveUpgradeTest(TransactionTestCase):
+
+    def test_backfill(self):
+        # an Archive table from a version without eoid_hash
+        table = models.Archive._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute("DROP TABLE " + table)
+        cursor.execute("CREATE TABLE " + table + " (" +
+                       "id integer NOT NULL PRIMARY KEY, " +
+                       "scenario_id integer NOT NULL, " +
+                       "eoid varchar(2048) NOT NULL)")
+        cursor.executemany("INSERT INTO " + table +
+                           " (scenario_id, eoid) VALUES (%s, %s)",
+                           [(1, "eoid-%d" % i) for i in range(7)])
+        backfill_batch = darc.BACKFILL_BATCH
+        darc.BACKFILL_BATCH = 3
+        try:
+            self.assertEqual(7, darc.upgrade_archive_table())
+        finally:
+            darc.BACKFILL_BATCH = backfill_batch
+        self.assertTrue(darc.archive_index_exists(cursor))
+        self.assertTrue(darc.is_archived(1, "eoid-5"))
+        # done: nothing is read at the next start-up
+        self.assertNumQueries(1, darc.upgrade_archive_table)
+
+class UrlSinkTest(TestCase):
+
+    def feed(self, sink, data, block_sz):
+        for i in range(0, len(data), block_sz):
+            sink.write(data[i:i+block_sz])
+        return sink.result()
+
+    def test_json_list(self):
+        dars = [ {"darURL"      : "http://ie/dar/%d" % i,
+                  "productList" : [{"message": '"], [{'}] * i}
+                 for i in range(50) ]
+        data = json.dumps({"other"              : {"dataAccessRequests": 1},
+                           "dataAccessRequests" : dars})
+        for block_sz in (1, 7, 1000, 65536):
+            sink = utils.ParserSink(utils.JsonListParser("dataAccessRequests"))
+            self.assertEqual(dars, self.feed(sink, data, block_sz))
+            sink = utils.ParserSink(utils.JsonListParser(
+                    "dataAccessRequests",
+                    lambda r: r["darURL"] == "http://ie/dar/49"))
+            self.assertEqual([dars[49]], self.feed(sink, data, block_sz))
+        sink = utils.ParserSink(utils.JsonListParser("dataAccessRequests"))
+        self.assertRaises(ValueError, self.feed, sink, data[:-1000], 100)
+        sink = utils.ParserSink(utils.JsonListParser("dataAccessRequests"))
+        self.assertRaises(ValueError, self.feed, sink, '{"status": 1}', 100)
+
+    def test_file_sink(self):
+        fp = tempfile.TemporaryFile()
+        self.assertEqual(100000, self.feed(utils.FileSink(fp), "x" * 100000, 4096))
+        fp.seek(0)
+        self.assertEqual("x" * 100000, fp.read())
+        fp.close()
@@ -14,16 +14,19 @@
 #  Ingestion Engine: Update Quality MetaData.
 #
 #  Implements the interface  IF-DREAM-O-UpdateQualityMD.
+#  The multipart request is read as a stream (see mime_stream), the
+#  metadata part is written straight to its file.  updateMDBatch takes
+#  any number of products in one request and runs the script once.
 #
 ############################################################
 
+import sys
 import logging
 import json
 import time
 import os.path
-import subprocess
+import spawn_service
 import traceback
-from email import message_from_string
 
 from settings import \
     IE_DEBUG, \
@@ -32,24 +35,116 @@ from settings import \
     UQMD_SUBDIR
 
 from ingestion_logic import create_dl_dir
-from utils import mkFname, open_unique_file
+from utils import \
+    mkFname, \
+    open_unique_file, \
+    write_manifest_list, \
+    read_batch_response
+
+from mime_stream import \
+    open_multipart, \
+    parse_content_type, \
+    MultipartError
 
 MAX_NON_UNIQ_FILES = 50000
 
+# max. size of the json part
+MAX_JSON_PART = 65536
+
+UQMD_ACTIONS = ("add", "replace")
+
 logger = logging.getLogger('dream.file_logger')
 
-def write_md(prodId, metadata):
-    try:
-        dl_dir, rp = create_dl_dir(prodId+"_", UQMD_SUBDIR)
-    except OSError as e:
-        return 31, "Cannot create directory for storing MD", None
+class UqmdError(Exception):
+    def __init__(self, status, msg):
+        Exception.__init__(self, msg)
+        self.status = status
+        self.msg = msg
 
+def open_md_file(md_dir, prodId):
+    # opens a new file for the metadata of prodId in md_dir[0], the
+    # directory is created at the first file of a request
+    if None == md_dir[0]:
+        try:
+            md_dir[0], rp = create_dl_dir(prodId+"_", UQMD_SUBDIR)
+        except OSError as e:
+            raise UqmdError(31, "Cannot create directory for storing MD")
     leaf_root = mkFname(prodId+"_")
-    meta_fp, meta_fname = open_unique_file(dl_dir, leaf_root, MAX_NON_UNIQ_FILES)
-    meta_fp.write(metadata)
-    meta_fp.close()
+    return open_unique_file(md_dir[0], leaf_root, MAX_NON_UNIQ_FILES)
+
+def remove_md_files(md_files):
+    # removes the metadata files of products that were not updated,
+    # and their directory if nothing else is left in it
+    for fname in md_files:
+        try:
+            os.remove(fname)
+        except OSError as e:
+            logger.warning("Cannot remove " + fname + ": " + `e`)
+    for md_dir in set([os.path.dirname(f) for f in md_files]):
+        try:
+            os.rmdir(md_dir)
+        except OSError:
+            pass
 
-    return 0, '', meta_fname
+def read_parts(reader, md_files):
+    # Reads the json and xml parts of the request.  Each json part is
+    # paired with an xml part, in either order; the xml is written
+    # straight to its file.  Returns a list of the items
+    #   {"command": dict from the json part or None,
+    #    "md":      metadata file name or None}
+    # The name of each metadata file is appended to md_files as soon as
+    # it is created, so that it can be removed if the request fails.
+    items = []
+    md_dir = [None]
+    while True:
+        headers = reader.next_part()
+        if None == headers:
+            break
+        main, sub, params = \
+            parse_content_type(headers.get("content-type", "text/plain"))
+        if main == 'multipart':
+            raise UqmdError(24, "Unexpected Nested Multipart.")
+        if main != 'application':
+            raise UqmdError(22, "Illegal Content Main Type: " + main)
+        if sub == 'json':
+            key = "command"
+        elif sub == 'xml':
+            key = "md"
+        else:
+            raise UqmdError(23, "Illegal Content Subtype: " + sub)
+        item = None
+        for i in items:
+            if None == i[key]:
+                item = i
+                break
+        if None == item:
+            item = {"command" : None, "md" : None}
+            items.append(item)
+        if key == "command":
+            item["command"] = json.loads(reader.read_part(MAX_JSON_PART))
+        else:
+            prodId = "uqmd"
+            if None != item["command"] and "productID" in item["command"]:
+                prodId = item["command"]["productID"]
+            md_fp, item["md"] = open_md_file(md_dir, prodId)
+            md_files.append(item["md"])
+            try:
+                reader.copy_part(md_fp.write)
+            finally:
+                md_fp.close()
+    return items
+
+def check_item(item):
+    command = item["command"]
+    if None == command:
+        return 11, "Missing json part."
+    if not "productID" in command or not "action" in command:
+        return 12, "Mandatory productID or action not found."
+    if None == item["md"]:
+        return 10, "Missing metadata."
+    if command["action"] not in UQMD_ACTIONS:
+        return 1, "Bad action: " + command["action"]
+    return 0, ''
 
 def run_qmd_update(command, md_filename):
     action = command["action"]
@@ -58,7 +153,7 @@ def run_qmd_update(command, md_filename):
 
     script = os.path.join(IE_SCRIPTS_DIR, IE_DEFAULT_UQMD_SCRIPT)
     
-    status = subprocess.call(
+    status = spawn_service.call(
         [script,
          "-"+action,
          prodId,
@@ -68,73 +163,71 @@ def run_qmd_update(command, md_filename):
     
     return status, error_str
 
-def updateMetaData(postData, request_meta):
-    logger.info("processing updateMD request")
+def run_qmd_batch(items):
+    # Runs the script once for all items, with the batch protocol of the
+    # ingestion scripts (see utils.write_manifest_list):
+    #   script -batch=<list file> -response=<response file>
+    # The list file has a line  action productID metadatafile  per item,
+    # the script writes a line  <status> <productID>  per product to the
+    # response file.  Returns a dict { productID: status }, products
+    # missing in the response have the status -1.
+    prod_ids = [item["command"]["productID"] for item in items]
+    lines = ["%s %s %s" % (item["command"]["action"],
+                           item["command"]["productID"],
+                           item["md"]) for item in items]
+    list_fn, resp_fn = write_manifest_list(
+        os.path.dirname(items[0]["md"]), lines)
+
+    script = os.path.join(IE_SCRIPTS_DIR, IE_DEFAULT_UQMD_SCRIPT)
+    try:
+        # the time-out is per product
+        r = spawn_service.call(
+            [script, "-batch="+list_fn, "-response="+resp_fn],
+            spawn_service.script_timeout(script) * len(items))
+        status = read_batch_response(resp_fn, prod_ids)
+    finally:
+        for fn in (list_fn, resp_fn):
+            if os.path.exists(fn):
+                os.unlink(fn)
+    if 0 != r:
+        logger.warning("Update Quality MetaData batch script returned status:"
+                       + `r`)
+    return status
 
-    # Handle the case where the boundary header is part of the HTTP headers
-    #  rather than separeated in the POST data
-    if 'CONTENT_TYPE' in request_meta:
-        content_type_header = request_meta['CONTENT_TYPE']
-        print 'Http CONTENT_TYPE: '+`content_type_header`
-        if 'multipart/mixed' in content_type_header.lower() and \
-                'boundary=' in content_type_header.lower():
-            postData = \
-                "Content-Type: "+ content_type_header + "\n" + \
-                "MIME-Version: 1.0\n\n"  + \
-                postData
+def open_request(stream, request_meta):
+    # the boundary header may be part of the HTTP headers, or at the
+    # start of the POST data
+    content_type = request_meta.get('CONTENT_TYPE', '')
+    if IE_DEBUG > 1:
+        logger.debug('Http CONTENT_TYPE: '+`content_type`)
+    return open_multipart(stream, content_type)
+
+def updateMetaData(stream, request_meta):
+    # stream: the request, or another file-like object with the body
+    logger.info("processing updateMD request")
 
     resp = {}
     error_str = None
     status = 0
-    metadata = None
-    command = None
-    productID = None
-    action = None
+    md_files = []
     try:
-        msg = message_from_string(postData)
-        if not msg.is_multipart():
-            logger.error("msg is not multipart.")
-        
-        for part in msg.walk():
-            # multipart/* are just containers
-            if part.get_content_maintype() == 'multipart':
-                continue
-            elif part.get_content_maintype() == 'application':
-                if part.is_multipart():
-                    status = 24
-                    error_str = "Unexpected Nested Multipart."
-                    break
-                subtype = part.get_content_subtype()
-                if  'json' == subtype:
-                    command = json.loads(part.get_payload())
-                elif 'xml' == subtype:
-                    metadata = part.get_payload()
-                else:
-                    status = 23
-                    error_str = "Illegal Content Subtype: " + subtype
-                    break
-            else:
-                status = 22
-                error_str = \
-                    "Illegal Content Main Type: " + \
-                    part.get_content_maintype()
-                break
+        items = read_parts(open_request(stream, request_meta), md_files)
+        if len(items) > 1:
+            raise UqmdError(25, "More than one product, use updateMDBatch.")
+        if not items:
+            items = [{"command" : None, "md" : None}]
+        status, error_str = check_item(items[0])
+        if 0 == status:
+            status, error_str = run_qmd_update(
+                items[0]["command"], items[0]["md"])
 
-        if None == metadata:
-            status = 10
-            error_str = "Missing metadata."
-        if None == command:
-            status = 11
-            error_str = "Missing json part."
-        elif not "productID" in command or not "action" in command:
-            status = 12
-            error_str = "Mandatory productID or action not found."
+    except UqmdError as e:
+        status = e.status
+        error_str = e.msg
 
-        if 0 == status:
-            status, error_str, md_filename = write_md(
-                command["productID"],metadata)
-        if 0 == status:
-            status, error_str = run_qmd_update(command, md_filename)
+    except MultipartError as e:
+        status = 21
+        error_str = "Bad multipart message: %s" % e
 
     except Exception as e:
         status = 50
@@ -142,8 +235,10 @@ def updateMetaData(postData, request_meta):
         logger.error("Exception in updateMetaData: " + `e`)
         if IE_DEBUG>0:
             traceback.print_exc(4,sys.stdout)
-            
-        
+
+    if 0 != status:
+        remove_md_files(md_files)
+
     resp["status"] = status
     if error_str:
         resp["errorString"] = error_str
@@ -153,4 +248,88 @@ def updateMetaData(postData, request_meta):
         logger.info("updateMD request finished with status " +`status`)
     return resp
 
+def updateMetaDataBatch(stream, request_meta):
+    # As updateMetaData, for any number of (json, xml) pairs of parts.
+    # The script is run once, for all products that passed the checks,
+    # and reports the status of each product (see run_qmd_batch).  The
+    # metadata files of the products that failed are removed.
+    # The response has the status of each product, in the order of the
+    # request:  "products": [{"productID":..., "status":...,
+    #                         "errorString":...}, ...]
+    logger.info("processing updateMDBatch request")
 
+    resp = {}
+    error_str = None
+    status = 0
+    products = []
+    md_files = []
+    done = set()
+    try:
+        items = read_parts(open_request(stream, request_meta), md_files)
+        todo = []
+        prod_ids = set()
+        for item in items:
+            st, err = check_item(item)
+            if 0 == st and len(item["command"]["productID"].split()) != 1:
+                # the list file for the script is split at white space
+                st, err = 12, "Bad productID: " + item["command"]["productID"]
+            if 0 == st and item["command"]["productID"] in prod_ids:
+                # the script reports the status by productID
+                st, err = 13, "Duplicate productID: " + \
+                    item["command"]["productID"]
+            if 0 == st:
+                prod_ids.add(item["command"]["productID"])
+            product = {"status" : st}
+            if None != item["command"] and "productID" in item["command"]:
+                product["productID"] = item["command"]["productID"]
+            if err:
+                product["errorString"] = err
+            else:
+                todo.append( (item, product) )
+            products.append(product)
+        if not items:
+            status, error_str = 11, "Missing json part."
+        if todo:
+            logger.info("updateMDBatch: %d of %d products" %
+                        (len(todo), len(items)))
+            script_status = run_qmd_batch([t[0] for t in todo])
+            for item, product in todo:
+                st = script_status[product["productID"]]
+                product["status"] = st
+                if 0 == st:
+                    done.add(item["md"])
+                elif st < 0:
+                    product["errorString"] = \
+                        'No status from the Update Quality MetaData script'
+                else:
+                    product["errorString"] = \
+                        'Update Quality MetaData script returned status:'+`st`
+
+    except UqmdError as e:
+        status = e.status
+        error_str = e.msg
+
+    except MultipartError as e:
+        status = 21
+        error_str = "Bad multipart message: %s" % e
+
+    except Exception as e:
+        status = 50
+        error_str = "Unexpected exception: " + e.__class__.__name__
+        logger.error("Exception in updateMetaDataBatch: " + `e`)
+        if IE_DEBUG>0:
+            traceback.print_exc(4,sys.stdout)
+
+    # the metadata of the products that were not updated
+    remove_md_files([f for f in md_files if f not in done])
+
+    resp["status"] = status
+    resp["products"] = products
+    if error_str:
+        resp["errorString"] = error_str
+        logger.warning("updateMDBatch request error. Status: " +`status`+\
+                    ", error: " + error_str)
+    else:
+        logger.info("updateMDBatch request finished, %d products" %
+                    len(products))
+    return resp
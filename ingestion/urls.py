@@ -48,8 +48,15 @@ urlpatterns = patterns('',
     url(r'^ingest/AddProduct/getStatus/id=(?P<op_id>.*)$',
         views.getAddStatus_operation),
 
+    # batch ingestion of local products and its status
+    url(r'^ingest/addLocalBatch/addLocalBatch', views.addLocalBatch_operation),
+    url(r'^ingest/addLocalBatch/getStatus/id=(?P<batch_id>.*)$',
+        views.getLocalBatchStatus_operation),
+
     # uqmd - updateQualityMetaData (JSON / mixed)
     # Implements the interface  IF-DREAM-O-UpdateQualityMD
+    # batch form, many products in one request (before updateMD)
+    url(r'^ingest/uqmd/updateMDBatch', views.updateMDBatch_operation),
     url(r'^ingest/uqmd/updateMD', views.updateMD_operation),
 
     # listScenarios
@@ -58,6 +65,14 @@ urlpatterns = patterns('',
     # listScenarios for ajax / backend
     url(r'^ingest/ManageScenario/odaListScenarios',views.getAjaxScenariosList_operation),
 
+    # scenario status changes, long-poll: ?since=<version>
+    url(r'^ingest/ManageScenario/scenarioStatus',
+        views.getScenarioStatusChanges_operation),
+
+    # script latencies and current stages of the workers
+    url(r'^ingest/ManageScenario/scriptStats',
+        views.getScriptStats_operation),
+
     # getScenario
     url(r'^ingest/ManageScenario/getScenario/ncn_id=(?P<ncn_id>.*)$',views.getScenario_operation),
 
@@ -91,6 +106,16 @@ urlpatterns = patterns('',
     # addScenario.html
     url(r'^scenario/add/$',views.addScenario),
     
+    # resumable uploads of local products, see views.py
+    url(r'^ingest/addLocalUpload/start/ncn_id=(?P<ncn_id>.*)$',
+        views.uploadStart_operation),
+    url(r'^ingest/addLocalUpload/chunk/id=(?P<upload_id>\w+)/file=(?P<name>.*)$',
+        views.uploadChunk_operation),
+    url(r'^ingest/addLocalUpload/status/id=(?P<upload_id>\w+)$',
+        views.uploadStatus_operation),
+    url(r'^ingest/addLocalUpload/finish/id=(?P<upload_id>\w+)$',
+        views.uploadFinish_operation),
+
     # addLocalProduct.html
     url(r'^ingest/addLocal/(?P<ncn_id>.*)$',views.addLocalProduct),
     
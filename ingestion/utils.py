@@ -20,18 +20,41 @@ from os import fdopen
 from os import O_WRONLY, O_CREAT, O_EXCL
 import shutil
 import glob
+import fnmatch
+import tarfile
+import gzip
+import zipfile
+from multiprocessing.pool import ThreadPool
 import re
 import urllib2
 import traceback
 import time, calendar
 import random
+import json
+import hashlib
+import zlib
 from math import floor
 import subprocess
+import threading
+import mmap
+import errno
+import fcntl
+import ctypes
+import ctypes.util
 from osgeo import osr
 
+# numpy is optional, used for parsing long coordinate lists
+have_numpy = False
+try:
+    import numpy
+    have_numpy = True
+except ImportError:
+    pass
+
 BLK_SZ = 8192
 MAX_MANIF_FILES = 750000
 MANIFEST_FN = "MANIFEST"
+CHECKSUMS_FN = ".ie_checksums"
 META_SUFFIX = ".meta"
 DATA_SUFFIX = ".data"
 TIFF_SUFFIX = '.tiff'
@@ -210,31 +233,28 @@ def coords_from_text(coord_string, srs=None):
      No error checking is done; simply throws an exception in case
      of problems.
     """
-    ret = []
-    if not coord_string: return ret
+    if not coord_string: return []
 
-    if srs and not srs_is_WGS84(srs):
-        srcRef = get_spatialReference(srs)
-        ct = osr.CoordinateTransformation(srcRef, SPATIAL_REF_WGS84)
+    if srs:
+        ct = get_transform_to_WGS84(srs)
     else:
         ct = None
 
-    vals = coord_string.split()
-    n = len(vals)
-    i = 0
-    while i < n:
-        x = float(vals[i])
-        y = float(vals[i+1])
-
-        if ct:
-            xy = ct.TransformPoint(x, y)
-        else:
-            xy = (x, y)
+    if have_numpy:
+        vals = numpy.array(coord_string.split(), dtype=float)
+        pts = vals.reshape(-1, 2).tolist()
+    else:
+        vals = coord_string.split()
+        if len(vals) % 2:
+            raise IndexError("odd number of values in coordinate list")
+        pts = [ (float(vals[i]), float(vals[i+1]))
+                for i in xrange(0, len(vals), 2) ]
 
-        ret.append(xy)
-        i += 2
+    if ct:
+        # one call for all the points, the loop is in the C library
+        return ct.TransformPoints(pts)
 
-    return ret
+    return [ tuple(p) for p in pts ]
 
 
 # ------------ Bbox --------------------------
@@ -365,27 +385,582 @@ def build_aoi_toi(aoi_json, start_tp, end_tp):
     return ret_aoi, ret_time
     
 # ------------ internet access --------------------------
-def read_from_url(
+#  fetch_url() streams the body of a response into a sink, any object
+#  with write(buff) and result() methods.  The sinks below collect the
+#  chunks and join them once, write them to a file, or feed them to an
+#  incremental parser; all of them run in linear time.
+
+URL_BLK_SZ = 65536
+
+class ChunkSink:
+    # result: the body as one string
+    def __init__(self):
+        self._chunks = []
+    def write(self, buff):
+        self._chunks.append(buff)
+    def result(self):
+        return ''.join(self._chunks)
+
+class JsonSink(ChunkSink):
+    # result: the decoded json object.  The json module has no
+    # incremental decoder, the chunks are joined and decoded once.
+    def result(self):
+        return json.loads(ChunkSink.result(self))
+
+class FileSink:
+    # result: the number of bytes written to the file
+    def __init__(self, fp):
+        self._fp = fp
+        self._n = 0
+    def write(self, buff):
+        self._fp.write(buff)
+        self._n += len(buff)
+    def result(self):
+        self._fp.flush()
+        return self._n
+
+class ParserSink:
+    # feeds the body to an incremental parser with feed() and close()
+    # methods, e.g. a JsonListParser or an ElementTree XMLParser;
+    # result: whatever parser.close() returns
+    def __init__(self, parser):
+        self._parser = parser
+    def write(self, buff):
+        self._parser.feed(buff)
+    def result(self):
+        return self._parser.close()
+
+class JsonListParser:
+    """ Incremental parser for the (first) list under key in a json
+        object, e.g. {"dataAccessRequests": [{...}, {...}]}.  The elements of
+        the list are decoded one at a time as the data arrives, and
+        only those for which select(element) is true are kept, so a
+        large response is never held in memory as a whole.
+        close() returns the list of the selected elements; it raises
+        ValueError, as the json module does, if the list was not found
+        or is incomplete.
+        The rest of the object is not checked.
+    """
+    def __init__(self, key, select=None):
+        self._key      = key
+        self._start    = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+        self._select   = select
+        self._decoder  = json.JSONDecoder()
+        self._buf      = ""
+        self._in_list  = False
+        self._done     = False
+        # a failed decode is retried when the buffer has doubled, so
+        # that a large element is not parsed once per block
+        self._retry_sz = 0
+        self._result   = []
+
+    def feed(self, data):
+        if self._done: return
+        self._buf += data
+        if not self._in_list:
+            m = self._start.search(self._buf)
+            if None == m:
+                # keep what may be the start of the key
+                self._buf = self._buf[-(len(self._key) + 64):]
+                return
+            self._buf = self._buf[m.end():]
+            self._in_list = True
+        if len(self._buf) < self._retry_sz:
+            return
+        self._parse()
+
+    def _parse(self):
+        buf = self._buf
+        i = 0
+        n = len(buf)
+        self._retry_sz = 0
+        while True:
+            while i < n and buf[i] in " \t\r\n,":
+                i += 1
+            if i == n:
+                break
+            if buf[i] == "]":
+                self._done = True
+                break
+            try:
+                elem, end = self._decoder.raw_decode(buf, i)
+            except ValueError:
+                # incomplete element
+                self._retry_sz = 2 * (n - i)
+                break
+            if None == self._select or self._select(elem):
+                self._result.append(elem)
+            i = end
+        self._buf = buf[i:]
+
+    def close(self):
+        if self._in_list and not self._done:
+            self._parse()
+        if not self._done:
+            raise ValueError("No complete list '" + self._key +
+                             "' found in the json data")
+        return self._result
+
+class LimitedReader:
+    # file-like wrapper around a response, enforces the size and time
+    # limits while the consumer (e.g. an xml parser) reads from it.
+    def __init__(self, fp, max_size=0, read_timeout=0):
+        self._fp = fp
+        self._max_size = max_size
+        self._n = 0
+        self._end_time = None
+        if read_timeout > 0:
+            self._end_time = time.time() + read_timeout
+    def read(self, size=-1):
+        if self._max_size > 0 and size < 0:
+            # don't read the whole (maybe unlimited) response at once
+            size = max(self._max_size + 1 - self._n, 1)
+        buff = self._fp.read(size)
+        self._n += len(buff)
+        if self._max_size > 0 and self._n > self._max_size:
+            raise IngestionError("Max read size exceeded")
+        if None != self._end_time and time.time() > self._end_time:
+            raise IngestionError("URL read time expired")
+        return buff
+    def geturl(self):
+        return self._fp.geturl()
+    def close(self):
+        self._fp.close()
+
+def fetch_url(
     url,
+    sink,
     post_data=None,
-    max_size=851200,    #bytes, 0 for unlimited
+    max_size=0,         #bytes, 0 for unlimited
     read_timeout=300    #seconds, 0 for unlimited
     ):
-    resp = None
+    """ Reads the response to url (a POST if post_data is not None)
+        in blocks and passes them to sink.write(), returns
+        sink.result().  Raises IngestionError if max_size or
+        read_timeout are exceeded, urllib2 errors are passed on.
+    """
     r = urllib2.urlopen(url, post_data)
-    end_time = time.time() + read_timeout
-    while True:
-        buff = r.read(BLK_SZ)
-        if not buff:
-            break
-        if read_timeout > 0 and time.time() > end_time:
-            raise IngestionError("URL read time expired")
-        if None == resp: resp = buff
-        else:            resp += buff
-        if max_size > 0 and None != resp and len(resp) > max_size:
-            raise IngestionError("Max read size exceeded")
-    if None != r: r.close()
-    return resp
+    try:
+        end_time = time.time() + read_timeout
+        n = 0
+        while True:
+            buff = r.read(URL_BLK_SZ)
+            if not buff:
+                break
+            if read_timeout > 0 and time.time() > end_time:
+                raise IngestionError("URL read time expired")
+            n += len(buff)
+            if max_size > 0 and n > max_size:
+                raise IngestionError("Max read size exceeded")
+            sink.write(buff)
+    finally:
+        r.close()
+    return sink.result()
+
+def fetch_json(url, post_data=None, max_size=0, read_timeout=300):
+    return fetch_url(url, JsonSink(), post_data, max_size, read_timeout)
+
+# ------------ checksums  -----------------
+#  The content hash of product data is computed while the data is
+#  copied anyway (split, upload, copy), never by an extra read.
+#  'crc32' and 'adler32' are much faster than the hashlib algorithms
+#  but are no protection against deliberate modification.
+
+class _ZlibChecksum:
+    def __init__(self, func):
+        self._func = func
+        self._val = func('')
+    def update(self, buff):
+        self._val = self._func(buff, self._val)
+    def hexdigest(self):
+        return "%08x" % (self._val & 0xffffffff)
+
+CHECKSUM_BLK_SZ = 1024*1024
+
+def new_checksum(algo):
+    # returns an object with update() and hexdigest(), or None if
+    # algo is empty or 'none'.  Raises ValueError for unknown algos.
+    if not algo or algo.lower() == 'none':
+        return None
+    algo = algo.lower()
+    if algo == 'crc32':
+        return _ZlibChecksum(zlib.crc32)
+    if algo == 'adler32':
+        return _ZlibChecksum(zlib.adler32)
+    return hashlib.new(algo)
+
+def checksum_manifest_lines(algo, hexdigest):
+    return 'DATA_CHECKSUM_TYPE="' + algo      + '"\n' + \
+           'DATA_CHECKSUM="'      + hexdigest + '"\n'
+
+# Checksums of files that are not listed in a MANIFEST at the time they
+# are written (uploads, copied local products) are kept in the file
+# CHECKSUMS_FN in the same directory, a json dictionary
+#   file name : [algo, hexdigest, size, mtime]
+# An entry is only valid while the size and mtime of the file match.
+
+# files of one directory may be copied by several threads
+_checksums_lock = threading.Lock()
+
+def record_checksum(dir_path, fname, algo, hexdigest):
+    ck_path = os.path.join(dir_path, CHECKSUMS_FN)
+    _checksums_lock.acquire()
+    try:
+        checksums = {}
+        if os.path.exists(ck_path):
+            try:
+                fp = open(ck_path, "r")
+                checksums = json.load(fp)
+                fp.close()
+            except Exception:
+                checksums = {}
+        st = os.stat(os.path.join(dir_path, fname))
+        checksums[fname] = [algo, hexdigest, st.st_size, int(st.st_mtime)]
+        fp = open(ck_path, "w")
+        json.dump(checksums, fp)
+        fp.close()
+    finally:
+        _checksums_lock.release()
+
+def lookup_checksum(dir_path, fname):
+    # returns (algo, hexdigest) or None
+    ck_path = os.path.join(dir_path, CHECKSUMS_FN)
+    if not os.path.exists(ck_path):
+        return None
+    try:
+        fp = open(ck_path, "r")
+        checksums = json.load(fp)
+        fp.close()
+        algo, hexdigest, size, mtime = checksums[fname]
+        st = os.stat(os.path.join(dir_path, fname))
+    except Exception:
+        return None
+    if st.st_size != size or int(st.st_mtime) != mtime:
+        return None
+    return algo.encode('ascii'), hexdigest.encode('ascii')
+
+def copy_with_checksum(src, dst, algo):
+    # copies the file src to dst (a file or a directory) and records
+    # the checksum of the data computed on the way.
+    # Returns the hexdigest.
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    ck = new_checksum(algo)
+    src_fp = open(src, "rb")
+    dst_fp = open(dst, "wb")
+    try:
+        while True:
+            buff = src_fp.read(CHECKSUM_BLK_SZ)
+            if not buff: break
+            if ck: ck.update(buff)
+            dst_fp.write(buff)
+    finally:
+        src_fp.close()
+        dst_fp.close()
+    shutil.copymode(src, dst)
+    if not ck:
+        return None
+    hexdigest = ck.hexdigest()
+    record_checksum(os.path.dirname(dst), os.path.basename(dst), algo, hexdigest)
+    return hexdigest
+
+
+# ------------ file utils: in-kernel copy  -----------------
+#  Python 2 has neither os.sendfile nor os.copy_file_range, they are
+#  called from libc via ctypes if the libc/kernel provides them.
+
+COPY_CHUNK = 1 << 30       # max bytes per copy_file_range/sendfile call
+MMAP_COPY_CHUNK = 8 << 20  # block size for the user-space fallback
+
+_libc = None
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except Exception:
+    _libc = None
+
+def _libc_func(name, restype, argtypes):
+    if None == _libc: return None
+    try:
+        func = getattr(_libc, name)
+    except AttributeError:
+        return None
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+_c_loff_p = ctypes.POINTER(ctypes.c_longlong)
+
+# ssize_t copy_file_range(int fd_in, loff_t *off_in,
+#                         int fd_out, loff_t *off_out,
+#                         size_t len, unsigned int flags);
+_copy_file_range = _libc_func(
+    'copy_file_range', ctypes.c_ssize_t,
+    [ctypes.c_int, _c_loff_p, ctypes.c_int, _c_loff_p,
+     ctypes.c_size_t, ctypes.c_uint])
+
+# ssize_t sendfile64(int out_fd, int in_fd, off64_t *offset, size_t count);
+_sendfile = _libc_func(
+    'sendfile64', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_int, _c_loff_p, ctypes.c_size_t])
+
+# errors meaning the call is not usable for these files,
+# the next method is tried
+_COPY_FALLBACK_ERRNOS = (
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+    errno.EBADF,  errno.ENOTSUP if hasattr(errno, 'ENOTSUP') else errno.EINVAL)
+
+def _kernel_copy(method, in_fd, out_fd, offset, length):
+    # returns the number of bytes copied, which is less than length only
+    # if the method is not supported (then nothing has been copied)
+    off = ctypes.c_longlong(offset)
+    done = 0
+    while done < length:
+        count = min(length - done, COPY_CHUNK)
+        if method == 'copy_file_range':
+            n = _copy_file_range(in_fd, ctypes.byref(off), out_fd, None, count, 0)
+        else:
+            n = _sendfile(out_fd, in_fd, ctypes.byref(off), count)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if done == 0 and err in _COPY_FALLBACK_ERRNOS:
+                return 0
+            raise OSError(err, method + ": " + os.strerror(err))
+        if n == 0:
+            raise IngestionError(method + ": unexpected end of file")
+        done += n
+    return done
+
+def copy_file_part(src_fp, dst_fp, offset, length, checksum=None):
+    """ Copies length bytes starting at offset of the file src_fp to the
+        current position of dst_fp (both are open file objects).
+        The data is copied by the kernel with copy_file_range (which
+        may share the blocks on reflink capable file systems) or
+        sendfile if available, otherwise via mmap in large blocks.
+        If checksum (see new_checksum) is given the data must pass
+        through user space, the mmap blocks are then also used to
+        update the checksum.
+        Returns the name of the method used.
+    """
+    dst_fp.flush()
+    if length <= 0:
+        return 'none'
+    in_fd  = src_fp.fileno()
+    out_fd = dst_fp.fileno()
+    for method, func in (('copy_file_range', _copy_file_range),
+                         ('sendfile',        _sendfile)):
+        if None == func or None != checksum: continue
+        if _kernel_copy(method, in_fd, out_fd, offset, length) == length:
+            return method
+
+    mm = mmap.mmap(in_fd, 0, access=mmap.ACCESS_READ)
+    try:
+        end = offset + length
+        pos = offset
+        while pos < end:
+            nxt = min(pos + MMAP_COPY_CHUNK, end)
+            buff = mm[pos:nxt]
+            if None != checksum:
+                checksum.update(buff)
+            dst_fp.write(buff)
+            pos = nxt
+        dst_fp.flush()
+    finally:
+        mm.close()
+    return 'mmap'
+
+# ------------ file utils: product relocation  -----------------
+#  A product (file or directory tree) is put into its product dir with
+#  the cheapest method that works for each file:
+#    rename          - same file system, only if the source may go
+#    hardlink        - same file system, the data is shared; only if the
+#                      source may go, since a change of the placed file
+#                      in place (scripts, chmod) would change it too
+#    reflink         - FICLONE, the blocks are shared copy-on-write
+#                      (btrfs, xfs, ..)
+#    copy_file_range - in-kernel copy
+#    copy            - user-space copy, the checksum is computed on the way
+#  A method that failed is not tried again for the rest of the tree.
+#  The files of a tree are processed by a bounded pool of threads.
+
+RELOCATE_METHODS = ('rename', 'hardlink', 'reflink', 'copy_file_range', 'copy')
+
+FICLONE = 0x40049409   # _IOW(0x94, 9, int)
+
+# errors meaning the method is not usable for these files
+_RELOCATE_FALLBACK_ERRNOS = _COPY_FALLBACK_ERRNOS + (
+    errno.EPERM, errno.EACCES, errno.ENOTTY, errno.EMLINK, errno.EROFS)
+
+def _relocate_file(src, dst, move, algo, skip):
+    # returns (method, size)
+    size = os.lstat(src).st_size
+    if move and 'rename' not in skip:
+        try:
+            os.rename(src, dst)
+            return 'rename', size
+        except OSError as e:
+            if e.errno not in _RELOCATE_FALLBACK_ERRNOS: raise
+            skip.add('rename')
+    method = None
+    if move and 'hardlink' not in skip:
+        try:
+            os.link(src, dst)
+            method = 'hardlink'
+        except OSError as e:
+            if e.errno not in _RELOCATE_FALLBACK_ERRNOS: raise
+            skip.add('hardlink')
+    ck = None
+    if None == method:
+        src_fp = open(src, "rb")
+        dst_fp = open(dst, "wb")
+        try:
+            if 'reflink' not in skip:
+                try:
+                    fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+                    method = 'reflink'
+                except IOError as e:
+                    if e.errno not in _RELOCATE_FALLBACK_ERRNOS: raise
+                    skip.add('reflink')
+            if None == method and None != _copy_file_range and \
+                    'copy_file_range' not in skip:
+                if _kernel_copy('copy_file_range', src_fp.fileno(),
+                                dst_fp.fileno(), 0, size) == size:
+                    method = 'copy_file_range'
+                else:
+                    skip.add('copy_file_range')
+            if None == method:
+                ck = new_checksum(algo)
+                while True:
+                    buff = src_fp.read(CHECKSUM_BLK_SZ)
+                    if not buff: break
+                    if ck: ck.update(buff)
+                    dst_fp.write(buff)
+                method = 'copy'
+        finally:
+            src_fp.close()
+            dst_fp.close()
+        shutil.copymode(src, dst)
+        if ck:
+            record_checksum(os.path.dirname(dst), os.path.basename(dst),
+                            algo, ck.hexdigest())
+    if move:
+        try:
+            os.unlink(src)
+        except OSError:
+            pass
+    return method, size
+
+def relocate_summary(stats):
+    # one line for the log
+    methods = ", ".join(["%s: %d" % (m, stats["methods"][m])
+                         for m in RELOCATE_METHODS if m in stats["methods"]])
+    return "%d files, %.1f MB in %.2f s (%.1f MB/s), %s" % \
+        (stats["files"], stats["bytes"] / (1024.0*1024.0), stats["secs"],
+         stats["mbPerSec"], methods or "no files")
+
+def relocate(src, dst_dir, move=True, n_threads=1, algo=None):
+    """ Puts the file or directory src into dst_dir, as
+        dst_dir/<basename of src>, with the methods described above.
+        If move is False the source is left in place and not shared
+        with the result (rename and hardlink are not used).  algo is the checksum algorithm for files that are copied
+        in user space, see copy_with_checksum.
+        Returns a dict
+          {"methods": {method: number of files}, "files": n,
+           "bytes": n, "secs": s, "mbPerSec": x}
+    """
+    t0 = time.time()
+    src = src.rstrip(os.sep)
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    if os.path.lexists(dst):
+        raise IngestionError("Destination exists: " + dst)
+    skip = set()
+    pairs = []
+    whole_dir = False
+    if not os.path.isdir(src) or os.path.islink(src):
+        pairs.append( (src, dst) )
+    else:
+        if move:
+            try:
+                os.rename(src, dst)
+                whole_dir = True
+            except OSError as e:
+                if e.errno not in _RELOCATE_FALLBACK_ERRNOS: raise
+                skip.add('rename')
+        top = dst if whole_dir else src
+        for root, dirs, files in os.walk(top):
+            rel = os.path.relpath(root, top)
+            out_dir = os.path.normpath(os.path.join(dst, rel))
+            if not whole_dir:
+                os.mkdir(out_dir)
+                shutil.copymode(root, out_dir)
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    if not whole_dir:
+                        os.symlink(os.readlink(path),
+                                   os.path.join(out_dir, name))
+                elif name in files:
+                    pairs.append( (path, os.path.join(out_dir, name)) )
+
+    results = []
+    if whole_dir:
+        results = [ ('rename', os.lstat(p[0]).st_size) for p in pairs ]
+    elif len(pairs) > 1 and n_threads > 1:
+        pool = ThreadPool(min(n_threads, len(pairs)))
+        try:
+            results = pool.map(
+                lambda p: _relocate_file(p[0], p[1], move, algo, skip), pairs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for s, d in pairs:
+            results.append( _relocate_file(s, d, move, algo, skip) )
+    if move and not whole_dir and os.path.isdir(src) \
+            and not os.path.islink(src):
+        shutil.rmtree(src, ignore_errors=True)
+
+    stats = {"methods": {}, "files": len(results), "bytes": 0}
+    for method, size in results:
+        stats["methods"][method] = stats["methods"].get(method, 0) + 1
+        stats["bytes"] += size
+    stats["secs"] = time.time() - t0
+    stats["mbPerSec"] = 0.0
+    if stats["secs"] > 0:
+        stats["mbPerSec"] = stats["bytes"] / (1024.0*1024.0) / stats["secs"]
+    return stats
+
+def find_closing_boundary(fp, start, raw_bound):
+    """ Searches the file fp from offset start for raw_bound, using mmap
+        so that a boundary is found regardless of block edges.
+        Returns a tuple (pos, trailer_len): pos is the offset of the
+        boundary that ends the part starting at start, or -1 if not
+        found; trailer_len is the number of bytes following that
+        boundary up to the end of the file.
+        If the boundary is followed only by the closing '--' and an
+        end of line the part is the last one, and the last occurrence
+        is used, so that data containing the boundary string is not
+        cut short.  Otherwise the first occurrence is returned.
+    """
+    size = os.fstat(fp.fileno()).st_size
+    if size <= start:
+        return -1, 0
+    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = mm.rfind(raw_bound, start)
+        if pos < 0:
+            return -1, 0
+        trailer_len = size - (pos + len(raw_bound))
+        if trailer_len > 4:
+            first = mm.find(raw_bound, start)
+            if first >= 0:
+                pos = first
+                trailer_len = size - (pos + len(raw_bound))
+        return pos, trailer_len
+    finally:
+        mm.close()
+
 
 # ------------ file utils: splitting, data handling  -----------------
 def read_headers(fp):
@@ -406,12 +981,15 @@ def read_headers(fp):
     return headers
 
 
-def split_wcs_raw(path, f, logger):
+def split_wcs_raw(path, f, logger, checksum_algo=None):
     """ TEMPORARY: splits a file into mime/multipart parts.
         path is the directory where the product is dowloaded to and
              also where the new metadata, and data files are to be
              created.
         f  is the mime/multipart source as downloaded by the DM.
+        checksum_algo: if set (see new_checksum), the checksum of the
+             data part is computed while it is copied and added to the
+             returned manifest string.
         The algorithm more or less expects the boundary to be '--wcs',
         but will check and try with whatever it finds in the
         first line.
@@ -423,7 +1001,7 @@ def split_wcs_raw(path, f, logger):
     base_fn = f
     manif_str = None
     base_full_path = os.path.join(path, base_fn)
-    fp = open(base_full_path, "r")
+    fp = open(base_full_path, "rb")
     meta_fp = None
     data_fp = None
     meta_fname = base_fn + META_SUFFIX
@@ -475,6 +1053,8 @@ def split_wcs_raw(path, f, logger):
         if not l.startswith('<?xml'):
             logger.warning("No xml start tag found in "+base_full_path)
         while l != boundary:
+            if not l:
+                raise IngestionError("No data part found in "+base_full_path)
             meta_fp.write(l)
             l = fp.readline()
         meta_fp.close()
@@ -518,30 +1098,27 @@ def split_wcs_raw(path, f, logger):
             # just bail rather than try to create a unique one.
             raise IngestionError("File exists: "+data_full_path)
 
-        data_fp = open(data_full_path, "w")
-        buff = None
-        while True:
-            buff = fp.read(BLK_SZ)
-            if not buff:
-                break
-            if raw_bound in buff:
-                break
-            data_fp.write(buff)
-        if not buff:
+        # locate the data part, then let the kernel copy it
+        data_start = fp.tell()
+        data_end, trailer_len = find_closing_boundary(fp, data_start, raw_bound)
+        if data_end < 0:
             logger.warning("Unexpected EOF while splitting "+base_full_path)
             delete_orig = False
-        else:
-            rests = buff.split(raw_bound)
-            if len(rests) < 2:
-                logger.warning("Failed to separate colosing boundary, f=" + base_full_path)
-                delete_orig = False
-            elif len(rests[1]) > 4:
-                logger.warning("unexpected trailing chars after boundary, f="+base_full_path)
-                delete_orig = False
-            data_fp.write(rests[0])
+            data_end = os.fstat(fp.fileno()).st_size
+        elif trailer_len > 4:
+            logger.warning("unexpected trailing chars after boundary, f="+base_full_path)
+            delete_orig = False
 
+        checksum = new_checksum(checksum_algo)
+        data_fp = open(data_full_path, "wb")
+        t0 = time.time()
+        method = copy_file_part(
+            fp, data_fp, data_start, data_end-data_start, checksum)
         data_fp.close()
         fp.close()
+        dt = time.time() - t0
+        logger.debug("split " + base_fn + ": " + `data_end-data_start` +
+                     " bytes by " + method + " in %.3fs" % dt)
 
         if delete_orig:
             try:
@@ -554,6 +1131,10 @@ def split_wcs_raw(path, f, logger):
             if h in hdrs:
                 extra_manifest += h + '="' + hdrs[h] + '"\n'
 
+        if None != checksum:
+            extra_manifest += checksum_manifest_lines(
+                checksum_algo.lower(), checksum.hexdigest())
+
         manif_str = \
             'METADATA="'+meta_fname + '"\n' + \
             'META_TYPE="'+meta_type + '"\n' + \
@@ -600,6 +1181,8 @@ def create_manifest(logger,
     #    DOWNLOAD_DIR="/path/p_scid0_001"
     #    METADATA="ows.meta"
     #    DATA="p1.tif"
+    #    DATA_CHECKSUM_TYPE="sha256"      (optional)
+    #    DATA_CHECKSUM="9f86d08..."       (optional)
     # Note that filenames in the manifest are relative to the DOWNLOAD_DIR.
 
     manif_str = \
@@ -611,6 +1194,10 @@ def create_manifest(logger,
     if data:
         # full_data = os.path.join(dir_path, data)
         manif_str += 'DATA="'           + data     + '"\n'
+        # checksum recorded when the data was uploaded or copied
+        ck = lookup_checksum(dir_path, data)
+        if None != ck:
+            manif_str += checksum_manifest_lines(ck[0], ck[1])
     if orig_data:
         # full_orig = os.path.join(dir_path, orig_data)
         manif_str += 'ORIG_DATA="'      + orig_data + '"\n'
@@ -624,7 +1211,7 @@ def create_manifest(logger,
 # TODO: the splitting should be done by the EO-WCS DM plugin
 #       instead of doing it here
 #
-def split_and_create_mf(dl_dir, d, ncn_id, logger):
+def split_and_create_mf(dl_dir, d, ncn_id, logger, checksum_algo=None):
 
     dir_path  = os.path.join(dl_dir, d)
     manif_str = ''
@@ -634,14 +1221,16 @@ def split_and_create_mf(dl_dir, d, ncn_id, logger):
         logger.warning("Found " + `len(files)` + " in " + dir_path + \
                            ", expect 1.")
     for f in files:
-        if f.startswith(MANIFEST_FN) or f.endswith(META_SUFFIX) or f.endswith(DATA_SUFFIX):
+        if f.startswith(MANIFEST_FN) or f.endswith(META_SUFFIX) or \
+                f.endswith(DATA_SUFFIX) or f == CHECKSUMS_FN:
             logger.warning("Ingestion: ignoring "+f)
             continue
         if f.endswith(TIFF_SUFFIX) or f.endswith(TIF_SUFFIX):
             logger.warning("Ingestion: Unexpected TIFF file, ignoring: "+f)
             continue
 
-        ret_str, metafile, df = split_wcs_raw(dir_path, f, logger)
+        ret_str, metafile, df = split_wcs_raw(
+            dir_path, f, logger, checksum_algo)
         if not ret_str:
             logger.error("Failed to split file '"+f+"'.")
             continue
@@ -724,6 +1313,7 @@ def get_spatialReference(srsName):
     try:
         ref = spatial_refs[srsName]
     except KeyError:
+        key = srsName
         if srsName.startswith("http://www.opengis.net/def/crs/EPSG"):
             epsg = (srsName.split('/')[-1])
             srsName = 'EPSG:'+epsg
@@ -731,6 +1321,7 @@ def get_spatialReference(srsName):
         ret = ref.SetFromUserInput(srsName)
         if 0 != ret:
             raise NoEPSGCodeError("Unknown EPSG code "+srsName)
+        spatial_refs[key] = ref
         spatial_refs[srsName] = ref
     return ref
 
@@ -742,25 +1333,138 @@ def srs_is_WGS84(srs):
     except Exception as e:
         return False
    
+# Transformations to WGS84, keyed by srsName; None for srsNames that
+# are WGS84 already.  The osr transformation objects are not shared
+# between threads, each thread has its own cache.
+_transform_cache = threading.local()
+
+def get_transform_to_WGS84(srs):
+    try:
+        cache = _transform_cache.cts
+    except AttributeError:
+        cache = _transform_cache.cts = {}
+    try:
+        return cache[srs]
+    except KeyError:
+        pass
+    if srs_is_WGS84(srs):
+        ct = None
+    else:
+        srcRef = get_spatialReference(srs)
+        ct = osr.CoordinateTransformation(srcRef, SPATIAL_REF_WGS84)
+    cache[srs] = ct
+    return ct
 
 def bbox_to_WGS84(srs, bbox):
-    if srs_is_WGS84(srs): return
-    srcRef = get_spatialReference(srs)
-    ct=osr.CoordinateTransformation(srcRef, SPATIAL_REF_WGS84)
-    new_ll = ct.TransformPoint(bbox.ll[0], bbox.ll[1])
-    new_ur = ct.TransformPoint(bbox.ur[0], bbox.ur[1])
+    ct = get_transform_to_WGS84(srs)
+    if None == ct: return
+    new_ll, new_ur = ct.TransformPoints( [bbox.ll, bbox.ur] )
     bbox.ll = (new_ll[0], new_ll[1])
     bbox.ur = (new_ur[0], new_ur[1])
 
 # ------------ untar/unzip  --------------------------
-IE_TARZIP_COMMANDS = {
-    '.tgz'    :  ['tar', 'xzf'],
-    '.gz'     :  ['gunzip'],
-    '.tar'    :  ['tar', 'xf' ],
-    '.zip'    :  ['unzip'],
-#    '.tbz2'   :  
-#    '.tbz'    :  
-    }
+#  Unpacking is done in-process with tarfile, gzip and zipfile, using
+#  absolute paths only (no chdir), so that several products may be
+#  unpacked at the same time by different worker threads.
+
+IE_UNPACK_TYPES = ('.tgz', '.gz', '.tar', '.zip')
+
+UNPACK_BLK_SZ = 1024*1024
+# zip members larger than this are extracted in parallel threads
+UNPACK_PARALLEL_MIN = 64*1024*1024
+UNPACK_THREADS = 4
+
+def safe_join(targetdir, name):
+    # Returns the absolute path of name within targetdir, raises
+    # IngestionError if name is absolute or would end up outside of
+    # targetdir (e.g. '../x', or through a symlink).
+    if not name or os.path.isabs(name) or name.startswith('\\'):
+        raise IngestionError("Unsafe path in archive: " + `name`)
+    root = os.path.realpath(targetdir)
+    full = os.path.realpath(os.path.join(root, name))
+    if full != root and not full.startswith(root + os.sep):
+        raise IngestionError("Unsafe path in archive: " + `name`)
+    return full
+
+def _copy_stream(src, dst_path):
+    dst = open(dst_path, "wb")
+    try:
+        shutil.copyfileobj(src, dst, UNPACK_BLK_SZ)
+    finally:
+        dst.close()
+
+def unpack_tar(targetdir, tarpath):
+    # the archive is read sequentially ('r|*'), compressed or not
+    tf = tarfile.open(tarpath, 'r|*')
+    try:
+        for m in tf:
+            full = safe_join(targetdir, m.name)
+            if m.issym():
+                # relative to the link's directory, within the archive
+                safe_join(targetdir,
+                          os.path.join(os.path.dirname(m.name), m.linkname))
+            elif m.islnk():
+                safe_join(targetdir, m.linkname)
+            elif not (m.isfile() or m.isdir()):
+                # devices, fifos: never extracted
+                continue
+            tf.extract(m, targetdir)
+    finally:
+        tf.close()
+
+def unpack_gz(targetdir, gzpath, outname):
+    src = gzip.open(gzpath, "rb")
+    try:
+        _copy_stream(src, safe_join(targetdir, outname))
+    finally:
+        src.close()
+
+def _unzip_member(args):
+    # runs in a pool thread, each thread uses its own ZipFile instance
+    zippath, name, dst_path = args
+    zf = zipfile.ZipFile(zippath, "r")
+    try:
+        src = zf.open(name)
+        try:
+            _copy_stream(src, dst_path)
+        finally:
+            src.close()
+    finally:
+        zf.close()
+
+def unpack_zip(targetdir, zippath, n_threads=UNPACK_THREADS):
+    zf = zipfile.ZipFile(zippath, "r")
+    large = []
+    try:
+        for info in zf.infolist():
+            full = safe_join(targetdir, info.filename)
+            if info.filename.endswith('/'):
+                if not os.path.isdir(full):
+                    os.makedirs(full)
+                continue
+            parent = os.path.dirname(full)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if n_threads > 1 and info.file_size >= UNPACK_PARALLEL_MIN:
+                large.append( (zippath, info.filename, full) )
+                continue
+            src = zf.open(info)
+            try:
+                _copy_stream(src, full)
+            finally:
+                src.close()
+    finally:
+        zf.close()
+
+    if len(large) == 1:
+        _unzip_member(large[0])
+    elif large:
+        pool = ThreadPool(min(n_threads, len(large)))
+        try:
+            pool.map(_unzip_member, large)
+        finally:
+            pool.close()
+            pool.join()
 
 def ie_unpack_maybe(targetdir, data):
     # if data is a tar, zip or gzip file with a known extension,
@@ -776,8 +1480,11 @@ def ie_unpack_maybe(targetdir, data):
     #  Returns: The unpacked filename is returned, or the original
     #  name if no unpacking was done.
     #  If the input data file does not exist, return 'None'.
+    #  Archive members that would be unpacked outside of targetdir
+    #  cause an IngestionError.
     #
 
+    targetdir = os.path.abspath(targetdir)
     fullpath = os.path.join(targetdir, data)
     if not os.path.exists(fullpath):
         return None
@@ -785,7 +1492,7 @@ def ie_unpack_maybe(targetdir, data):
     fn, ext = os.path.splitext(data)
 
     # Don't unpack unless we have a known extension
-    if not ext or not ext in IE_TARZIP_COMMANDS:
+    if not ext or not ext in IE_UNPACK_TYPES:
         return data
 
     # handle the case of '.tar.gz'
@@ -795,31 +1502,28 @@ def ie_unpack_maybe(targetdir, data):
             ext = '.tgz'
             fn = fn2
 
-    cmd = []
-    for c in IE_TARZIP_COMMANDS[ext]:
-        cmd.append(c)
-    cmd.append(data)
-
-    curr_dir = os.getcwd()
-    os.chdir(targetdir)
-    r = subprocess.call(cmd)
-    if 0 == r:
-        os.unlink(data)
-    os.chdir(curr_dir)
-    if 0 != r:
-        print >>sys.stderr, "Non-zero cmd status ie_unpack_maybe: "  + `r`
-        raise IngestionError ("Unpacking failed, status: " + `r`)
+    try:
+        if ext in ('.tgz', '.tar'):
+            unpack_tar(targetdir, fullpath)
+        elif ext == '.gz':
+            unpack_gz(targetdir, fullpath, fn)
+        else:
+            unpack_zip(targetdir, fullpath)
+    except IngestionError:
+        raise
+    except Exception as e:
+        raise IngestionError ("Unpacking " + data + " failed: " + `e`)
+
+    os.unlink(fullpath)
 
     # The basenae of the tar archive is passed to ODA as
     # the entry 'DATA= ' in the MANIFEST file.
     return fn
 
 def get_glob_list(targetdir, suffix):
-    curr_dir = os.getcwd()
-    os.chdir(targetdir)
-    glob_list = glob.glob("*"+suffix)
-    os.chdir(curr_dir)
-    return glob_list
+    # like glob.glob("*"+suffix) in targetdir, without chdir
+    return [f for f in fnmatch.filter(os.listdir(targetdir), "*"+suffix)
+            if not f.startswith('.')]
 
 def extract_outfile(src_str):
     outfile_str = ''
@@ -829,6 +1533,74 @@ def extract_outfile(src_str):
         outfile_str = src_str
     return outfile_str
 
+# ------------ Batched script invocation  --------------------------
+#  A script that contains the marker line
+#      # IE-BATCH-PROTOCOL: 1
+#  within its first SCRIPT_MARKER_SZ bytes is started once for a batch
+#  of products instead of once per product:
+#      script -batch=<manifest list> -response=<response file> [-catreg=..]
+#  The manifest list contains the names of the products' manifest files,
+#  one per line.  For each product the script writes a line
+#      <status> <manifest file>
+#  to the response file, status 0 means success.  Products that have no
+#  line in the response file are treated as failed.
+
+SCRIPT_BATCH_MARKER = "IE-BATCH-PROTOCOL: 1"
+SCRIPT_MARKER_SZ    = 4096
+
+# key is the script path, value is (mtime, supports_batch)
+_batch_script_cache = {}
+
+def script_supports_batch(script):
+    try:
+        mtime = os.stat(script).st_mtime
+    except OSError:
+        return False
+    cached = _batch_script_cache.get(script)
+    if None != cached and cached[0] == mtime:
+        return cached[1]
+    supported = False
+    try:
+        fp = open(script, "r")
+        try:
+            supported = SCRIPT_BATCH_MARKER in fp.read(SCRIPT_MARKER_SZ)
+        finally:
+            fp.close()
+    except IOError:
+        pass
+    _batch_script_cache[script] = (mtime, supported)
+    return supported
+
+def write_manifest_list(dir_path, mf_names):
+    # returns the names of the manifest list and of the (not yet
+    # existing) response file
+    fp, list_fn = open_unique_file(dir_path, ".ie_batch_"+mkIdBase(), 32)
+    try:
+        for mf in mf_names:
+            fp.write(mf + "\n")
+    finally:
+        fp.close()
+    return list_fn, list_fn + ".resp"
+
+def read_batch_response(resp_fn, mf_names):
+    # returns a dict { mf_name: status }, missing entries are -1
+    status = dict( [(mf, -1) for mf in mf_names] )
+    if not os.path.exists(resp_fn):
+        return status
+    fp = open(resp_fn, "r")
+    try:
+        for line in fp:
+            parts = line.strip().split(None, 1)
+            if len(parts) != 2 or parts[1] not in status:
+                continue
+            try:
+                status[parts[1]] = int(parts[0])
+            except ValueError:
+                pass
+    finally:
+        fp.close()
+    return status
+
 # ------------ Dummy logger  --------------------------
 
 class DummyLogger():
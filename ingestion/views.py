@@ -22,6 +22,7 @@ from django.views.defaults import server_error
 from django.utils.timezone import utc
 from django.contrib.auth import authenticate, login
 from django.http import Http404
+from django.core.servers.basehttp import FileWrapper
 from django.forms.util import ErrorList
 from urllib2 import URLError
 from ingestion_logic import create_dl_dir
@@ -30,10 +31,13 @@ import os
 import logging
 import json
 import re
+import shutil
+import tempfile
 
 import models
 import forms
 import work_flow_manager
+import spawn_service
 
 from settings import \
     IE_DEBUG, \
@@ -47,19 +51,44 @@ from settings import \
     IE_DEFAULT_DEL_SCRIPT, \
     JQUERYUI_OFFLINEURL, \
     SC_NCN_ID_BASE, \
-    AUTHENTICATION_BACKENDS
+    AUTHENTICATION_BACKENDS, \
+    IE_DM_RESPONSE_MAX_SIZE, \
+    IE_CHECKSUM_ALGO, \
+    IE_STATUS_POLL_TIMEOUT, \
+    IE_UPLOAD_STATE_DIR, \
+    IE_UPLOAD_MAX_AGE
 
 from utils import \
-    read_from_url, \
+    fetch_json, \
+    fetch_url, \
+    FileSink, \
+    new_checksum, \
+    record_checksum, \
     ManageScenarioError
 
 from dm_control import \
     DownloadManagerController, \
     DM_DAR_STATUS_COMMAND
 
-from uqmd import updateMetaData
+from uqmd import updateMetaData, updateMetaDataBatch
 
-from add_product import add_product_submit
+from status_feed import status_feed
+
+from product_upload import \
+    ProductDirUploadHandler, \
+    ProductFile, \
+    UploadError, \
+    UploadOffsetError, \
+    purge_uploads, \
+    start_upload, \
+    load_upload, \
+    upload_status, \
+    write_chunk, \
+    finish_upload
+
+from add_product import add_product_submit, product_status
+
+from local_batch import local_batch_submit, batch_status
 
 
 IE_DEFAULT_USER = r'drtest'
@@ -67,6 +96,9 @@ IE_DEFAULT_PASS = r'1234'
 
 IE_RE_NCN_FORBIDDEN = re.compile(r"[/:|%@]")
 
+# block size for streaming DARs to the DM
+DAR_BLK_SZ = 65536
+
 dmcontroller = DownloadManagerController.Instance()
 logger = logging.getLogger('dream.file_logger')
 
@@ -110,10 +142,14 @@ def get_scenario_ncn_id(scenario_id):
     return models.Scenario.objects.get(id=int(scenario_id)).ncn_id
 
 def get_or_create_scenario_status(s):
+    # With select_related('scenariostatus') a missing status is
+    # cached as None instead of raising DoesNotExist.
     sstat = None
     try:
         sstat = s.scenariostatus
     except models.ScenarioStatus.DoesNotExist:
+        pass
+    if None == sstat:
         sstat = models.ScenarioStatus(
             scenario=s,
             is_available=1,
@@ -248,6 +284,19 @@ def do_post_operation(op, request):
         logger.error("Unxexpected GET request on url "+`request.path_info`)
         raise Http404
 
+def do_stream_operation(op, request):
+    # as do_post_operation, but op reads the body from the request (a
+    # file-like object) itself, instead of getting it as a string
+    if request.method == 'POST':
+        response_data = op(request, request.META)
+        return HttpResponse(
+            json.dumps(response_data),
+            content_type="application/json")
+
+    else:
+        logger.error("Unxexpected GET request on url "+`request.path_info`)
+        raise Http404
+
 def auto_login(request):
     if not IE_AUTO_LOGIN:
         return
@@ -572,10 +621,56 @@ def saveFile(upload_file, path):
     filename = upload_file._get_name()
     path_file_name = os.path.join(path, filename)
     logger.info('Saving file: ' + path_file_name)
+    ck = new_checksum(IE_CHECKSUM_ALGO)
     fd = open(path_file_name, 'wb')
     for chunk in upload_file.chunks():
+        if ck: ck.update(chunk)
         fd.write(chunk)
     fd.close()
+    if ck:
+        record_checksum(path, filename, IE_CHECKSUM_ALGO, ck.hexdigest())
+
+def store_upload(upload_file, path):
+    # files from the ProductDirUploadHandler are already in place
+    if isinstance(upload_file, ProductFile):
+        upload_file.close()
+    else:
+        saveFile(upload_file, path)
+    return upload_file._get_name().encode('ascii','ignore')
+
+def mk_product_dir(ncn_id):
+    full_directory_name, directory_name = create_dl_dir(ncn_id+"_")
+    full_directory_name = full_directory_name.encode('ascii','ignore')
+    logger.info("Product directory name:" + full_directory_name)
+    return full_directory_name
+
+def submit_local_product(wfm, scenario, full_directory_name, meta, data):
+    # send request/task to work-flow-manager to ingest the product
+    # in full_directory_name; meta and data are file names in it
+    ncn_id = scenario.ncn_id.encode('ascii','ignore')
+    scripts = []
+    if scenario.oda_server_ingest != 0:
+        scripts.append(os.path.join(IE_SCRIPTS_DIR, IE_DEFAULT_ADDPROD_SCRIPT))
+    if len(scripts) == 0:
+        logger.warning("Scenario '%s' name='%s' does not have scripts to ingest, proceeding regardless." \
+            % (ncn_id,scenario.scenario_name))
+
+    current_task = work_flow_manager.WorkerTask(
+        {"scenario_id": scenario.id,
+         "ncn_id"   : ncn_id,
+         "task_type": "INGEST_LOCAL_PROD",
+         "scripts"  : scripts,
+         "cat_registration" : scenario.cat_registration,
+         "s2_preprocess"    : scenario.s2_preprocess,
+         "dir_path" : full_directory_name,
+         "metadata" : meta,
+         "data"     : data,
+         })
+
+    wfm.put_task_to_queue(current_task)
+    logger.info("Local ingest scenario - submitted to queue: " +
+                "id=%d, ncn_id='%s', name='%s'" \
+              % (scenario.id, ncn_id, scenario.scenario_name))
 
 def odaAddLocalProductOld(request, ncn_id):
     oda_init(request)
@@ -681,56 +776,51 @@ def add_local_product_core(request, ncn_id, template, aftersave=None):
 
         if wfm.lock_scenario(sc_id):
 
+            # the product files are written directly into the product
+            # dir while the request is read; must be set up before
+            # request.POST or request.FILES are accessed
+            handler = ProductDirUploadHandler(
+                lambda: mk_product_dir(ncn_id),
+                ('metadataFile', 'rasterFile'),
+                IE_CHECKSUM_ALGO,
+                request)
+            request.upload_handlers.insert(0, handler)
+            full_directory_name = None
+
             try:
 
               form = forms.AddLocalProductForm(request.POST, request.FILES)
               if form.is_valid() and form.is_multipart():
 
-                  full_directory_name, directory_name = create_dl_dir(ncn_id+"_")
-                  full_directory_name = full_directory_name.encode('ascii','ignore')
-                  logger.info("Product directory name:" + full_directory_name)
+                  full_directory_name = handler.dir_path
+                  if None == full_directory_name:
+                      full_directory_name = mk_product_dir(ncn_id)
 
                   if 'metadataFile' in request.FILES:
-                      saveFile(request.FILES['metadataFile'], full_directory_name)
-                      meta = request.FILES['metadataFile']._get_name().encode('ascii','ignore')
-
+                      meta = store_upload(request.FILES['metadataFile'],
+                                          full_directory_name)
                   else:
                       meta = None
 
-                  saveFile(request.FILES['rasterFile'], full_directory_name)
-                  data = request.FILES['rasterFile']._get_name().encode('ascii','ignore')
-
-                  scripts = []
-                  if scenario.oda_server_ingest != 0:
-                      scripts.append(os.path.join(IE_SCRIPTS_DIR, IE_DEFAULT_ADDPROD_SCRIPT))
-                  if len(scripts) == 0:
-                      logger.warning("Scenario '%s' name='%s' does not have scripts to ingest, proceeding regardless." \
-                          % (ncn_id,scenario.scenario_name))
-
-                  # send request/task to work-flow-manager to run script
-                  current_task = work_flow_manager.WorkerTask(
-                      {"scenario_id": sc_id,
-                       "ncn_id"   : ncn_id,
-                       "task_type": "INGEST_LOCAL_PROD",
-                       "scripts"  : scripts,
-                       "cat_registration" : scenario.cat_registration,
-                       "s2_preprocess"    : scenario.s2_preprocess,
-                       "dir_path" : full_directory_name,
-                       "metadata" : meta,
-                       "data"     : data,
-                       })
-
-                  wfm.put_task_to_queue(current_task)
-                  logger.info("Local ingest scenario - submitted to queue: " +
-                              "id=%d, ncn_id='%s', name='%s'" \
-                            % (sc_id, ncn_id, scenario.scenario_name))
+                  data = store_upload(request.FILES['rasterFile'],
+                                      full_directory_name)
+
+                  submit_local_product(
+                      wfm, scenario, full_directory_name, meta, data)
               else:
                   logger.warning('The add product form has not been fully/correctly filled')
+                  if None != handler.dir_path:
+                      shutil.rmtree(handler.dir_path, ignore_errors=True)
 
             except Exception, e:
                 logger.error("Failed to add local product to Scenario '%s' name=%s" \
                                  % (ncn_id, scenario.scenario_name) + \
                                  'exception = ' + `e`)
+                # the product dir may be partly written
+                if None == full_directory_name:
+                    full_directory_name = handler.dir_path
+                if None != full_directory_name:
+                    shutil.rmtree(full_directory_name, ignore_errors=True)
             finally:
                 wfm.set_scenario_status(0, sc_id, 1, 'IDLE', 0)
 
@@ -774,6 +864,107 @@ def odaAddLocalProduct(request, ncn_id):
         'uploadedPage.html')
 
 
+# ---- resumable uploads of local products
+#  1. POST ingest/addLocalUpload/start/ncn_id=<ncn_id>
+#       {"files": {<file name>: <size>, ...}}   -> {"upload_id": ...}
+#  2. PUT (or POST) ingest/addLocalUpload/chunk/id=<upload_id>/file=<name>
+#       ?offset=<n>, the body is the data       -> {"received": n}
+#  3. GET ingest/addLocalUpload/status/id=<upload_id>
+#                           -> {"files": {name: size}, "received": {...}}
+#  4. POST ingest/addLocalUpload/finish/id=<upload_id>
+#       {"data": <name>, "metadata": <name or null>}
+#  If the offset of a chunk is not the size received so far the
+#  response is HTTP 409 with "received"; the client continues from there.
+
+def upload_operation(func, request, *args):
+    oda_init(request)
+    status = 200
+    try:
+        response_data = func(request, *args)
+        response_data['status'] = 0
+    except UploadOffsetError as e:
+        status = 409
+        response_data = {'status': 1, 'error': "%s" % e,
+                         'received': e.received}
+    except (UploadError, ValueError, KeyError,
+            models.Scenario.DoesNotExist) as e:
+        status = 400
+        response_data = {'status': 1, 'error': "%s" % e}
+    except Exception as e:
+        logger.error("Error in upload_operation(" + `func` + "): " + `e`)
+        status = 500
+        response_data = {'status': 1, 'error': "%s" % e}
+    return HttpResponse(json.dumps(response_data),
+                        content_type="application/json",
+                        status=status)
+
+def uploadStart(request, ncn_id):
+    scenario = models.Scenario.objects.get(ncn_id=ncn_id)
+    files = json.loads(request.read())["files"]
+    purge_uploads(IE_UPLOAD_STATE_DIR, IE_UPLOAD_MAX_AGE)
+    dir_path = mk_product_dir(scenario.ncn_id.encode('ascii','ignore'))
+    try:
+        upload_id = start_upload(
+            IE_UPLOAD_STATE_DIR, scenario.ncn_id, dir_path, files)
+    except Exception:
+        shutil.rmtree(dir_path, ignore_errors=True)
+        raise
+    logger.info("Upload " + upload_id + " started for ncn_id=" +
+                `scenario.ncn_id` + ", files: " + `files.keys()`)
+    return {'upload_id': upload_id}
+
+def uploadChunk(request, upload_id, name):
+    if request.method not in ('PUT', 'POST'):
+        raise UploadError("Request method is not PUT or POST.")
+    state  = load_upload(IE_UPLOAD_STATE_DIR, upload_id)
+    offset = int(request.GET.get('offset', 0))
+    length = int(request.META.get('CONTENT_LENGTH') or 0)
+    received = write_chunk(state, name.encode('ascii','ignore'),
+                           offset, request, length, IE_CHECKSUM_ALGO)
+    return {'received': received}
+
+def uploadStatus(request, upload_id):
+    state = load_upload(IE_UPLOAD_STATE_DIR, upload_id)
+    return {'files'    : state["files"],
+            'received' : upload_status(state)}
+
+def uploadFinish(request, upload_id):
+    state = load_upload(IE_UPLOAD_STATE_DIR, upload_id)
+    params = json.loads(request.read())
+    data = params["data"].encode('ascii','ignore')
+    meta = params.get("metadata")
+    if meta: meta = meta.encode('ascii','ignore')
+    for n in (data, meta):
+        if n and n not in state["files"]:
+            raise UploadError("File not in the upload: " + `n`)
+
+    wfm = work_flow_manager.WorkFlowManager.Instance()
+    scenario = models.Scenario.objects.get(ncn_id=state["ncn_id"])
+    if not wfm.lock_scenario(scenario.id):
+        raise UploadError("Scenario '%s' is busy." % state["ncn_id"])
+    try:
+        dir_path = finish_upload(IE_UPLOAD_STATE_DIR, state, IE_CHECKSUM_ALGO)
+        submit_local_product(wfm, scenario, dir_path, meta, data)
+    finally:
+        wfm.set_scenario_status(0, scenario.id, 1, 'IDLE', 0)
+    return {}
+
+@csrf_exempt
+def uploadStart_operation(request, ncn_id):
+    return upload_operation(uploadStart, request, ncn_id)
+
+@csrf_exempt
+def uploadChunk_operation(request, upload_id, name):
+    return upload_operation(uploadChunk, request, upload_id, name)
+
+@csrf_exempt
+def uploadStatus_operation(request, upload_id):
+    return upload_operation(uploadStatus, request, upload_id)
+
+@csrf_exempt
+def uploadFinish_operation(request, upload_id):
+    return upload_operation(uploadFinish, request, upload_id)
+
 def show_log_core(request, template):
     variables = RequestContext(
         request,
@@ -952,9 +1143,13 @@ def getListScenarios(request):
              'description':'%s' % s.scenario_description})
     return "scenarios", response_data
 
-def getAjaxScenariosList(request):
+def scenario_status_list(user=None):
+    # the scenarios of user, or all of them if user is None
     response_data = []
-    scenarios = models.Scenario.objects.all()
+    # one query for all the scenarios and their status
+    scenarios = models.Scenario.objects.select_related('scenariostatus')
+    if None != user:
+        scenarios = scenarios.filter(user=user)
     for s in scenarios:
         auto_ingest = 0;
         if s.repeat_interval > 0 : auto_ingest = 1;
@@ -970,11 +1165,45 @@ def getAjaxScenariosList(request):
                 'st_st'  :  ss.status,
                 'st_done':  ss.done
             })
-    return "scenarios", response_data
+    return response_data
+
+def getAjaxScenariosList(request):
+    return "scenarios", scenario_status_list()
+
+def getScenarioStatusChanges(request):
+    """ Long-poll for scenario status changes.  The client passes the
+        'version' of its previous response as 'since' (0 at first) and
+        gets the scenarios whose status changed after it, or waits
+        until there is a change or the time-out expires.  If 'full' is
+        true in the response, 'scenarios' is the complete list and the
+        client should replace its list.  Deleted scenarios are sent as
+        {'id':..., 'deleted':true}.
+        A logged-in user (the web UI) gets only their own scenarios.
+    """
+    since = int(request.GET.get('since', 0))
+    timeout = IE_STATUS_POLL_TIMEOUT
+    if 'timeout' in request.GET:
+        timeout = min(float(request.GET['timeout']), IE_STATUS_POLL_TIMEOUT)
+    user = None
+    if None != request and request.user.is_authenticated():
+        user = request.user
+    version, changes = status_feed.get_changes(
+        since, timeout, None if None == user else user.id)
+    full = False
+    if None == changes:
+        # get the version first, so that no change gets lost
+        full = True
+        version = status_feed.get_version()
+        changes = scenario_status_list(user)
+    return {'status'    : 0,
+            'version'   : version,
+            'full'      : full,
+            'scenarios' : changes}
 
 def getScenario(request,args):
     response_data = {}
-    scenario = models.Scenario.objects.get(ncn_id=args[0])
+    scenario = models.Scenario.objects.prefetch_related(
+        *models.SCENARIO_DICT_RELATED).get(ncn_id=args[0])
     response_data = models.scenario_dict(scenario)
     return "scenario", response_data
 
@@ -1123,6 +1352,23 @@ def newScenario(data, request_meta):
     return updateOrNew(data, new_sc_core)
 
 
+def getLocalBatchStatus(request,args):
+    # status: processing, success, failed, stopped, or idError
+    try:
+        return batch_status(int(args[0]))
+    except models.LocalBatch.DoesNotExist:
+        return {'status'      : "idError",
+                'errorString' : "Id not found."}
+
+def getScriptStats(request):
+    # latencies of the external scripts, from the spawn service, and
+    # what the work-flow workers are doing
+    stages = [ {"worker": w, "stage": st, "secs": round(secs, 1)}
+               for w, st, secs in
+               work_flow_manager.WorkFlowManager.Instance().get_stages() ]
+    return {"scripts" : spawn_service.get_stats(),
+            "workers" : stages}
+
 def getAddStatus(request,args):
     # Possible Error values:
     #     processing
@@ -1131,24 +1377,13 @@ def getAddStatus(request,args):
     #     idError
     #
 
-    response_data = {}
-
     iid = int(args[0])
-    pi = None
     try:
         pi = models.ProductInfo.objects.get(id__exact=iid)
-        response_data['status'] = pi.info_status
-
-        if pi.info_error:
-            response_data["errorString"] = pi.info_error
-
-        if pi.new_product_id:
-            response_data["productId"] = pi.new_product_id
-
-        if pi.product_url:
-            response_data["url"] = pi.product_url
+        response_data = product_status(pi)
 
     except models.ProductInfo.DoesNotExist:
+        response_data = {}
         response_data['status'] = "idError"
         response_data["errorString"] = "Id not found."
 
@@ -1255,6 +1490,11 @@ def getAjaxScenariosList_operation(request):
     # expect a GET request
     return get_request_json(getAjaxScenariosList, request)
 
+@csrf_exempt
+def getScenarioStatusChanges_operation(request):
+    # expect a GET request
+    return get_request_json(getScenarioStatusChanges, request, wrapper=False)
+
 @csrf_exempt
 def getScenario_operation(request,ncn_id):
     return get_request_json(getScenario, request, args=(ncn_id,))
@@ -1271,6 +1511,22 @@ def newScenario_operation(request):
 def addProduct_operation(request):
     return do_post_operation(add_product_submit, request)
 
+@csrf_exempt
+def addLocalBatch_operation(request):
+    return do_post_operation(local_batch_submit, request)
+
+@csrf_exempt
+def getLocalBatchStatus_operation(request, batch_id):
+    return get_request_json(getLocalBatchStatus,
+                            request,
+                            args=(batch_id,),
+                            string_error=True,
+                            wrapper=False)
+
+@csrf_exempt
+def getScriptStats_operation(request):
+    return get_request_json(getScriptStats, request, wrapper=False)
+
 @csrf_exempt
 def getAddStatus_operation(request, op_id):
     return get_request_json(getAddStatus,
@@ -1287,14 +1543,17 @@ def darResponse(request,seq_id):
         logger.info("Request to retrieve DAR from" + \
                         `request.META['REMOTE_ADDR']` +\
                         ", id="+`seq_id`)
-        dar = dmcontroller.get_next_dar(seq_id)
-        if None == dar:
+        dar_fp = dmcontroller.get_dar_file(seq_id)
+        if None == dar_fp:
             logger.error("No dar!")
-            server_error(request)
+            return server_error(request)
         else:
-            return HttpResponse(
-                dar,
+            # streamed from the DAR store
+            response = HttpResponse(
+                FileWrapper(dar_fp, DAR_BLK_SZ),
                 content_type="application/xml")
+            response['Content-Length'] = os.fstat(dar_fp.fileno()).st_size
+            return response
     else:
         logger.error("Unxexpected POST request on darResponse url,\n" + \
                          `request.META['SERVER_PORT']`)
@@ -1307,15 +1566,25 @@ def dmDARStatus(request):
     if request.method == 'GET':
         dm_url = dmcontroller._dm_url
         url = dm_url+DM_DAR_STATUS_COMMAND
+        # the status of all the DARs may be large; it is passed on as
+        # the DM sent it, through a temporary file
+        fp = tempfile.TemporaryFile()
         try:
-            response_data = json.loads(read_from_url(url))
+            size = fetch_url(url, FileSink(fp),
+                             max_size=IE_DM_RESPONSE_MAX_SIZE)
         except URLError as e:
+            fp.close()
             return HttpResponse(
                 "Cannot connect to Download Manager: " + `e`,
                 content_type="text/plain")
-            
-        response_str = json.dumps(response_data,indent=4)
-        return HttpResponse(response_str,content_type="text/plain")
+        except:
+            fp.close()
+            raise
+        fp.seek(0)
+        response = HttpResponse(FileWrapper(fp, DAR_BLK_SZ),
+                                content_type="text/plain")
+        response['Content-Length'] = size
+        return response
     else:
         logger.error("Unxexpected POST request on dmDARStatus url,\n" + \
                          `request.META['SERVER_PORT']`)
@@ -1323,7 +1592,11 @@ def dmDARStatus(request):
 
 @csrf_exempt
 def updateMD_operation(request):
-    return do_post_operation(updateMetaData, request)
+    return do_stream_operation(updateMetaData, request)
+
+@csrf_exempt
+def updateMDBatch_operation(request):
+    return do_stream_operation(updateMetaDataBatch, request)
 
 @csrf_exempt
 def odaDeleteScenario(request, ncn_id):
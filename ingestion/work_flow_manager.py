@@ -22,7 +22,7 @@ import time
 import datetime
 import calendar
 import traceback
-import subprocess
+import spawn_service
 import sys
 
 import models
@@ -45,31 +45,78 @@ from settings import \
     IE_DIMAPMETA_SUFFIX, \
     IE_S2ATM_OUT_SUFFIX, \
     IE_TAR_RESULT_SCRIPT, \
-    IE_TAR_FILE_SUFFIX
+    IE_TAR_FILE_SUFFIX, \
+    IE_CHECKSUM_ALGO, \
+    IE_PP_SPLIT_THREADS, \
+    IE_PP_SCRIPT_THREADS, \
+    IE_PP_POLL_INTERVAL, \
+    IE_SCRIPT_BATCH_SIZE, \
+    IE_WORKER_STUCK_SECS, \
+    IE_TAR_BUILTIN, \
+    IE_TAR_THREADS, \
+    IE_TAR_BLOCK_SZ, \
+    IE_LOCAL_BATCH_THREADS
+
+from multiprocessing.pool import ThreadPool
 
 from ingestion_logic import \
     ingestion_logic, \
     check_status_stopping, \
-    stop_active_dar_dl
+    stop_active_dar_dl, \
+    create_dl_dir
 
-from darc import archive_metadata
+from darc import ArchiveBatch, delete_archive
 
-from add_product import add_product_wfunc
+from result_packer import ResultPacker
+
+from add_product import \
+    add_product_wfunc, \
+    add_product_batch_wfunc, \
+    read_response_file
+
+from local_batch import BatchResults, place_product
 
 from utils import \
     UnsupportedBboxError, \
     IngestionError, \
     StopRequest, \
+    MANIFEST_FN, \
     create_manifest, \
     split_and_create_mf, \
     ie_unpack_maybe, \
     get_glob_list, \
+    script_supports_batch, \
+    write_manifest_list, \
+    read_batch_response, \
     mkFname, \
     get_base_fname, \
     extract_outfile
 
 worker_id = 0
 
+#**************************************************
+#                 Watchdog                        *
+#**************************************************
+class Watchdog(threading.Thread):
+    #
+    # reports worker threads that stay in one stage of a task
+    # (e.g. a script, or waiting for the DM) for longer than max_secs
+    #
+    def __init__(self, work_flow_manager, max_secs):
+        threading.Thread.__init__(self)
+        self._wfm = work_flow_manager
+        self._max_secs = max_secs
+        self._logger = logging.getLogger('dream.file_logger')
+
+    def run(self):
+        interval = min(60, max(1, self._max_secs / 10))
+        while True:
+            time.sleep(interval)
+            for who, stage, secs in self._wfm.check_stuck_stages(self._max_secs):
+                self._logger.warning(
+                    "Watchdog: %s has been in stage '%s' for %d s" %
+                    (who, stage, secs))
+
 #**************************************************
 #                 Work Task                       *
 #**************************************************
@@ -107,7 +154,9 @@ class Worker(threading.Thread):
             "RESET_SCENARIO"   : self.reset_func,
             "INGEST_SCENARIO"  : self.ingest_func,
             "INGEST_LOCAL_PROD": self.local_product_func,
-            "ADD_PRODUCT"      : add_product_wfunc       # from add_product
+            "INGEST_LOCAL_BATCH": self.local_batch_func,
+            "ADD_PRODUCT"      : add_product_wfunc,      # from add_product
+            "ADD_PRODUCT_BATCH": add_product_batch_wfunc # from add_product
             }
 
     def run(self):
@@ -123,6 +172,11 @@ class Worker(threading.Thread):
             if queue.empty():
                 time.sleep(1)
 
+    def set_stage(self, stage):
+        # records what the current thread is doing, for the watchdog;
+        # None when it is done.
+        self._wfm.set_stage("Worker-%d" % self._id, stage)
+
     def mk_s2pre_scriptandargs(self, s2pre, targetdir, s2meta):
         if s2pre == 'NO':
             return []
@@ -183,21 +237,132 @@ class Worker(threading.Thread):
                 scripts_args.append([s, mf_name])
         return scripts_args
 
-    def run_scripts(self, sc_id, ncn_id, scripts_args):
+    def run_scripts(self, sc_id, ncn_id, scripts_args, stop_check=None):
+        # stop_check: called before each script instead of querying the
+        # db for the scenario status (used by the post-processing threads)
         if not scripts_args: return 0
 
         n_errors = 0
         for script_arg in scripts_args:
-            if check_status_stopping(sc_id):
-                raise StopRequest("Stop Request")
+            self.check_stopping(sc_id, stop_check)
 
             self._logger.info("Running script: %s" % script_arg[0])
-            r = subprocess.call(script_arg)
+            self.set_stage("script " + script_arg[0])
+            r = spawn_service.call(script_arg)
             if 0 != r:
                 n_errors += 1
                 self._logger.error(`ncn_id`+": script returned status:"+`r`)
         return n_errors
 
+    def check_stopping(self, sc_id, stop_check=None):
+        if None == stop_check:
+            stopping = check_status_stopping(sc_id)
+        else:
+            stopping = stop_check()
+        if stopping:
+            raise StopRequest("Stop Request")
+
+    def run_batch_script(self, sc_id, ncn_id, dl_dir, script, mf_names,
+                         cat_reg, stop_check=None):
+        # Runs one script for all manifests in mf_names using the batch
+        # protocol (see utils.script_supports_batch), returns the number
+        # of products for which the script failed.
+        self.check_stopping(sc_id, stop_check)
+
+        list_fn, resp_fn = write_manifest_list(dl_dir, mf_names)
+        script_arg = [script, "-batch="+list_fn, "-response="+resp_fn]
+        if cat_reg:
+            script_arg.append(self.mk_catreg_arg())
+        self._logger.info("Running script: %s, batch of %d products" %
+                          (script, len(mf_names)))
+        self.set_stage("script %s, batch of %d" % (script, len(mf_names)))
+        try:
+            # the time-out is per product
+            r = spawn_service.call(
+                script_arg,
+                spawn_service.script_timeout(script) * len(mf_names))
+            status = read_batch_response(resp_fn, mf_names)
+        finally:
+            for fn in (list_fn, resp_fn):
+                if os.path.exists(fn):
+                    os.unlink(fn)
+
+        if 0 != r:
+            self._logger.warning(`ncn_id`+": batch script returned status:"+`r`)
+        n_errors = 0
+        for mf in mf_names:
+            if 0 != status[mf]:
+                n_errors += 1
+                self._logger.error(`ncn_id`+": script returned status:" +
+                                   `status[mf]` + " for " + mf)
+        return n_errors
+
+    def run_scripts_batch(self, sc_id, ncn_id, dl_dir, scripts, mf_names,
+                          cat_reg, stop_check=None):
+        # Runs the scripts for each of the manifests in mf_names.
+        # Scripts that support the batch protocol are started once for
+        # all the manifests, the others once per manifest.
+        batch_scripts = []
+        if len(mf_names) > 1:
+            batch_scripts = [s for s in scripts if script_supports_batch(s)]
+        if not batch_scripts:
+            n_errors = 0
+            for mf_name in mf_names:
+                scripts_args = self.mk_scripts_args(scripts, mf_name, cat_reg)
+                n_errors += self.run_scripts(
+                    sc_id, ncn_id, scripts_args, stop_check)
+            return n_errors
+
+        n_errors = 0
+        for s in scripts:
+            if s in batch_scripts:
+                n_errors += self.run_batch_script(
+                    sc_id, ncn_id, dl_dir, s, mf_names, cat_reg, stop_check)
+            else:
+                for mf_name in mf_names:
+                    n_errors += self.run_scripts(
+                        sc_id, ncn_id,
+                        self.mk_scripts_args([s], mf_name, cat_reg),
+                        stop_check)
+        return n_errors
+
+    def pp_split(self, dl_dir, d, ncn_id, stop_event):
+        # split stage of post_download_actions, runs in a pool thread
+        if stop_event.is_set():
+            return "split", d, (None, None)
+        self._logger.info("Processing dir " + d)
+        self.set_stage("split " + d)
+        try:
+            mf_name, metafiles = split_and_create_mf(
+                dl_dir, d, ncn_id, self._logger, IE_CHECKSUM_ALGO)
+        except Exception as e:
+            self._logger.info("Exception" + `e`)
+            mf_name, metafiles = None, None
+        finally:
+            self.set_stage(None)
+        return "split", d, (mf_name, metafiles)
+
+    def pp_scripts(self, scid, ncn_id, dl_dir, batch, scripts, cat_reg,
+                   stop_event):
+        # script stage of post_download_actions, runs in a pool thread.
+        # batch is a list of (dir, manifest) of split products.
+        # Returns the number of errors.
+        dirs     = [b[0] for b in batch]
+        mf_names = [b[1] for b in batch]
+        try:
+            n_errors = self.run_scripts_batch(
+                scid, ncn_id, dl_dir, scripts, mf_names, cat_reg,
+                stop_event.is_set)
+        except StopRequest:
+            n_errors = 0
+        except Exception as e:
+            self._logger.error(`ncn_id`+": error running scripts for " +
+                               `dirs` + ": " + `e`)
+            n_errors = len(dirs)
+        finally:
+            self.set_stage(None)
+        return "scripts", dirs, n_errors
+
     def post_download_actions(self,
                               scid,
                               ncn_id,
@@ -213,10 +378,18 @@ class Worker(threading.Thread):
         # Then run the post- ingestion scripts.
         # TODO: the splitting could be done by the EO-WCS DM plugin
         #       instead of doing it here
+        #
+        # The products are processed concurrently: the split stage runs
+        # in IE_PP_SPLIT_THREADS threads, the scripts for the split
+        # products are then run in one of IE_PP_SCRIPT_THREADS threads,
+        # for batches of up to IE_SCRIPT_BATCH_SIZE products.
+        # This thread collects the results, inserts the archive records,
+        # updates the progress and checks for a stop request; the
+        # stage threads themselves do not use the db.
         dir_list = os.listdir(dl_dir)
         n_dirs = len(dir_list)
         n_errors = 0
-        i = 1
+        todo = []
         for d in dir_list:
             process = True
             for f in failed_dirs:
@@ -225,39 +398,114 @@ class Worker(threading.Thread):
                     process = False
                     n_errors += 1
                     break
+            if process:
+                todo.append(d)
+
+        # dirs whose download failed count as done for the progress
+        n_done = n_dirs - len(todo)
+        results = Queue.Queue()
+        stop_event = threading.Event()
+        split_pool  = ThreadPool(min(IE_PP_SPLIT_THREADS,  max(1, len(todo))))
+        script_pool = ThreadPool(min(IE_PP_SCRIPT_THREADS, max(1, len(todo))))
+        # the archive records are inserted in batches
+        archive = ArchiveBatch(scid)
+        # the tar file is written while the products are processed
+        packer = None
+        if tar_result and IE_TAR_BUILTIN:
+            try:
+                packer = ResultPacker(dl_dir,
+                                      dl_dir.rstrip(os.sep) + IE_TAR_FILE_SUFFIX,
+                                      IE_TAR_THREADS,
+                                      IE_TAR_BLOCK_SZ)
+            except (IOError, OSError) as e:
+                # the tar script is used instead
+                self._logger.error(`ncn_id`+": cannot create the tar file: " + `e`)
+        completed = False
+        try:
+            for d in todo:
+                split_pool.apply_async(
+                    self.pp_split,
+                    (dl_dir, d, ncn_id, stop_event),
+                    callback=results.put)
 
-            if not process:
-                continue
-            self._logger.info("Processing dir " + d)
-            
-            percent  = 100 * (float(i) / float(n_dirs))
-            # keep percent > 0 to ensure webpage updates
+            percent = 100 * (float(n_done) / float(max(1, n_dirs)))
             if percent < 1.0: percent = 1
             self._wfm.set_scenario_status(self._id, scid, 0, "RUNNING SCRIPTS", percent)
 
-            try:
-                mf_name, metafiles = split_and_create_mf(
-                    dl_dir, d, ncn_id, self._logger)
-            except Exception as e:
-                self._logger.info("Exception" + `e`)
-                mf_name = None
-            if not mf_name:
-                self._logger.info("Error processing download directory " + `d`)
-                n_errors += 1
-                continue
-
-            # archive products that were downloaded
-            for m in metafiles:
-                archive_metadata(scid, m)
-
-            scripts_args = self.mk_scripts_args(
-                scripts, mf_name, cat_reg)
-            n_errors += self.run_scripts(scid, ncn_id, scripts_args)
-
-            i += 1
-
-        # run the tar script if requested
-        if tar_result:
+            pending = len(todo)
+            n_splitting = len(todo)
+            batch = []
+            while pending > 0:
+                try:
+                    stage, d, r = results.get(True, IE_PP_POLL_INTERVAL)
+                except Queue.Empty:
+                    stage = None
+                if check_status_stopping(scid):
+                    raise StopRequest("Stop Request")
+
+                n_finished = 0
+                if stage == "split":
+                    n_splitting -= 1
+                    mf_name, metafiles = r
+                    if mf_name:
+                        # archive products that were downloaded
+                        for m in metafiles:
+                            archive.add(m)
+                        batch.append( (d, mf_name) )
+                    else:
+                        self._logger.info("Error processing download directory " + `d`)
+                        n_errors += 1
+                        n_finished = 1
+                elif stage == "scripts":
+                    n_errors += r
+                    n_finished = len(d)
+                    if packer:
+                        for pd in d:
+                            packer.add_dir(pd)
+
+                # start the scripts when the batch is full, when there
+                # is nothing more to split, or when nothing has arrived
+                # for a while
+                if batch and (len(batch) >= IE_SCRIPT_BATCH_SIZE or
+                              0 == n_splitting or None == stage):
+                    script_pool.apply_async(
+                        self.pp_scripts,
+                        (scid, ncn_id, dl_dir, batch, scripts, cat_reg,
+                         stop_event),
+                        callback=results.put)
+                    batch = []
+
+                if 0 == n_finished:
+                    continue
+                pending -= n_finished
+                n_done += n_finished
+                self.set_stage("post-processing %d/%d" % (n_done, n_dirs))
+                percent  = 100 * (float(n_done) / float(n_dirs))
+                # keep percent > 0 to ensure webpage updates
+                if percent < 1.0: percent = 1
+                self._wfm.set_scenario_status(self._id, scid, 0, "RUNNING SCRIPTS", percent)
+            completed = True
+        finally:
+            if packer and not completed:
+                packer.abort()
+            # let the threads skip whatever has not been started yet,
+            # scripts that are already running are waited for.
+            stop_event.set()
+            split_pool.close()
+            script_pool.close()
+            split_pool.join()
+            script_pool.join()
+            archive.flush()
+
+        # finish the tar file, or run the tar script if requested
+        if packer:
+            self.set_stage("tar " + dl_dir)
+            if check_status_stopping(scid):
+                packer.abort()
+                raise StopRequest("Stop Request")
+            n_errors += self.finish_tar_result(scid, ncn_id, dl_dir,
+                                               packer, cat_reg)
+        elif tar_result:
             if check_status_stopping(scid):
                 raise StopRequest("Stop Request")
 
@@ -266,7 +514,8 @@ class Worker(threading.Thread):
             if cat_reg:
                 script_arg.append(self.mk_catreg_arg())
             self._logger.info(`ncn_id`+": running " + `script_arg`)
-            r = subprocess.call(script_arg)
+            self.set_stage("script " + tar_script)
+            r = spawn_service.call(script_arg)
             if 0 != r:
                 n_errors += 1
                 self._logger.error(`ncn_id`+": tar script returned status:"+`r`)
@@ -277,6 +526,33 @@ class Worker(threading.Thread):
         return n_errors
 
 
+    def finish_tar_result(self, scid, ncn_id, dl_dir, packer, cat_reg):
+        # completes the tar file of the built-in packer and, like the
+        # tar script, runs the cat. registration for each product dir.
+        # Returns the number of errors.
+        if not packer.finish():
+            self._logger.error(`ncn_id`+": writing the tar file failed")
+            return 1
+        self._logger.info(`ncn_id`+": tar file is ready: " +
+                          dl_dir.rstrip(os.sep) + IE_TAR_FILE_SUFFIX)
+        if not cat_reg:
+            return 0
+
+        n_errors = 0
+        catreg_script = os.path.join(IE_SCRIPTS_DIR, IE_DEFAULT_CATREG_SCRIPT)
+        for d in sorted(os.listdir(dl_dir)):
+            if not os.path.isdir(os.path.join(dl_dir, d)):
+                continue
+            self.check_stopping(scid)
+            mf_name = os.path.join(dl_dir, d, MANIFEST_FN)
+            self.set_stage("script " + catreg_script)
+            r = spawn_service.call([catreg_script, mf_name])
+            if 0 != r:
+                n_errors += 1
+                self._logger.error(`ncn_id`+": cat. reg. script returned status:"+
+                                   `r` + " for " + d)
+        return n_errors
+
     def do_task(self,current_task):
 
         parameters = current_task._parameters
@@ -285,6 +561,7 @@ class Worker(threading.Thread):
         if IE_DEBUG > 1:
             self._logger.debug( "do_task: "+task_type )
 
+        self.set_stage(task_type)
         try:
             self.task_functions[task_type](parameters)
         except KeyError:
@@ -295,6 +572,8 @@ class Worker(threading.Thread):
             self._logger.error(
                 "Worker do_task caught exception " + `e` +
                 "- Recovering from Internal Error")
+        finally:
+            self.set_stage(None)
 
     def reset_func(self, parameters):
         self.delete_or_reset(parameters, False)
@@ -345,7 +624,8 @@ class Worker(threading.Thread):
                                 "-catreg=%s"%os.path.join(IE_SCRIPTS_DIR, IE_DEFAULT_CATDEREG_SCRIPT)]
                     else:
                         args = [script, ncn_id]
-                    r = subprocess.call(args)
+                    self.set_stage("script " + script)
+                    r = spawn_service.call(args)
                     if 0 != r:
                         n_errors += 1
                         self._logger.error(
@@ -369,10 +649,12 @@ class Worker(threading.Thread):
                 scripts = scenario.script_set.all()
                 delete_scripts(scripts)
 
+                # the archive may be large, delete it directly
+                delete_archive(scenario.id)
                 scenario.delete()
                 scenario_status.delete()
             else:
-                models.Archive.objects.filter(scenario=scenario).delete()
+                delete_archive(scenario.id)
                 scenario_status.status = "RESET, IDLE"
                 scenario_status.is_available = 1
                 scenario_status.done = 0
@@ -384,6 +666,66 @@ class Worker(threading.Thread):
         finally:
             self._wfm._lock_db.release()
 
+    def ingest_local_dir(self, sc_id, ncn_id, dl_dir, metadata, data,
+                         scripts, s2_preprocess,
+                         set_status=None, stop_check=None):
+        # Ingests the local product in dl_dir: unpacks data, runs the S2
+        # pre-processing, creates the manifest and runs the addProduct
+        # script (the first of scripts, if any).  metadata and data are
+        # file names in dl_dir.  set_status(text) reports the progress.
+        # Returns (n_errors, full name of the addProduct response file
+        # or None).
+        n_errors = 0
+        orig_data = None
+        unpacked = ie_unpack_maybe(dl_dir, data)
+        if not unpacked:
+            raise IngestionError(
+                "Error unpacking or accessing " +
+                os.path.join(dl_dir, data))
+        data = unpacked
+
+        if 'NO' != s2_preprocess:
+            s2script_args = self.mk_s2pre_scriptandargs(
+                s2_preprocess, dl_dir, metadata)
+
+            if s2script_args:
+                if set_status: set_status("LOCAL ING.: S2-PRE")
+                s2pre_errors = self.run_scripts(
+                    sc_id, ncn_id, s2script_args, stop_check)
+                if s2pre_errors > 0:
+                    n_errors += s2pre_errors
+                else:
+                    orig_data = data
+                    data = extract_outfile(s2script_args[0][3])
+
+        create_manifest(
+            self._logger,
+            ncn_id,
+            dl_dir,
+            metadata=metadata,
+            data=data,
+            orig_data=orig_data
+            )
+
+        if set_status: set_status("RUNNING SCRIPTS")
+
+        scripts_args = []
+        resp_full_fname = None
+        if len(scripts) > 0:
+            resp_fname = mkFname("addProdResp_")
+            resp_full_fname = os.path.join(dl_dir,resp_fname)
+            ap_script = [scripts[0]]
+            ap_script.append("-add")
+            ap_script.append("-dldir="+dl_dir)
+            ap_script.append("-response="+resp_fname)
+            if metadata is not None:
+                ap_script.append("-meta="+get_base_fname(metadata))
+            ap_script.append("-data="+get_base_fname(data))
+            scripts_args.append(ap_script)
+
+        n_errors += self.run_scripts(sc_id, ncn_id, scripts_args, stop_check)
+        return n_errors, resp_full_fname
+
     def local_product_func(self,parameters):
         if IE_DEBUG > 0:
             self._logger.info(
@@ -400,62 +742,16 @@ class Worker(threading.Thread):
             self._wfm.set_ingestion_pid(sc_id, os.getpid())
             ncn_id = parameters["ncn_id"].encode('ascii','ignore')
 
-            data = parameters["data"]
-            orig_data = None
-            data = ie_unpack_maybe(parameters["dir_path"], data)
-            if not data:
-                raise IngestionError(
-                    "Error unpacking or accessing " +
-                    os.path.join(parameters["dir_path"]), data)
-
-            if 'NO' != parameters["s2_preprocess"]:
-                s2script_args = self.mk_s2pre_scriptandargs(
-                    parameters["s2_preprocess"],
-                    parameters["dir_path"],
-                    parameters["metadata"])
-
-                if s2script_args:
-
-                    self._wfm.set_scenario_status(
-                        self._id, sc_id, 0, "LOCAL ING.: S2-PRE", percent)
-            
-                    s2pre_errors = self.run_scripts(sc_id, ncn_id, s2script_args)
-                    if s2pre_errors > 0:
-                        n_errors += s2pre_errors
-                    else:
-                        orig_data = data
-                        data = extract_outfile(s2script_args[0][3])
-
-            mf_name = create_manifest(
-                self._logger,
+            n_errors, resp_full_fname = self.ingest_local_dir(
+                sc_id,
                 ncn_id,
                 parameters["dir_path"],
-                metadata=parameters["metadata"],
-                data=data,
-                orig_data=orig_data
-                )
-
-            self._wfm.set_scenario_status(
-                self._id, sc_id, 0, "RUNNING SCRIPTS", percent)
-
-            scripts_args = []
-            
-            scripts = parameters["scripts"]
-            if len(scripts) > 0:
-                resp_fname = mkFname("addProdResp_")
-                dl_dir = parameters["dir_path"]
-                resp_full_fname = os.path.join(dl_dir,resp_fname)
-                ap_script = [scripts[0]]
-                ap_script.append("-add")
-                ap_script.append("-dldir="+dl_dir)
-                ap_script.append("-response="+resp_fname)
-                metadata=parameters["metadata"]
-                if metadata is not None:
-                    ap_script.append("-meta="+get_base_fname(metadata))
-                ap_script.append("-data="+get_base_fname(data))
-                scripts_args.append(ap_script)
-
-            n_errors += self.run_scripts(sc_id, ncn_id, scripts_args)
+                parameters["metadata"],
+                parameters["data"],
+                parameters["scripts"],
+                parameters["s2_preprocess"],
+                lambda st: self._wfm.set_scenario_status(
+                    self._id, sc_id, 0, st, percent))
 
             if n_errors > 0:
                 raise IngestionError("Number of errors " +`n_errors`)
@@ -478,6 +774,120 @@ class Worker(threading.Thread):
             self._wfm.set_ingestion_pid(sc_id, 0)
 
 
+    def local_batch_one(self, sc_id, ncn_id, parameters, product,
+                        results, stop_event):
+        # ingests one product of a batch, runs in a thread of the pool
+        data_src, meta_src = product
+        result = {"data": data_src, "metadata": meta_src}
+        n_bytes = 0
+        t_start = time.time()
+        try:
+            if stop_event.is_set():
+                raise StopRequest("Stop Request")
+            self.set_stage("local batch " + data_src)
+            dl_dir, rel_path = create_dl_dir(ncn_id+"_")
+            data, n_bytes = place_product(data_src, dl_dir)
+            meta = None
+            if meta_src:
+                meta, n = place_product(meta_src, dl_dir)
+                n_bytes += n
+            n_errors, resp_full_fname = self.ingest_local_dir(
+                sc_id,
+                ncn_id,
+                dl_dir,
+                meta,
+                data,
+                parameters["scripts"],
+                parameters["s2_preprocess"],
+                stop_check=stop_event.is_set)
+            if n_errors > 0:
+                raise IngestionError("Number of errors " +`n_errors`)
+            if resp_full_fname:
+                resp = read_response_file(resp_full_fname)
+                if "productId" in resp: result["productId"] = resp["productId"]
+                if "url" in resp:       result["url"]       = resp["url"]
+            result["status"] = "success"
+        except StopRequest:
+            result["status"] = "stopped"
+        except Exception as e:
+            self._logger.error(`ncn_id`+": Error while ingesting local product " +
+                               data_src + ": " + `e`)
+            result["status"] = "failed"
+            result["error"]  = "%s" % e
+        finally:
+            self.set_stage(None)
+        result["secs"] = time.time() - t_start
+        results.add(result, n_bytes)
+
+    def local_batch_func(self, parameters):
+        # INGEST_LOCAL_BATCH, see local_batch.py
+        sc_id    = parameters["scenario_id"]
+        ncn_id   = parameters["ncn_id"]
+        products = parameters["products"]
+        results  = BatchResults(parameters["batch_id"])
+        if IE_DEBUG > 0:
+            self._logger.info(
+                "wfm: executing INGEST_LOCAL_BATCH, id=" + `sc_id` +
+                ", " + `len(products)` + " products")
+
+        final_status = "success"
+        stop_event = threading.Event()
+
+        def stopping():
+            # True after a stop request, which stops the products that
+            # have not been started and those between scripts
+            if not stop_event.is_set() and check_status_stopping(sc_id):
+                self._logger.info(`ncn_id`+
+                    ": Stop request from user: Local Batch Stopped")
+                stop_event.set()
+            return stop_event.is_set()
+
+        pool = ThreadPool(IE_LOCAL_BATCH_THREADS)
+        try:
+            self._wfm.set_scenario_status(
+                self._id, sc_id, 0, "LOCAL BATCH", 1)
+            # set_stop_request only sets STOP_REQUEST for a scenario
+            # with an ingestion pid
+            self._wfm.set_ingestion_pid(sc_id, os.getpid())
+            pending = [ pool.apply_async(
+                    self.local_batch_one,
+                    (sc_id, ncn_id, parameters, p, results, stop_event))
+                        for p in products ]
+            n_done = 0
+            percent = 1
+            for r in pending:
+                while not r.ready():
+                    r.wait(IE_PP_POLL_INTERVAL)
+                    stopping()
+                n_done += 1
+                # the progress must not overwrite a stop request
+                if not stopping() and \
+                        max(1, 100 * n_done / len(products)) != percent:
+                    percent = max(1, 100 * n_done / len(products))
+                    self._wfm.set_scenario_status(
+                        self._id, sc_id, 0, "LOCAL BATCH", percent)
+                results.save()
+            if stop_event.is_set():
+                final_status = "stopped"
+            elif results.n_failed() > 0:
+                final_status = "failed"
+
+        except Exception as e:
+            self._logger.error(`ncn_id`+" Error in local batch ingestion: " + `e`)
+            final_status = "failed"
+            stop_event.set()
+            if IE_DEBUG > 0:
+                traceback.print_exc(12,sys.stdout)
+
+        finally:
+            pool.close()
+            pool.join()
+            results.save(final_status)
+            self._wfm.set_ingestion_pid(sc_id, 0)
+            self._wfm.set_scenario_status(self._id, sc_id, 1, "IDLE", 0)
+            self._logger.info(`ncn_id`+": local batch " +
+                              `parameters["batch_id"]` + " " + final_status)
+
     def ingest_func(self,parameters):
         if IE_DEBUG > 0:
             self._logger.info(
@@ -491,12 +901,14 @@ class Worker(threading.Thread):
         self._wfm.set_scenario_status(
             self._id, sc_id, 0, "GENERATING URLS", percent)
         try:
-            scenario = models.Scenario.objects.get(id=sc_id)
+            scenario = models.Scenario.objects.prefetch_related(
+                *models.SCENARIO_DICT_RELATED).get(id=sc_id)
             ncn_id   = scenario.ncn_id.encode('ascii','ignore')
             cat_reg  = scenario.cat_registration
 
             # ingestion_logic blocks until DM is finished downloading
             self._wfm.set_ingestion_pid(sc_id, os.getpid())
+            self.set_stage("INGEST_SCENARIO: urls/download")
             dl_errors, dl_dir, dar_url, dar_id, status, failed_dirs = \
                 ingestion_logic(sc_id, models.scenario_dict(scenario))
 
@@ -518,6 +930,7 @@ class Worker(threading.Thread):
                         " Hint: use local ingestion instead")
                     s2pre = 'NO'
 
+                self.set_stage("INGEST_SCENARIO: post-processing")
                 n_errors = self.post_download_actions(
                     sc_id,
                     ncn_id,
@@ -666,6 +1079,12 @@ class WorkFlowManager:
             n += 1
 
         self._AIS_worker = AISWorker(self)
+        self._watchdog   = Watchdog(self, IE_WORKER_STUCK_SECS)
+
+        # current stage of the worker threads, for the watchdog,
+        # key is the thread ident, value is [who, stage, since, n_reports]
+        self._stages = {}
+        self._lock_stages = threading.Lock()
 
         self._lock_db = threading.Lock()
         self._logger = logging.getLogger('dream.file_logger')
@@ -676,6 +1095,42 @@ class WorkFlowManager:
     def release_db(self):
         self._lock_db.release()
 
+    def set_stage(self, who, stage):
+        key = threading.current_thread().ident
+        self._lock_stages.acquire()
+        try:
+            if None == stage:
+                self._stages.pop(key, None)
+            else:
+                self._stages[key] = [who, stage, time.time(), 0]
+        finally:
+            self._lock_stages.release()
+
+    def get_stages(self):
+        # returns a list of (who, stage, seconds in the stage)
+        now = time.time()
+        self._lock_stages.acquire()
+        try:
+            return [ (v[0], v[1], now - v[2]) for v in self._stages.values() ]
+        finally:
+            self._lock_stages.release()
+
+    def check_stuck_stages(self, max_secs):
+        # returns the (who, stage, seconds) that are over the limit and
+        # have not been reported in the last max_secs
+        now = time.time()
+        stuck = []
+        self._lock_stages.acquire()
+        try:
+            for v in self._stages.values():
+                secs = now - v[2]
+                if secs > max_secs * (v[3] + 1):
+                    v[3] += 1
+                    stuck.append( (v[0], v[1], secs) )
+        finally:
+            self._lock_stages.release()
+        return stuck
+
     def put_task_to_queue(self,current_task):
         if isinstance(current_task,WorkerTask):
             self._queue.put(current_task)
@@ -796,6 +1251,9 @@ class WorkFlowManager:
 
     def start(self):
         self._AIS_worker.start()
+        if IE_WORKER_STUCK_SECS > 0:
+            self._watchdog.setDaemon(True)
+            self._watchdog.start()
         for w in self._workers:
             w.setDaemon(True)
             w.start()
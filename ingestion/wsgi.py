@@ -32,10 +32,18 @@ import logging
 import json
 
 import dm_control
+import md_eval_pool
+import spawn_service
 import product_manager
 import work_flow_manager
-from settings import IE_PROJECT
-    
+from settings import \
+    IE_PROJECT, \
+    IE_SPAWN_SERVICE, \
+    IE_SPAWN_PYTHON, \
+    IE_SCRIPT_TIMEOUT, \
+    IE_SCRIPT_TIMEOUTS, \
+    IE_SCRIPT_LIMITS
+
 # We defer to a DJANGO_SETTINGS_MODULE already in the environment.
 # This breaks if running multiple sites in the same mod_wsgi process. 
 # To fix this, use mod_wsgi daemon mode with each site in its own 
@@ -43,6 +51,14 @@ from settings import IE_PROJECT
 # os.environ["DJANGO_SETTINGS_MODULE"] = "<project>.settings"
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", IE_PROJECT + ".settings")
 
+# start the helper process for running the external scripts, it gets
+# the environment above (scripts may use DJANGO_SETTINGS_MODULE)
+spawn_service.configure(IE_SCRIPT_TIMEOUT,
+                        IE_SCRIPT_LIMITS,
+                        IE_SCRIPT_TIMEOUTS)
+if IE_SPAWN_SERVICE:
+    spawn_service.start(None, IE_SPAWN_PYTHON)
+
 # This application object is used by any WSGI server configured to use this
 # file. This includes Django's development server, if the WSGI_APPLICATION
 # setting points here.
@@ -52,6 +68,21 @@ application = get_wsgi_application()
 #  Misc. Initialisations for DREAM/Ingestion
 logger = logging.getLogger('dream.file_logger')
 
+# add the eoid_hash column and index to an Archive table from an
+# older version, if needed
+import darc
+try:
+    darc.upgrade_archive_table()
+except Exception as e:
+    logger.error("Error upgrading the Archive table: " + `e`)
+
+# tables of models added since the db was created
+import local_batch
+try:
+    local_batch.create_batch_table()
+except Exception as e:
+    logger.error("Error creating the LocalBatch table: " + `e`)
+
 # start the ngEO download manager (external process)
 dmcontroller = dm_control.DownloadManagerController.Instance()
 dm_is_running = dmcontroller.configure()
@@ -59,6 +90,10 @@ if not dm_is_running:
     logger.warning("Could not verify a listening Download Manager port, "+
                    "Ingestion Engine started-up regardless.")
 
+# start the md evaluation process pool (if enabled), this must be
+# done before the work-flow manager threads are started
+md_eval_pool.start()
+
 # start work-flow manager
 wfmanager = work_flow_manager.WorkFlowManager.Instance()
 wfmanager.start()
@@ -8,3 +8,6 @@ echo '---- IF-DREAM-O-AddProduct --------'
 echo
 echo '---- IF-DREAM-O-ManageScenario --------'
 ( cd manageScenario_sa; ./test_manageScenario.py )
+echo
+echo '---- ie_xml_parser backends --------'
+( cd xmlParser_sa; ./test_xml_backends.py )
@@ -21,6 +21,7 @@ from urllib2 import urlopen
 METADATA = "short.xml"
 DEBUG    = 0
 SERVICE_URL = 'http://127.0.0.1:8000/ingest/uqmd/updateMD'
+SERVICE_BATCH_URL = 'http://127.0.0.1:8000/ingest/uqmd/updateMDBatch'
 
 BLK_SZ = 8192
 
@@ -110,6 +111,23 @@ else:
     n_errors += 1
     print "FAILED"
 
+print "    test batch: ",
+outer = MIMEMultipart()
+for prod_id, action in (("prod1", "add"), ("prod2", "replace"), ("prod3", "BadRequest")):
+    outer.attach(MIMEApplication(
+            json.dumps({"productID" : prod_id, "action" : action}),
+            "json", encode_noop))
+    outer.attach(MIMEApplication(metadata, "xml",  encode_bin))
+resp = json.loads(read_from_url(SERVICE_BATCH_URL, outer.as_string()))
+if resp['status'] == 0 and \
+        [p['status'] for p in resp['products']] == [0, 0, 1]:
+    print "OK"
+else:
+    n_errors += 1
+    print "FAILED"
+    if DEBUG>0:
+        print "response:\n"+`resp`
+
 if not n_errors:
     print TEST_SUBJECT+": TESTS PASSED"
 
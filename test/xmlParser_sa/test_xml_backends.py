@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#--------------------------------------------------------
+# DREAM test harness/utility
+#
+# (c) 2014 Siemens Convergence Creators, s.r.o, Prague.
+#--------------------------------------------------------
+
+TEST_SUBJECT='ie_xml_parser backends'
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join("..", "..", "ingestion"))
+
+import ie_xml_parser as xp
+
+DEBUG = 0
+
+# (file, expected root tag, contains CoverageDescriptions)
+SAMPLES = (
+    ("cds_draft.xml",  "EOCoverageSetDescription", True),
+    ("cds_final.xml",  "EOCoverageSetDescription", True),
+    ("caps_draft.xml", "Capabilities",             False),
+    ("caps_final.xml", "Capabilities",             False),
+    (os.path.join("..", "addProduct_sa", "short.xml"), None, False),
+    )
+
+def cd_values(cd, wcs_type):
+    # everything that ingestion_logic and coastline_ck extract from a
+    # CoverageDescription
+    v = {}
+    v['CoverageId']   = xp.extract_CoverageId(cd)
+    v['eoid']         = xp.extract_eoid(cd, wcs_type)
+    v['gml_bbox']     = `xp.extract_gml_bbox(cd)`
+    v['om_time']      = `xp.extract_om_time(cd, wcs_type)`
+    v['sensor']       = xp.extract_paths_text(cd, xp.xpaths_sensor(wcs_type))
+    v['angle']        = xp.extract_paths_text(
+        cd, xp.xpaths_incidenceangle(wcs_type))
+    v['cloud_cover']  = xp.extract_paths_text(
+        cd, xp.xpaths_cloudcover(wcs_type))
+    v['prods_masks']  = xp.extract_prods_and_masks(cd, True)
+    rec = xp.extract_cd_record(cd, wcs_type, True)
+    for a in rec.__slots__:
+        val = getattr(rec, a)
+        if a in ('bbox', 'time_period'): val = `val`
+        v['record.'+a] = val
+    if rec.has_footprint:
+        v['footprint'] = xp.extract_footprintpolys(cd, wcs_type)
+    return v
+
+def doc_values(fname, root_tag, is_cds):
+    v = {}
+    root = xp.parse_file(fname, root_tag, fname, True)
+    if None == root:
+        v['root'] = None
+        return v
+    ns_map = xp.get_ns_map(root)
+    v['ns_uris']    = sorted(ns_map.values())
+    v['wcs_type']   = xp.determine_wcs_type(root)
+    v['wcseo_type'] = xp.determine_wcseo_type(root)
+    v['stream_eoid'] = xp.stream_extract_eoid(fname)
+    if root_tag == "Capabilities":
+        v['version'] = xp.extract_ServiceTypeVersion(root)
+        dss_list = xp.extract_DatasetSeriesSummaries(root, v['wcs_type'])
+        v['dss'] = [ (xp.extract_Id(dss, v['wcs_type']),
+                      `xp.extract_WGS84bbox(dss)`,
+                      `xp.extract_TimePeriod(dss)`) for dss in dss_list ]
+    if is_cds:
+        cds = xp.get_coverageDescriptions(root)
+        v['cds'] = [ cd_values(cd, v['wcseo_type']) for cd in cds ]
+        # as sent to the md evaluation processes
+        v['cds_copied'] = [
+            cd_values(xp.xml_fromstring(xp.xml_tostring(cd)), v['wcseo_type'])
+            for cd in cds ]
+    return v
+
+def values_for_backend(backend):
+    if xp.set_backend(backend) != backend:
+        return None
+    result = {}
+    for fname, root_tag, is_cds in SAMPLES:
+        result[fname] = doc_values(fname, root_tag, is_cds)
+    return result
+
+print "Testing " + TEST_SUBJECT
+print "Date of test run: " + time.ctime()
+
+if not xp.have_lxml:
+    print "lxml is not installed, nothing to compare: SKIPPED"
+    sys.exit(0)
+
+n_errors = 0
+
+etree_vals = values_for_backend(xp.BACKEND_ETREE)
+lxml_vals  = values_for_backend(xp.BACKEND_LXML)
+
+for fname, root_tag, is_cds in SAMPLES:
+    print "    "+fname+": ",
+    e = etree_vals[fname]
+    l = lxml_vals[fname]
+    if e == l and not (is_cds and not e.get('cds')) and \
+            e.get('cds') == e.get('cds_copied'):
+        print "OK"
+    else:
+        n_errors += 1
+        print "FAILED"
+        if DEBUG > 0:
+            print "etree:\n" + `e`
+            print "lxml:\n"  + `l`
+
+print "    malformed xml: ",
+ok = True
+for backend in (xp.BACKEND_ETREE, xp.BACKEND_LXML):
+    xp.set_backend(backend)
+    try:
+        xp.xml_fromstring("<a><b></a>")
+        ok = False
+    except xp.XML_PARSE_ERRORS:
+        pass
+if ok: print "OK"
+else:
+    n_errors += 1
+    print "FAILED"
+
+if not n_errors:
+    print TEST_SUBJECT+": TESTS PASSED"
+
+else:
+    print "FAILED with "+`n_errors`+" failures."